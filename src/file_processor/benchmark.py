@@ -0,0 +1,335 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+# Offline benchmarks for each stage of the fingerprinting and matching pipeline.
+#
+# Generates deterministic synthetic audio (chirps, tones and tones mixed with noise) of a few
+# lengths, writes it as wav, mp3 and MPEG-TS, and times each stage on every file. Database
+# lookups go to InMemoryDataApi, an in-process stand-in for the RDS Data API, so no AWS
+# access is needed. Results are written as JSON, and can be compared against an earlier
+# results file:
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --baseline results.json --output new_results.json
+#
+# The process exits with status 1 if any file is not matched to its song, or if any stage
+# is slower than its baseline by more than the tolerance.
+
+import os
+import sys
+import json
+import platform
+import tempfile
+from collections import Counter
+from time import perf_counter, sleep
+import av
+import numpy as np
+import db_utils
+from fingerprinting import get_samples_from_file, file_to_spectrogram, find_peaks, \
+    idxs_to_tf_pairs, hash_points, get_fingerprint_arrays
+from fingerprinting_config import SAMPLE_RATE, FINGERPRINT_FORMAT
+from matching import get_best_match
+from storage import set_storage
+
+SIGNAL_KINDS = ['chirp', 'tones', 'mixed']
+AUDIO_FORMATS = ['wav', 'mp3', 'ts']
+DURATIONS = [10, 60]
+# how many times each stage is run - the median is reported
+REPEATS = 3
+# songs in the stand-in database besides the ones being queried
+CATALOGUE_DISTRACTORS = 20
+# a stage regresses if it is this much slower than the baseline...
+REGRESSION_TOLERANCE = 0.25
+# ...and by at least this many seconds, so tiny stages don't fail on noise
+REGRESSION_MIN_SECONDS = 0.005
+
+STAGES = ['get_samples_from_file', 'file_to_spectrogram', 'find_peaks', 'hash_points',
+          'lookup', 'get_best_match']
+
+
+def generate_signal(kind, seconds, seed=0):
+    """Generates deterministic mono audio at :data:`SAMPLE_RATE`.
+
+    :param kind: 'chirp' (overlapping frequency sweeps), 'tones' (short notes at random
+        pitches) or 'mixed' (tones over broadband noise).
+    :param seconds: Length of the audio.
+    :param seed: Seed for the random pitches, timings and noise.
+    :returns: Array of 16-bit samples.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    signal = np.zeros_like(t)
+
+    if kind == 'chirp':
+        # sweeps restart every few seconds, each with its own range
+        period = 4.0
+        for _ in range(3):
+            f0, f1 = rng.uniform(200, 5000, size=2)
+            phase_t = (t + rng.uniform(0, period)) % period
+            rate = (f1 - f0) / period
+            signal += np.sin(2 * np.pi * (f0 * phase_t + rate * phase_t ** 2 / 2))
+    elif kind in ('tones', 'mixed'):
+        for _ in range(int(seconds * 8)):
+            freq = rng.uniform(100, 4000)
+            start = rng.uniform(0, seconds)
+            length = rng.uniform(0.1, 1.5)
+            note = (t >= start) & (t < start + length)
+            signal[note] += np.sin(2 * np.pi * freq * t[note])
+        if kind == 'mixed':
+            signal += 0.3 * rng.standard_normal(len(t))
+    else:
+        raise ValueError(f'Unknown signal kind {kind}')
+
+    signal /= max(np.abs(signal).max(), 1e-9)
+    return (signal * 20000).astype(np.int16)
+
+
+def write_audio(path, samples, audio_format):
+    """Encodes mono 16-bit samples as wav, mp3 or ts (MPEG-TS with AAC audio)."""
+    codec, container_format = {
+        'wav': ('pcm_s16le', 'wav'),
+        'mp3': ('mp3', 'mp3'),
+        'ts': ('aac', 'mpegts'),
+    }[audio_format]
+    with av.open(path, 'w', format=container_format) as container:
+        stream = container.add_stream(codec, rate=SAMPLE_RATE, layout='mono')
+        frame_samples = 1152
+        for start in range(0, len(samples), frame_samples):
+            chunk = samples[start:start + frame_samples]
+            frame = av.AudioFrame.from_ndarray(chunk.reshape(1, -1), format='s16', layout='mono')
+            frame.sample_rate = SAMPLE_RATE
+            frame.pts = start
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+
+class InMemoryDataApi:
+    """An in-process stand-in for the RDS Data API client, holding fingerprints in memory.
+
+    Answers the statements that lookups make - the schema version check, the stop hash query,
+    the paged fingerprint SELECT and the song name lookup - in the same response format as the
+    Data API.
+
+    :param latency: Seconds to sleep per statement, to model the network round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.statements = 0
+        self.rows_by_hash = {}
+        self.songs = []
+
+    def add_song(self, songid, hashes, timesteps):
+        self.songs.append(songid)
+        song = len(self.songs)
+        # timesteps are rounded half up, as PostgreSQL rounds them into the INT column
+        for h, t in zip(hashes.tolist(), np.floor(timesteps + 0.5).astype(np.int64).tolist()):
+            self.rows_by_hash.setdefault(h, []).append((song, t))
+
+    def execute_statement(self, sql, parameters=(), **kwargs):
+        self.statements += 1
+        if self.latency:
+            sleep(self.latency)
+        values = {p['name']: next(iter(p['value'].values())) for p in parameters}
+
+        if "to_regclass('fingerprints')" in sql:
+            # no old fingerprints table to read
+            return {'records': [[{'booleanValue': False}]]}
+        if 'to_regclass' in sql:
+            return {'records': [[{'booleanValue': True}]]}
+        if 'FROM schema_migrations' in sql:
+            return {'records': [[{'longValue': len(db_utils.SCHEMA_MIGRATIONS)}]]}
+        if 'FROM hash_stats' in sql:
+            return {'records': self._stop_hashes(values)}
+        if 'FROM song_fingerprints' in sql and kwargs.get('formatRecordsAs') == 'JSON':
+            return {'formattedRecords': json.dumps([self._select_page(values)])}
+        if sql.startswith('SELECT id, songid FROM songs'):
+            ids = [int(song) for song in values['ids'].strip('{}').split(',') if song]
+            return {'records': [[{'longValue': song}, {'stringValue': self.songs[song - 1]}] for song in ids]}
+        raise NotImplementedError(f'InMemoryDataApi does not support: {sql}')
+
+    def _stop_hashes(self, values):
+        records = []
+        for h, rows in self.rows_by_hash.items():
+            songs = len({row[0] for row in rows})
+            if songs >= values['minsongs'] and songs > values['maxfraction'] * len(self.songs):
+                records.append([{'longValue': h}, {'longValue': len(rows)}])
+        return records
+
+    def _select_page(self, values):
+        hashes = sorted(set(int(h) for h in values['hashes'].strip('{}').split(',') if h))
+        after = (values['lasthash'], values['lastsong'], values['laststep'])
+        page = {'hashes': [], 'songs': [], 'timesteps': [], 'counts': []}
+        for h in hashes:
+            if h < after[0]:
+                continue
+            grouped = Counter(self.rows_by_hash.get(h, ()))
+            for song, timestep in sorted(grouped):
+                if (h, song, timestep) > after:
+                    for column, value in zip(page.values(), (h, song, timestep, grouped[song, timestep])):
+                        column.append(value)
+                    if len(page['hashes']) == db_utils.SELECT_PAGE_ROWS:
+                        return page
+        # array_agg over no rows is NULL
+        return page if page['hashes'] else dict.fromkeys(page)
+
+
+def time_stage(fn, repeats=REPEATS):
+    # runs fn repeats times, returning its last result and the median and fastest times
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        result = fn()
+        times.append(perf_counter() - start)
+    return result, {'median': float(np.median(times)), 'min': float(min(times))}
+
+
+def run_case(path, songid, repeats=REPEATS):
+    # times every stage on one file, feeding each stage the output of the one before
+    stages = {}
+    samples, stages['get_samples_from_file'] = time_stage(lambda: get_samples_from_file(path), repeats)
+    (f, t, Sxx), stages['file_to_spectrogram'] = time_stage(lambda: file_to_spectrogram(path), repeats)
+    peaks, stages['find_peaks'] = time_stage(lambda: find_peaks(Sxx), repeats)
+    points = idxs_to_tf_pairs(peaks, t, f)
+    (hashes, offsets), stages['hash_points'] = time_stage(lambda: hash_points(points), repeats)
+    fingerprints = list(zip(hashes.tolist(), offsets.tolist()))
+    matches, stages['lookup'] = time_stage(lambda: db_utils.get_db_matches_for_fingerprints(fingerprints), repeats)
+    (song, score), stages['get_best_match'] = time_stage(lambda: get_best_match(matches), repeats)
+    return {
+        'samples': len(samples),
+        'peaks': len(points),
+        'fingerprints': len(fingerprints),
+        'matched_song': song,
+        'expected_song': songid,
+        'score': score,
+        'stages': stages,
+    }
+
+
+def run_benchmarks(kinds=SIGNAL_KINDS, audio_formats=AUDIO_FORMATS, durations=DURATIONS,
+                   repeats=REPEATS, latency=0.0):
+    """Runs every combination of signal kind, audio format and duration.
+
+    :returns: Dictionary of results, keyed by case name ("kind-seconds-format").
+    """
+    data_api = InMemoryDataApi(latency=latency)
+    set_storage(db_utils.DataApiStorage(client=data_api))
+    cases = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the catalogue holds every clean signal, plus unrelated distractor songs
+        signals = {}
+        for seed, (kind, seconds) in enumerate((k, s) for k in kinds for s in durations):
+            signals[kind, seconds] = generate_signal(kind, seconds, seed=seed)
+        for i in range(CATALOGUE_DISTRACTORS):
+            kind = SIGNAL_KINDS[i % len(SIGNAL_KINDS)]
+            path = os.path.join(tmp_dir, f'distractor{i}.wav')
+            write_audio(path, generate_signal(kind, 30, seed=1000 + i), 'wav')
+            data_api.add_song(f'distractor{i}', *get_fingerprint_arrays(path))
+
+        for (kind, seconds), samples in signals.items():
+            songid = f'{kind}-{seconds}'
+            clean_path = os.path.join(tmp_dir, f'{songid}.wav')
+            write_audio(clean_path, samples, 'wav')
+            data_api.add_song(songid, *get_fingerprint_arrays(clean_path))
+
+        for (kind, seconds), samples in signals.items():
+            for audio_format in audio_formats:
+                name = f'{kind}-{seconds}-{audio_format}'
+                path = os.path.join(tmp_dir, f'{name}.{audio_format}')
+                write_audio(path, samples, audio_format)
+                print(f'Running {name}')
+                cases[name] = run_case(path, f'{kind}-{seconds}', repeats)
+
+    return {
+        'fingerprint_format': FINGERPRINT_FORMAT,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'av': av.__version__,
+        'repeats': repeats,
+        'latency': latency,
+        'cases': cases,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Compares the median time of every stage against a baseline results file.
+
+    :returns: List of (case, stage, baseline seconds, new seconds) for every regression.
+    """
+    regressions = []
+    for name, case in results['cases'].items():
+        baseline_case = baseline['cases'].get(name)
+        if baseline_case is None:
+            continue
+        for stage, timing in case['stages'].items():
+            if stage not in baseline_case['stages']:
+                continue
+            before = baseline_case['stages'][stage]['median']
+            after = timing['median']
+            ratio = after / before if before > 0 else float('inf')
+            print(f'{name:20} {stage:22} {before:8.4f}s -> {after:8.4f}s ({ratio:5.2f}x)')
+            if after > before * (1 + tolerance) and after - before > REGRESSION_MIN_SECONDS:
+                regressions.append((name, stage, before, after))
+    return regressions
+
+
+def print_results(results):
+    print(f'{"case":20} ' + ' '.join(f'{stage[:14]:>14}' for stage in STAGES) + '  match')
+    for name, case in results['cases'].items():
+        times = ' '.join(f'{case["stages"][stage]["median"]:14.4f}' for stage in STAGES)
+        matched = 'ok' if case['matched_song'] == case['expected_song'] else f'MISSED ({case["matched_song"]})'
+        print(f'{name:20} {times}  {matched}')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark each stage of fingerprinting and matching')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write results to')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help='allowed slowdown against the baseline, as a fraction')
+    parser.add_argument('--kinds', nargs='+', default=SIGNAL_KINDS, choices=SIGNAL_KINDS)
+    parser.add_argument('--formats', nargs='+', default=AUDIO_FORMATS, choices=AUDIO_FORMATS)
+    parser.add_argument('--durations', nargs='+', type=int, default=DURATIONS)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of simulated Data API latency per statement')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.kinds, args.formats, args.durations, args.repeats, args.latency)
+    print_results(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    failed = False
+    for name, case in results['cases'].items():
+        if case['matched_song'] != case['expected_song']:
+            print(f'MISMATCH: {name} matched {case["matched_song"]}, expected {case["expected_song"]}')
+            failed = True
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for name, stage, before, after in regressions:
+            print(f'REGRESSION: {name} {stage} took {after:.4f}s, baseline {before:.4f}s')
+        failed = failed or len(regressions) > 0
+
+    if failed:
+        sys.exit(1)
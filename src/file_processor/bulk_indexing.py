@@ -0,0 +1,225 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import json
+import multiprocessing
+import pathlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
+from db_utils import store_fingerprints_to_db, get_indexed_content_key
+from fingerprint_cache import get_content_key_for_etag, get_content_key_for_file
+from fingerprint_index import update_index
+from fingerprinting import get_fingerprints
+from s3_utils import get_s3_client
+from validation_utils import is_music_file
+
+# threads downloading from S3, and threads storing fingerprints to the database
+DOWNLOAD_WORKERS = 4
+INSERT_WORKERS = 2
+# most tracks in flight (downloading, downloaded, fingerprinting or storing) at once
+MAX_IN_FLIGHT = 32
+# print progress after this many tracks
+REPORT_EVERY = 25
+
+
+def list_tracks(source):
+    # lists the (songid, location, etag) of every music file under an s3://bucket/prefix
+    # or a local directory. Local files have no ETag
+    if source.startswith('s3://'):
+        bucket, _, prefix = source[len('s3://'):].partition('/')
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if is_music_file(obj['Key']):
+                    yield pathlib.PurePath(obj['Key']).stem, f's3://{bucket}/{obj["Key"]}', obj['ETag']
+    else:
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if is_music_file(name):
+                    yield pathlib.PurePath(name).stem, os.path.join(root, name), None
+
+
+def load_checkpoint(checkpoint_path):
+    # the locations already indexed by earlier runs
+    done = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                if line.strip():
+                    done.add(json.loads(line)['location'])
+    return done
+
+
+def fetch_track(track, tmp_dir):
+    # returns (local path, whether it is a temporary download, content key) for the track,
+    # or None if the song is already indexed from the same content
+    songid, location, etag = track
+    if not location.startswith('s3://'):
+        content_key = get_content_key_for_file(location)
+        if get_indexed_content_key(songid) == content_key:
+            return None
+        return location, False, content_key
+
+    content_key = get_content_key_for_etag(etag)
+    if get_indexed_content_key(songid) == content_key:
+        return None
+    bucket, _, key = location[len('s3://'):].partition('/')
+    # a file of its own, as tracks in different folders can share a name
+    fd, local_fname = tempfile.mkstemp(suffix=pathlib.PurePath(key).suffix, dir=tmp_dir)
+    os.close(fd)
+    get_s3_client().download_file(bucket, key, local_fname)
+    return local_fname, True, content_key
+
+
+def fingerprint_track(local_fname):
+    # runs in a worker process
+    return get_fingerprints(local_fname)
+
+
+def bulk_index(source, checkpoint_path='bulk_index_checkpoint.jsonl', workers=None, index_path=None):
+    """Indexes every music file under an S3 prefix or a local directory.
+
+    Downloads, fingerprinting and database inserts run as a pipeline: tracks are downloaded
+    on a few threads, fingerprinted on a process pool with one process per core, and stored on
+    a few more threads, with at most MAX_IN_FLIGHT tracks between the stages at any time.
+    Each stored track is appended to the checkpoint file, and tracks listed there are skipped,
+    so a rerun carries on where the last one stopped. Songs already indexed from the same
+    content are skipped too, and songs whose content has changed are replaced.
+
+    :param source: s3://bucket/prefix, or a path to a local directory.
+    :param checkpoint_path: File recording the tracks already indexed.
+    :param workers: Number of fingerprinting processes. Defaults to the number of cores.
+    :param index_path: Local index file to bring up to date once all tracks are stored, if any.
+    :returns: Dictionary with the number of tracks indexed, unchanged, failed and skipped.
+    """
+    workers = workers or os.cpu_count()
+    done = load_checkpoint(checkpoint_path)
+    tracks = []
+    skipped = 0
+    for track in list_tracks(source):
+        if track[1] in done:
+            skipped += 1
+        else:
+            tracks.append(track)
+    print(f'Indexing {len(tracks)} tracks from {source} on {workers} processes, '
+          f'skipping {skipped} already indexed')
+
+    start_time = perf_counter()
+    indexed = 0
+    unchanged = 0
+    failed = 0
+    remaining = iter(tracks)
+    downloading, fingerprinting, storing = {}, {}, {}
+
+    # fingerprinting processes are started fresh rather than forked, as they are started while
+    # the download and insert threads are running, and a fork could copy a lock one of them holds
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            open(checkpoint_path, 'a') as checkpoint, \
+            ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as downloads, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as fingerprints, \
+            ThreadPoolExecutor(max_workers=INSERT_WORKERS) as inserts:
+
+        def fill_pipeline():
+            while len(downloading) + len(fingerprinting) + len(storing) < MAX_IN_FLIGHT:
+                track = next(remaining, None)
+                if track is None:
+                    return
+                downloading[downloads.submit(fetch_track, track, tmp_dir)] = track
+
+        fill_pipeline()
+        while downloading or fingerprinting or storing:
+            finished, _ = wait([*downloading, *fingerprinting, *storing], return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future in downloading:
+                    track = downloading.pop(future)
+                    try:
+                        fetched = future.result()
+                    except Exception as e:
+                        print(f'Failed to download {track[1]}: {e}')
+                        failed += 1
+                        continue
+                    if fetched is None:
+                        _checkpoint(checkpoint, track, None)
+                        unchanged += 1
+                        continue
+                    local_fname, is_temporary, content_key = fetched
+                    fingerprinting[fingerprints.submit(fingerprint_track, local_fname)] = \
+                        (track, local_fname, is_temporary, content_key)
+
+                elif future in fingerprinting:
+                    track, local_fname, is_temporary, content_key = fingerprinting.pop(future)
+                    if is_temporary:
+                        os.remove(local_fname)
+                    try:
+                        file_fingerprints = future.result()
+                    except Exception as e:
+                        print(f'Failed to fingerprint {track[1]}: {e}')
+                        failed += 1
+                        continue
+                    storing[inserts.submit(store_fingerprints_to_db, track[0], file_fingerprints, content_key)] = \
+                        (track, len(file_fingerprints))
+
+                else:
+                    track, fingerprint_count = storing.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'Failed to store {track[1]}: {e}')
+                        failed += 1
+                        continue
+                    _checkpoint(checkpoint, track, fingerprint_count)
+                    indexed += 1
+                    if indexed % REPORT_EVERY == 0:
+                        _report(indexed, len(tracks), start_time)
+            fill_pipeline()
+
+    _report(indexed, len(tracks), start_time)
+    if unchanged:
+        print(f'{unchanged} tracks were already indexed from the same content')
+    if failed:
+        print(f'{failed} tracks failed - run again to retry them')
+    if index_path is not None:
+        # updated once per run, since each update rewrites the whole index file
+        update_index(index_path)
+    return {'indexed': indexed, 'unchanged': unchanged, 'failed': failed, 'skipped': skipped}
+
+
+def _checkpoint(checkpoint, track, fingerprint_count):
+    # fingerprint_count is None for tracks that didn't need indexing
+    checkpoint.write(json.dumps({
+        'songid': track[0], 'location': track[1], 'fingerprints': fingerprint_count
+    }) + '\n')
+    checkpoint.flush()
+
+
+def _report(indexed, total, start_time):
+    minutes = (perf_counter() - start_time) / 60
+    rate = indexed / minutes if minutes > 0 else 0.0
+    print(f'{indexed} of {total} tracks indexed in {minutes:.1f} minutes ({rate:.1f} tracks/minute)')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Index every music file under an S3 prefix or local directory')
+    parser.add_argument('source', help='s3://bucket/prefix or a local directory')
+    parser.add_argument('--checkpoint', default='bulk_index_checkpoint.jsonl',
+                        help='file recording the tracks already indexed')
+    parser.add_argument('--workers', type=int, help='number of fingerprinting processes')
+    parser.add_argument('--index', help='local index file to update once the tracks are stored')
+    args = parser.parse_args()
+    bulk_index(args.source, checkpoint_path=args.checkpoint, workers=args.workers, index_path=args.index)
@@ -16,12 +16,21 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 import pathlib
 import json
-from db_utils import create_tables_if_needed, get_db_matches_for_fingerprints
-from s3_utils import download_from_s3_to_local, send_text_to_s3
-from fingerprinting import get_fingerprints
+from concurrent.futures import ThreadPoolExecutor
+from fingerprint_index import get_matches_for_fingerprints, get_matches_for_fingerprint_sets
+from s3_utils import get_s3_client, send_text_to_s3
+from fingerprint_cache import get_fingerprints_for_s3_object_cached
 from matching import get_best_match
+from progressive_matching import identify_s3_object_progressively
 from validation_utils import is_music_file
 
+# files fingerprinted at once, and reports written at once, when checking a batch of files
+FINGERPRINT_WORKERS = 4
+REPORT_WORKERS = 16
+# when True, files are identified a few seconds at a time, stopping once the match is clear
+# (see progressive_matching.py)
+USE_PROGRESSIVE_MATCHING = False
+
 
 def identify_song_in_file(bucket, key):
     # used for checking individual files dropped into the S3 folder.
@@ -33,19 +42,58 @@ def identify_song_in_file(bucket, key):
         print(f'Skipping {key} as it is not a music file')
         return
 
-    local_fname = download_from_s3_to_local(bucket, key)
-
-    create_tables_if_needed()
+    if USE_PROGRESSIVE_MATCHING:
+        best_match_song_id, score, seconds, complete = identify_s3_object_progressively(bucket, key)
+        print(f'Best match for {key} is {best_match_song_id} with score {score}, '
+              f'from {seconds:.1f} seconds of audio')
+        # record how much of the file was needed
+        write_report(bucket, key, best_match_song_id, score,
+                     {"audio_seconds": round(seconds, 3), "complete": complete})
+        return
 
-    fingerprints = get_fingerprints(local_fname)
-    matches = get_db_matches_for_fingerprints(fingerprints)
+    fingerprints = get_fingerprints_for_s3_object_cached(bucket, key)
+    matches = get_matches_for_fingerprints(fingerprints)
     best_match_song_id, score = get_best_match(matches)
 
     print(f'Best match for {key} is {best_match_song_id} with score {score}')
+    write_report(bucket, key, best_match_song_id, score)
+
+
+def identify_songs_in_files(bucket, keys):
+    # checks many files together. The files are fingerprinted in parallel and their
+    # hashes looked up in one go, so a hash shared by several files is only fetched
+    # once. Each file still gets the same result and report as identify_song_in_file
+    keys = [key for key in keys if is_music_file(key)]
+    if len(keys) == 0:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=FINGERPRINT_WORKERS) as executor:
+        fingerprint_sets = list(executor.map(lambda key: get_fingerprints_for_s3_object_cached(bucket, key), keys))
+
+    results = {}
+    for key, matches in zip(keys, get_matches_for_fingerprint_sets(fingerprint_sets)):
+        results[key] = get_best_match(matches)
+        print(f'Best match for {key} is {results[key][0]} with score {results[key][1]}')
 
+    with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as executor:
+        # list() so any failed upload is raised here
+        list(executor.map(lambda key: write_report(bucket, key, *results[key]), keys))
+    return results
+
+
+def identify_songs_under_prefix(bucket, prefix):
+    # checks every file under a folder of the bucket as one batch
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    keys = [obj['Key'] for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for obj in page.get('Contents', [])]
+    return identify_songs_in_files(bucket, keys)
+
+
+def write_report(bucket, key, song, score, details=None):
     report_data = json.dumps({
-        "song": best_match_song_id,
-        "score": int(score)
+        "song": song,
+        "score": int(score),
+        **(details or {})
         })
 
     # create a report and upload to S3
@@ -55,3 +103,12 @@ def identify_song_in_file(bucket, key):
     report_name = f'{folder}/{songid}.json'
     print(f'Writing report {report_name} to {bucket}')
     send_text_to_s3(bucket, report_name, report_data)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Check every file under an S3 folder for known songs')
+    parser.add_argument('bucket')
+    parser.add_argument('prefix', help='folder to check, e.g. songs_to_check/')
+    args = parser.parse_args()
+    identify_songs_under_prefix(args.bucket, args.prefix)
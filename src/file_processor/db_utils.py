@@ -14,148 +14,672 @@ COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
-from boto3.session import Session
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, monotonic
 import os
-from collections import defaultdict
+import json
+import uuid
+import threading
+import numpy as np
+from fingerprinting_config import FINGERPRINT_FORMAT
+from matching import Matches, match_postings
+from metrics import stage, count
+from storage import FingerprintStorage, get_storage
+
+
+# Fingerprints are stored in PostgreSQL by default, through the RDS Data API. The storage
+# backend is chosen by configuration (see storage.py), and the functions at the end of this
+# module work with whichever one is configured.
+
+# the Data API client is created on first use (see get_rds_data_client), so importing this
+# module stays cheap and doesn't need the database settings
+rds_data = None
+_rds_data_lock = threading.Lock()
+DBClusterArn = os.environ.get('DBClusterArn')
+DBName = os.environ.get('DBName')
+SecretArn = os.environ.get('SecretArn')
+
+# rows per batched INSERT - keeps each array parameter comfortably under 64KB
+INSERT_BATCH_ROWS = 2500
+# number of INSERT batches sent to the Data API at once
+INSERT_WORKERS = 8
+# hashes per SELECT batch, and rows per page of results - the Data API
+# rejects any result larger than 1MB, so large results are fetched in pages
+SELECT_BATCH_HASHES = 2000
+SELECT_PAGE_ROWS = 5000
+# number of SELECT batches sent to the Data API at once
+SELECT_WORKERS = 8
+# hashes found in more than this fraction of the catalogue's songs (and in at least
+# STOP_HASH_MIN_SONGS songs) are "stop hashes", and are left out of lookups
+STOP_HASH_MAX_FRACTION = 0.05
+STOP_HASH_MIN_SONGS = 20
+# how often each container reloads the set of stop hashes
+STOP_HASH_REFRESH_SECONDS = 300
+# how often each container checks whether the old fingerprints table still has rows, which
+# lookups read alongside song_fingerprints until migrate_fingerprints.py has moved them all
+LEGACY_CHECK_SECONDS = 300
+
+
+# Schema migrations, applied in order. The schema version is the number of migrations applied,
+# recorded in the schema_migrations table. Never edit a migration once released - add a new one.
+SCHEMA_MIGRATIONS = [
+    # 1: fingerprints, stream state and the fingerprint staging table
+    [
+        "CREATE TABLE IF NOT EXISTS fingerprints "
+        "(id SERIAL PRIMARY KEY, songid VARCHAR(128), hash bigint, timestep INT);",
+        "CREATE INDEX IF NOT EXISTS hash_index on fingerprints (hash);",
+        "CREATE TABLE IF NOT EXISTS streams "
+        "(streamid VARCHAR(128) PRIMARY KEY, songid VARCHAR(128));",
+        "CREATE INDEX IF NOT EXISTS stream_index on streams (streamid);",
+        # fingerprints are written here first, then moved into the fingerprints table in one statement
+        "CREATE UNLOGGED TABLE IF NOT EXISTS fingerprint_staging "
+        "(ingestid VARCHAR(64), songid VARCHAR(128), hash bigint, timestep INT);",
+        "CREATE INDEX IF NOT EXISTS staging_ingest_index on fingerprint_staging (ingestid);",
+    ],
+    # 2: record the fingerprint format of every row, so formats can coexist while re-indexing.
+    # existing rows are all format 1
+    [
+        "ALTER TABLE fingerprints ADD COLUMN IF NOT EXISTS version SMALLINT NOT NULL DEFAULT 1;",
+        "ALTER TABLE fingerprint_staging ADD COLUMN IF NOT EXISTS version SMALLINT NOT NULL DEFAULT 1;",
+    ],
+    # 3: document frequency of each hash, and the number of songs indexed, for pruning stop
+    # hashes. Kept up to date as songs are stored; use rebuild_hash_stats() to fill them in for
+    # songs indexed before this migration
+    [
+        "CREATE TABLE IF NOT EXISTS hash_stats "
+        "(version SMALLINT, hash bigint, songs INT, rowcount INT, PRIMARY KEY (version, hash));",
+        "CREATE INDEX IF NOT EXISTS hash_stats_songs_index on hash_stats (version, songs);",
+        "CREATE TABLE IF NOT EXISTS catalogue_stats (version SMALLINT PRIMARY KEY, songs INT);",
+    ],
+    # 4: the content each song was last indexed from, so re-indexing unchanged content can be
+    # skipped. The index on the fingerprints table used to replace a song's old rows is built
+    # by migrate_fingerprints.py instead, as building it here could take far longer than a request
+    [
+        "CREATE TABLE IF NOT EXISTS indexed_songs (songid VARCHAR(128), version SMALLINT, "
+        "content_key VARCHAR(256), indexed_at TIMESTAMP DEFAULT now(), PRIMARY KEY (songid, version));",
+    ],
+    # 5: compact storage. The songs catalogue gives each (songid, version) a 4-byte id, and
+    # song_fingerprints holds just (hash, song, timestep) per row. Lookups are index-only scans
+    # of the covering index, and the BRIN index (tiny, as a song's rows are written together)
+    # finds a song's rows to replace them. revision is bumped whenever a song's rows change,
+    # for incremental exports. Existing fingerprints rows are moved across by
+    # migrate_fingerprints.py, and are read alongside the new table until then
+    [
+        "CREATE SEQUENCE IF NOT EXISTS song_revisions;",
+        "CREATE TABLE IF NOT EXISTS songs (id SERIAL PRIMARY KEY, songid VARCHAR(128) NOT NULL, "
+        "version SMALLINT NOT NULL, content_key VARCHAR(256), indexed_at TIMESTAMP DEFAULT now(), "
+        "revision BIGINT NOT NULL DEFAULT nextval('song_revisions'), UNIQUE (songid, version));",
+        "CREATE INDEX IF NOT EXISTS songs_revision_index on songs (version, revision);",
+        "CREATE TABLE IF NOT EXISTS song_fingerprints "
+        "(hash bigint NOT NULL, song INT NOT NULL, timestep INT NOT NULL);",
+        "CREATE INDEX IF NOT EXISTS song_fingerprints_lookup_index on song_fingerprints (hash, song, timestep);",
+        "CREATE INDEX IF NOT EXISTS song_fingerprints_song_index on song_fingerprints USING brin (song);",
+        "INSERT INTO songs (songid, version, content_key, indexed_at) "
+        "SELECT songid, version, content_key, indexed_at FROM indexed_songs ON CONFLICT DO NOTHING;",
+        "DROP TABLE IF EXISTS indexed_songs;",
+    ],
+]
+
+# arbitrary key for the advisory lock that serializes migrations across containers
+SCHEMA_LOCK_ID = 72310551
+
+
+class PostgresStorage(FingerprintStorage):
+    """Fingerprint storage in PostgreSQL: the schema, SQL and per-container caches shared by the
+    Data API and direct connection backends. Subclasses supply :meth:`execute` and transactions.
+    """
+
+    def __init__(self):
+        # set once this container has checked the schema is up to date
+        self._schema_version = None
+        self._schema_lock = threading.Lock()
+        self._stop_hashes = {}
+        self._stop_hashes_expiry = 0
+        # song names by songs table id. Ids are never reused, so entries never go stale
+        self._song_names = {}
+        self._legacy_rows = True
+        self._legacy_rows_expiry = 0
+
+    def execute(self, sql, parameters=None, transaction_id=None, compact=False, continue_after_timeout=False):
+        """Runs a statement with named (:name) parameters, returning its rows as tuples.
+
+        :param compact: Fetch the result in the most compact form the transport offers, for
+            statements returning a few large values such as arrays.
+        :param continue_after_timeout: Leave the statement running if the transport stops
+            waiting for it, for long DDL run outside a transaction.
+        """
+        raise NotImplementedError
+
+    def begin_transaction(self):
+        raise NotImplementedError
+
+    def commit_transaction(self, transaction_id):
+        raise NotImplementedError
+
+    def rollback_transaction(self, transaction_id):
+        raise NotImplementedError
+
+    def ensure_schema(self):
+        # checks (and if needed migrates) the schema once per container. After that this
+        # returns straight away, so hot paths can call it without any database round trips
+        if self._schema_version == len(SCHEMA_MIGRATIONS):
+            return
+
+        # threads wait for the first one to finish checking
+        with self._schema_lock:
+            if self._schema_version == len(SCHEMA_MIGRATIONS):
+                return
+            version = self.get_schema_version()
+            if version < len(SCHEMA_MIGRATIONS):
+                version = self.migrate_schema()
+            self._schema_version = version
+
+    def get_schema_version(self, transaction_id=None):
+        # 0 if the schema_migrations table doesn't exist yet
+        rows = self.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;", transaction_id=transaction_id)
+        if not rows[0][0]:
+            return 0
+        rows = self.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations;",
+                            transaction_id=transaction_id)
+        return rows[0][0]
+
+    def migrate_schema(self):
+        # applies any outstanding migrations, each in its own transaction. The advisory lock
+        # means only one container migrates at a time; the others wait, then find nothing to do
+        while True:
+            transaction_id = self.begin_transaction()
+            try:
+                self.execute(f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_ID});", transaction_id=transaction_id)
+                # created under the lock, as concurrent CREATE TABLE IF NOT EXISTS can fail
+                self.execute("CREATE TABLE IF NOT EXISTS schema_migrations "
+                             "(version INT PRIMARY KEY, applied_at TIMESTAMP DEFAULT now());",
+                             transaction_id=transaction_id)
+                version = self.get_schema_version(transaction_id)
+                if version >= len(SCHEMA_MIGRATIONS):
+                    self.commit_transaction(transaction_id)
+                    return version
+                for cmd in SCHEMA_MIGRATIONS[version]:
+                    self.execute(cmd, transaction_id=transaction_id)
+                self.execute("INSERT INTO schema_migrations (version) VALUES (:version);",
+                             {'version': version + 1}, transaction_id=transaction_id)
+                self.commit_transaction(transaction_id)
+                print(f'Migrated schema to version {version + 1}')
+                if version + 1 == len(SCHEMA_MIGRATIONS):
+                    return version + 1
+            except Exception:
+                self.rollback_transaction(transaction_id)
+                raise
+
+    def store_fingerprints(self, songid, hashes, timesteps, content_key=None):
+        # each batch passes its hashes and timesteps as two array parameters, and the batches
+        # are sent concurrently into a staging table under an ID for this ingest. One final
+        # statement then moves them all into the song_fingerprints table, replacing any the
+        # song already had, so a failure part way through never leaves a half-written song,
+        # and re-indexing a song never leaves duplicate rows behind
+        self.ensure_schema()
+        ingestid = uuid.uuid4().hex
+        batches = [
+            {
+                'ingestid': ingestid,
+                'songid': songid,
+                'version': FINGERPRINT_FORMAT,
+                'hashes': sql_array(hashes[i:i + INSERT_BATCH_ROWS].tolist()),
+                'timesteps': sql_array(timesteps[i:i + INSERT_BATCH_ROWS].tolist()),
+            }
+            for i in range(0, len(hashes), INSERT_BATCH_ROWS)
+        ]
+        sql = "INSERT INTO fingerprint_staging (ingestid, songid, version, hash, timestep) " \
+              "SELECT :ingestid, :songid, :version, " \
+              "unnest(CAST(:hashes AS bigint[])), unnest(CAST(:timesteps AS numeric[]));"
+
+        count('InsertBatches', len(batches))
+        try:
+            with stage('Store'), ThreadPoolExecutor(max_workers=INSERT_WORKERS) as executor:
+                list(executor.map(lambda params: self.execute(sql, params), batches))
+
+            # the same statement updates the hash statistics by the difference between the old
+            # and new rows, so they always agree with the fingerprints. Stats rows are locked in
+            # hash order, to avoid deadlocks between songs. Old rows are also removed from the
+            # fingerprints table, in case the song hasn't been migrated yet
+            sql = "WITH song AS (INSERT INTO songs (songid, version, content_key) " \
+                  "VALUES (:songid, :version, :contentkey) ON CONFLICT (songid, version) " \
+                  "DO UPDATE SET content_key = EXCLUDED.content_key, indexed_at = now(), " \
+                  "revision = nextval('song_revisions') RETURNING id), " \
+                  "moved AS (DELETE FROM fingerprint_staging WHERE ingestid = :ingestid " \
+                  "RETURNING hash, timestep), " \
+                  "removed AS (DELETE FROM song_fingerprints WHERE song = (SELECT id FROM song) " \
+                  "RETURNING hash), " \
+                  "removed_legacy AS (DELETE FROM fingerprints WHERE songid = :songid AND version = :version " \
+                  "RETURNING hash), " \
+                  "stored AS (INSERT INTO song_fingerprints (hash, song, timestep) " \
+                  "SELECT hash, (SELECT id FROM song), timestep FROM moved), " \
+                  "delta AS (SELECT hash, SUM(songs) AS songs, SUM(rowcount) AS rowcount FROM (" \
+                  "SELECT hash, 1 AS songs, COUNT(*) AS rowcount FROM moved GROUP BY hash " \
+                  "UNION ALL SELECT hash, -1, -COUNT(*) FROM (SELECT hash FROM removed " \
+                  "UNION ALL SELECT hash FROM removed_legacy) AS old GROUP BY hash) AS changes " \
+                  "GROUP BY hash), " \
+                  "counted AS (INSERT INTO hash_stats (version, hash, songs, rowcount) " \
+                  "SELECT :version, hash, songs, rowcount FROM delta ORDER BY hash " \
+                  "ON CONFLICT (version, hash) DO UPDATE SET songs = hash_stats.songs + EXCLUDED.songs, " \
+                  "rowcount = hash_stats.rowcount + EXCLUDED.rowcount) " \
+                  "INSERT INTO catalogue_stats (version, songs) " \
+                  "SELECT :version, CASE WHEN EXISTS (SELECT 1 FROM removed) " \
+                  "OR EXISTS (SELECT 1 FROM removed_legacy) THEN 0 ELSE 1 END " \
+                  "ON CONFLICT (version) DO UPDATE SET songs = catalogue_stats.songs + EXCLUDED.songs;"
+            with stage('Publish'):
+                self.execute(sql, {'ingestid': ingestid, 'songid': songid, 'version': FINGERPRINT_FORMAT,
+                                   'contentkey': content_key})
+        except Exception:
+            self.execute("DELETE FROM fingerprint_staging WHERE ingestid = :ingestid;", {'ingestid': ingestid})
+            raise
+        return len(batches)
+
+    def get_indexed_content_key(self, songid):
+        self.ensure_schema()
+        sql = "SELECT content_key FROM songs WHERE songid = :songid AND version = :version;"
+        rows = self.execute(sql, {'songid': songid, 'version': FINGERPRINT_FORMAT})
+        return rows[0][0] if len(rows) > 0 else None
+
+    def get_stop_hashes(self):
+        # loaded once per STOP_HASH_REFRESH_SECONDS per container, since they change slowly
+        # as songs are added
+        if monotonic() < self._stop_hashes_expiry:
+            return self._stop_hashes
+
+        sql = "SELECT hash, rowcount FROM hash_stats WHERE version = :version AND songs >= :minsongs " \
+              "AND songs > :maxfraction * (SELECT songs FROM catalogue_stats WHERE version = :version);"
+        parameters = {
+            'version': FINGERPRINT_FORMAT,
+            'minsongs': STOP_HASH_MIN_SONGS,
+            'maxfraction': STOP_HASH_MAX_FRACTION,
+        }
+        self._stop_hashes = dict(self.execute(sql, parameters))
+        self._stop_hashes_expiry = monotonic() + STOP_HASH_REFRESH_SECONDS
+        print(f'Loaded {len(self._stop_hashes)} stop hashes')
+        return self._stop_hashes
+
+    def rebuild_hash_stats(self):
+        # recalculates the hash statistics from the fingerprint tables. This is a heavy query
+        # over every row, meant to be run by hand (e.g. after upgrading an existing database)
+        self.ensure_schema()
+        rows = "SELECT s.version, f.hash, s.songid FROM song_fingerprints f JOIN songs s ON s.id = f.song " \
+               "UNION ALL SELECT version, hash, songid FROM fingerprints"
+        transaction_id = self.begin_transaction()
+        try:
+            self.execute("DELETE FROM hash_stats;", transaction_id=transaction_id)
+            self.execute("DELETE FROM catalogue_stats;", transaction_id=transaction_id)
+            self.execute("INSERT INTO hash_stats (version, hash, songs, rowcount) "
+                         "SELECT version, hash, COUNT(DISTINCT songid), COUNT(*) "
+                         f"FROM ({rows}) AS all_rows GROUP BY version, hash;", transaction_id=transaction_id)
+            self.execute("INSERT INTO catalogue_stats (version, songs) "
+                         f"SELECT version, COUNT(DISTINCT songid) FROM ({rows}) AS all_rows GROUP BY version;",
+                         transaction_id=transaction_id)
+            self.commit_transaction(transaction_id)
+        except Exception:
+            self.rollback_transaction(transaction_id)
+            raise
+
+    def select_fingerprints_for_hashes(self, hashes):
+        # identical rows are grouped, which also makes (hash, song, timestep) unique, so it
+        # serves as the key to carry on from between pages
+        sql = _page_sql("SELECT hash, song, timestep, COUNT(*) AS n FROM song_fingerprints "
+                        "WHERE hash = ANY(CAST(:hashes AS bigint[])) "
+                        "AND song IN (SELECT id FROM songs WHERE version = :version) "
+                        "AND (hash, song, timestep) > (:lasthash, :lastsong, :laststep) "
+                        "GROUP BY hash, song, timestep", 'song')
+        found, songs, timesteps, counts = self._select_pages(sql, hashes, 0)
+        catalogue_ids, song_idxs = np.unique(songs, return_inverse=True)
+        names = self.get_song_names(catalogue_ids.tolist())
+        song_ids = [names[song] for song in catalogue_ids.tolist()]
+
+        if self.has_legacy_rows():
+            # rows not yet moved out of the old table, which carry the song name themselves
+            sql = _page_sql("SELECT hash, songid, timestep, COUNT(*) AS n FROM fingerprints "
+                            "WHERE hash = ANY(CAST(:hashes AS bigint[])) AND version = :version "
+                            "AND (hash, songid, timestep) > (:lasthash, :lastsong, :laststep) "
+                            "GROUP BY hash, songid, timestep", 'songid')
+            legacy_found, legacy_songs, legacy_timesteps, legacy_counts = self._select_pages(sql, hashes, '')
+            legacy_ids, legacy_idxs = np.unique(legacy_songs, return_inverse=True)
+            found = np.concatenate((found, legacy_found))
+            order = np.argsort(found, kind='stable')
+            found = found[order]
+            song_idxs = np.concatenate((song_idxs, legacy_idxs + len(song_ids)))[order]
+            timesteps = np.concatenate((timesteps, legacy_timesteps))[order]
+            counts = np.concatenate((counts, legacy_counts))[order]
+            song_ids += legacy_ids.tolist()
+        return song_ids, found, song_idxs, timesteps, counts
+
+    def _select_pages(self, sql, hashes, first_song):
+        parameters = {
+            'hashes': sql_array(hashes.tolist()),
+            'version': FINGERPRINT_FORMAT,
+            'lasthash': np.iinfo(np.int64).min,
+            'lastsong': first_song,
+            'laststep': np.iinfo(np.int32).min,
+        }
+        pages = []
+        while True:
+            page = self.execute(sql, parameters, compact=True)[0]
+            if page[0] is None:
+                break
+            pages.append(page)
+            if len(page[0]) < SELECT_PAGE_ROWS:
+                break
+            parameters['lasthash'], parameters['lastsong'], parameters['laststep'] = (column[-1] for column in page[:3])
+
+        if len(pages) == 0:
+            return (np.empty(0, dtype=np.int64),) * 4
+        return (
+            np.concatenate([np.array(page[0], dtype=np.int64) for page in pages]),
+            np.concatenate([np.array(page[1]) for page in pages]),
+            np.concatenate([np.array(page[2], dtype=np.int64) for page in pages]),
+            np.concatenate([np.array(page[3], dtype=np.int64) for page in pages]),
+        )
+
+    def get_song_names(self, song_ids):
+        # maps songs table ids to song names, fetching only those this container hasn't seen yet
+        missing = [song for song in song_ids if song not in self._song_names]
+        if missing:
+            sql = "SELECT id, songid FROM songs WHERE id = ANY(CAST(:ids AS int[]));"
+            self._song_names.update(self.execute(sql, {'ids': sql_array(missing)}))
+        return self._song_names
+
+    def has_legacy_rows(self):
+        # whether the old fingerprints table still has rows to read, checked once per
+        # LEGACY_CHECK_SECONDS per container. Rows are only ever moved out of it
+        if not self._legacy_rows or monotonic() < self._legacy_rows_expiry:
+            return self._legacy_rows
+
+        self._legacy_rows = self.execute("SELECT to_regclass('fingerprints') IS NOT NULL;")[0][0]
+        if self._legacy_rows:
+            self._legacy_rows = self.execute("SELECT EXISTS (SELECT 1 FROM fingerprints);")[0][0]
+        self._legacy_rows_expiry = monotonic() + LEGACY_CHECK_SECONDS
+        return self._legacy_rows
+
+    def get_last_song_for_stream(self, streamid):
+        # make sure we have a table to select from
+        self.ensure_schema()
+        rows = self.execute("SELECT songid FROM streams WHERE streamid = :streamid;", {'streamid': streamid})
+        return rows[0][0] if len(rows) > 0 else None
+
+    def store_song_for_stream(self, streamid, songid):
+        # make sure we have a table to select from
+        self.ensure_schema()
+
+        # only writes if the song differs from the one stored, and returns a row only if it
+        # wrote. concurrent callers storing the same change are serialized on the row, so
+        # exactly one of them sees it as a change
+        sql = "INSERT INTO streams (streamid, songid) VALUES (:streamid, :songid) " \
+              "ON CONFLICT (streamid) DO UPDATE SET songid = EXCLUDED.songid " \
+              "WHERE streams.songid IS DISTINCT FROM EXCLUDED.songid RETURNING songid;"
+        return len(self.execute(sql, {'streamid': streamid, 'songid': songid})) > 0
+
+
+def _page_sql(rows_sql, song):
+    # a page of rows, returned as one row of column arrays. Decoding a few arrays is far
+    # quicker than a row at a time
+    key = f"hash, {song}, timestep"
+    return f"SELECT array_agg(hash ORDER BY {key}) AS hashes, array_agg({song} ORDER BY {key}) AS songs, " \
+           f"array_agg(timestep ORDER BY {key}) AS timesteps, array_agg(n ORDER BY {key}) AS counts " \
+           f"FROM ({rows_sql} ORDER BY {key} LIMIT {SELECT_PAGE_ROWS}) AS page;"
+
+
+class DataApiStorage(PostgresStorage):
+    """PostgreSQL through the RDS Data API - no connections to manage, but an HTTPS request
+    per statement. Compact results are requested as JSON, which is much smaller than the
+    Data API's typed records.
+
+    :param client: RDS Data API client. By default one is created on first use.
+    :param cluster_arn: ARN of the Aurora cluster, by default from DBClusterArn.
+    :param secret_arn: ARN of the database secret, by default from SecretArn.
+    :param database: Database name, by default from DBName.
+    """
+
+    def __init__(self, client=None, cluster_arn=None, secret_arn=None, database=None):
+        super().__init__()
+        self._client = client
+        self.cluster_arn = cluster_arn or DBClusterArn
+        self.secret_arn = secret_arn or SecretArn
+        self.database = database or DBName
+
+    def client(self):
+        if self._client is None:
+            for name, value in (('DBClusterArn', self.cluster_arn), ('DBName', self.database),
+                                ('SecretArn', self.secret_arn)):
+                if value is None:
+                    raise KeyError(f'{name} environment variable is not set')
+            self._client = get_rds_data_client()
+        return self._client
+
+    def execute(self, sql, parameters=None, transaction_id=None, compact=False, continue_after_timeout=False):
+        # Use the Data API ExecuteStatement operation to run the SQL command
+        kwargs = {}
+        if transaction_id is not None:
+            kwargs['transactionId'] = transaction_id
+        if compact:
+            kwargs['formatRecordsAs'] = 'JSON'
+        if continue_after_timeout:
+            # the call still fails after 45 seconds, but the statement carries on
+            kwargs['continueAfterTimeout'] = True
+        if parameters:
+            kwargs['parameters'] = [
+                {'name': name, 'value': _sql_value(value)} for name, value in parameters.items()
+            ]
+        result = self.client().execute_statement(
+            resourceArn=self.cluster_arn,
+            secretArn=self.secret_arn,
+            database=self.database,
+            sql=sql,
+            **kwargs
+        )
+        if compact:
+            return [tuple(row.values()) for row in json.loads(result['formattedRecords'])]
+        return [tuple(_field_value(field) for field in row) for row in result.get('records', [])]
+
+    def begin_transaction(self):
+        result = self.client().begin_transaction(resourceArn=self.cluster_arn, secretArn=self.secret_arn,
+                                                 database=self.database)
+        return result['transactionId']
+
+    def commit_transaction(self, transaction_id):
+        self.client().commit_transaction(resourceArn=self.cluster_arn, secretArn=self.secret_arn,
+                                         transactionId=transaction_id)
+
+    def rollback_transaction(self, transaction_id):
+        self.client().rollback_transaction(resourceArn=self.cluster_arn, secretArn=self.secret_arn,
+                                           transactionId=transaction_id)
+
+
+def get_rds_data_client():
+    global rds_data
+    if rds_data is None:
+        # the first calls come from the INSERT and SELECT worker threads, so creation is locked
+        with _rds_data_lock:
+            if rds_data is None:
+                from boto3.session import Session
+                rds_data = Session().client(service_name='rds-data')
+    return rds_data
+
+
+def _sql_value(value):
+    if value is None:
+        return {'isNull': True}
+    if isinstance(value, str):
+        return {'stringValue': value}
+    if isinstance(value, (int, np.integer)):
+        return {'longValue': int(value)}
+    return {'doubleValue': float(value)}
+
+
+def _field_value(field):
+    # the Python value of a Data API result field, e.g. {'longValue': 5} -> 5
+    if field.get('isNull'):
+        return None
+    if 'arrayValue' in field:
+        return next(iter(field['arrayValue'].values()), [])
+    return next(iter(field.values()))
 
 
-session = Session()
-rds_data = session.client(service_name='rds-data')
-DBClusterArn = os.environ['DBClusterArn']
-DBName = os.environ['DBName']
-SecretArn = os.environ['SecretArn']
+def sql_array(values):
+    # Postgres array literal, passed as a string parameter and CAST in the SQL
+    return '{' + ','.join(map(str, values)) + '}'
 
 
-def create_tables_if_needed():
-    cmd = "CREATE TABLE IF NOT EXISTS fingerprints " \
-        "(id SERIAL PRIMARY KEY, songid VARCHAR(128), hash bigint, timestep INT);"
-    run_command(cmd)
+# The functions below are what the rest of the application uses. Each works with the
+# configured storage backend.
 
-    cmd = "CREATE INDEX IF NOT EXISTS hash_index on fingerprints (hash);"
-    run_command(cmd)
+def ensure_schema():
+    get_storage().ensure_schema()
 
-    cmd = "CREATE TABLE IF NOT EXISTS streams " \
-        "(streamid VARCHAR(128) PRIMARY KEY, songid VARCHAR(128));"
-    run_command(cmd)
 
-    cmd = "CREATE INDEX IF NOT EXISTS stream_index on streams (streamid);"
-    run_command(cmd)
+def run_command(sql_statement, parameters=None, transaction_id=None, continue_after_timeout=False):
+    # runs a SQL statement on the configured PostgreSQL backend, returning its rows as tuples.
+    # For tools that work on the PostgreSQL tables directly
+    return _get_postgres_storage().execute(sql_statement, parameters, transaction_id=transaction_id,
+                                           continue_after_timeout=continue_after_timeout)
 
 
-def run_command(sql_statement):
-    # Use the Data API ExecuteStatement operation to run the SQL command
-    result = rds_data.execute_statement(
-        resourceArn=DBClusterArn,
-        secretArn=SecretArn,
-        database=DBName,
-        sql=sql_statement
-    )
-    return result
-
-
-def store_fingerprints_to_db(songid, file_fingerprints):
-    # need a table to store them
-    create_tables_if_needed()
-
-    # a song might have 25,000 fingerprints, so we need to be careful about the string length
-    # therefore, we batch these inserts into SQL commands roughly 64KB long (the max allowed)
-    vals = []
-    batches_done = 0
-    for hash, timeindex in file_fingerprints:
-        vals.append(f"('{songid}', {hash}, {timeindex})")
-        joined_string = ','.join(vals)
-        if len(joined_string) >= 64000:
-            sql = f"INSERT INTO fingerprints (songid, hash, timestep) VALUES {joined_string};"
-            # print(f'SQL command to insert fingerprints is {len(sql)} chars long')
-            # print(f'Initial chars: {sql[0:300]}')
-            run_command(sql)
-            vals = []
-            batches_done += 1
-
-    # get any of the leftovers
-    if len(vals) > 0:
-        sql = f"INSERT INTO fingerprints (songid, hash, timestep) VALUES {','.join(vals)};"
-        print(f'Final SQL command to insert fingerprints is {len(sql)} chars long')
-        run_command(sql)
-        batches_done += 1
-    print(f'{batches_done} INSERTs issued')
-
-
-def get_db_matches_for_fingerprints(fingerprints):
-    # make sure we have a table to select from
-    create_tables_if_needed()
-
-    # first, retrieve all matching hashes
-    prefix = "SELECT songid, hash, timestep FROM fingerprints WHERE hash in "
-    # we need to break this into possibly multiple selects, in order to keep the total length
-    # of the query less than 64K
-    result_rows = []
-    hashes_for_select = []
-    batches_done = 0
-
-    hashes_to_find = [h for h, _ in fingerprints]
-    # get rid of dupes
-    hashes_to_find = list(set(hashes_to_find))
-    print(f'Searching in DB for matching for {len(hashes_to_find)} fingerprints')
-
-    for hash in hashes_to_find:
-
-        hashes_for_select.append(str(hash))
-        sql = f"{prefix} ({','.join(hashes_for_select)});"
-        if len(sql) >= 64000:
-            print(f'SQL command to get matches is {len(sql)} chars long, starting chars: {sql[0:300]}')
-            result = run_command(sql)
-            result_rows.extend(result['records'])
-            print(f'{len(result_rows)} rows of results so far ')
-
-            hashes_for_select = []
-            batches_done += 1
-
-    # get any of the leftovers once we drop out of the loop
-    if len(hashes_for_select) > 0:
-        sql = f"{prefix} ({','.join(hashes_for_select)});"
-        print(f'SQL command to get matches is {len(sql)} chars long, starting chars: {sql[0:300]}')
-        result = run_command(sql)
-        result_rows.extend(result['records'])
-        print(f'{len(result_rows)} rows of results so far ')
-        batches_done += 1
-
-    # finish any leftovers
-    print(f'{batches_done} SELECTs issued, {len(result_rows)} total rows returned')
-
-    # now refactor the results into a list we can use
-    # the first step is to map the fingerprints we are searching for to their timesteps
-    timesteps_by_hash = {}
-    for h, t in fingerprints:
-        timesteps_by_hash[h] = t
-
-    # and then use that mapping as part of the returned data
-    results = defaultdict(list)
-    for row in result_rows:
-        songid = row[0]['stringValue']
-        search_for_hash = row[1]['longValue']
-        timestep = row[2]['longValue']
-        results[songid].append((timestep, timesteps_by_hash[search_for_hash]))
+def has_legacy_rows():
+    # whether the old fingerprints table still has rows for migrate_fingerprints.py to move
+    return _get_postgres_storage().has_legacy_rows()
 
-    return results
 
+def _get_postgres_storage():
+    storage = get_storage()
+    if not isinstance(storage, PostgresStorage):
+        raise TypeError(f'{type(storage).__name__} does not run SQL statements; this needs a PostgreSQL backend')
+    return storage
 
-def get_last_song_for_stream_from_db(streamid):
-    # make sure we have a table to select from
-    create_tables_if_needed()
 
-    sql = f"SELECT songid FROM streams WHERE streamid = '{streamid}';"
-    result = run_command(sql)
-    if len(result['records']) == 0:
-        return None
-    else:
-        return result['records'][0][0]['stringValue']
+def store_fingerprints_to_db(songid, file_fingerprints, content_key=None):
+    # a song might have 25,000 fingerprints. They replace any the song already had, as one
+    # change. content_key (see fingerprint_cache.py) is recorded so unchanged content can be
+    # skipped
+    start_time = perf_counter()
+    hashes = np.fromiter((h for h, _ in file_fingerprints), dtype=np.int64, count=len(file_fingerprints))
+    timesteps = np.fromiter((t for _, t in file_fingerprints), dtype=np.float64, count=len(file_fingerprints))
+    count('RowsInserted', len(hashes))
+    batches = get_storage().store_fingerprints(songid, hashes, timesteps, content_key=content_key)
 
+    elapsed = perf_counter() - start_time
+    rows_per_sec = len(hashes) / elapsed if elapsed > 0 else 0.0
+    return {'rows': len(hashes), 'batches': batches, 'seconds': elapsed, 'rows_per_sec': rows_per_sec}
+
+
+def get_indexed_content_key(songid):
+    # the content key the song was last indexed from in the current format, or None
+    return get_storage().get_indexed_content_key(songid)
+
+
+def get_db_matches_for_fingerprints(fingerprints, workers=SELECT_WORKERS):
+    return get_db_matches_for_fingerprint_sets([fingerprints], workers=workers)[0]
+
+
+def get_db_matches_for_fingerprint_sets(fingerprint_sets, workers=SELECT_WORKERS):
+    # looks up several queries at once, returning a matching.Matches for each. Their hashes
+    # are combined so each hash is only selected once, then each query is paired with the rows
+    # for its own hashes, giving it exactly what get_db_matches_for_fingerprints would have
+    # returned for it alone
 
-def store_song_for_stream_in_db(streamid, songid):
     # make sure we have a table to select from
-    create_tables_if_needed()
+    storage = get_storage()
+    storage.ensure_schema()
+    if len(fingerprint_sets) == 0:
+        return []
+    stop_hashes, stop_rows = _stop_hash_arrays(storage.get_stop_hashes())
+    queries = [_plan_lookup(fingerprints, stop_hashes, stop_rows) for fingerprints in fingerprint_sets]
+
+    hashes_to_find = np.unique(np.concatenate([query_hashes for query_hashes, _ in queries]))
+    if len(queries) > 1:
+        requested = sum(len(np.unique(query_hashes)) for query_hashes, _ in queries)
+        print(f'Combined {requested} hashes from {len(queries)} queries into {len(hashes_to_find)} unique hashes')
+    with stage('Lookup'):
+        song_ids, hashes, offsets, songs, timesteps = _select_rows_by_hash(storage, hashes_to_find, workers)
+
+    results = []
+    for query_hashes, query_times in queries:
+        pair_rows, pair_query_times, _, _ = match_postings(query_hashes, query_times, hashes, offsets)
+        results.append(Matches(song_ids, songs[pair_rows], timesteps[pair_rows], pair_query_times))
+    return results
+
+
+def plan_lookup(fingerprints):
+    # a query's hashes and timesteps, without the stop hashes, as looked up in the database.
+    # Local indexes use this too, so they give the same matches
+    stop_hashes, stop_rows = _stop_hash_arrays(get_storage().get_stop_hashes())
+    return _plan_lookup(fingerprints, stop_hashes, stop_rows)
+
+
+def _stop_hash_arrays(stop_hashes):
+    # {hash: rows} as a sorted array of the hashes and an array of their row counts
+    hashes = np.fromiter(stop_hashes.keys(), dtype=np.int64, count=len(stop_hashes))
+    rows = np.fromiter(stop_hashes.values(), dtype=np.int64, count=len(stop_hashes))
+    order = np.argsort(hashes)
+    return hashes[order], rows[order]
+
+
+def _plan_lookup(fingerprints, stop_hashes, stop_rows):
+    # the query as arrays of hashes and timesteps. A hash can occur more than once in the query,
+    # and every occurrence should count towards the match. Leave out the stop hashes, which
+    # match so much of the catalogue that they say very little about which song this is, and
+    # record how many of them there were and how many rows they would have returned
+    hashes = np.fromiter((h for h, _ in fingerprints), dtype=np.int64, count=len(fingerprints))
+    timesteps = np.fromiter((t for _, t in fingerprints), dtype=np.float64, count=len(fingerprints))
+    stop = np.isin(hashes, stop_hashes)
+    pruned = np.unique(hashes[stop])
+    count('StopHashesPruned', len(pruned))
+    count('StopHashRowsSaved', int(stop_rows[np.searchsorted(stop_hashes, pruned)].sum()))
+    return hashes[~stop], timesteps[~stop]
+
+
+def _select_rows_by_hash(storage, hashes_to_find, workers):
+    # fetches the rows for a sorted array of unique hashes, laid out like a local index: the
+    # rows for hashes[i] are at offsets[i]:offsets[i+1] of songs and timesteps, and songs
+    # index into song_ids
+    batches = [
+        hashes_to_find[i:i + SELECT_BATCH_HASHES]
+        for i in range(0, len(hashes_to_find), SELECT_BATCH_HASHES)
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch_results = list(executor.map(storage.select_fingerprints_for_hashes, batches))
+
+    # one table of song names for all the batches. It is sorted, so the order of the songs
+    # (which decides ties when scoring) doesn't depend on which queries were looked up together
+    song_ids = sorted({songid for batch_song_ids, *_ in batch_results for songid in batch_song_ids})
+    song_lookup = {songid: i for i, songid in enumerate(song_ids)}
+    columns = [[], [], [], []]
+    for batch_song_ids, *batch_columns in batch_results:
+        to_song_ids = np.array([song_lookup[songid] for songid in batch_song_ids], dtype=np.int64)
+        batch_columns[1] = to_song_ids[batch_columns[1]]
+        for column, values in zip(columns, batch_columns):
+            column.append(values)
+
+    # the batches are in hash order, as are the rows within them. Identical rows come back as
+    # one row with a count, and are expanded back out
+    hashes, songs, timesteps, counts = (
+        np.concatenate(column) if column else np.empty(0, dtype=np.int64) for column in columns
+    )
+    hashes, songs, timesteps = (np.repeat(column, counts) for column in (hashes, songs, timesteps))
+    unique_hashes, first = np.unique(hashes, return_index=True)
+    offsets = np.append(first, len(hashes)).astype(np.int64)
+    count('RowsReturned', len(hashes))
+    count('UniqueHashes', len(hashes_to_find))
+    count('SelectBatches', len(batches))
+    return song_ids, unique_hashes, offsets, songs, timesteps
+
+
+def get_stop_hashes():
+    # the stop hashes for the current fingerprint format, as {hash: rows}
+    return get_storage().get_stop_hashes()
+
 
-    sql = f"INSERT INTO streams (streamid, songid) VALUES ('{streamid}', '{songid}') " \
-          f"ON CONFLICT (streamid) DO UPDATE SET songid = '{songid}';"
-    run_command(sql)
+def rebuild_hash_stats():
+    get_storage().rebuild_hash_stats()
+
+
+def get_last_song_for_stream_from_db(streamid):
+    return get_storage().get_last_song_for_stream(streamid)
+
+
+def store_song_for_stream_in_db(streamid, songid):
+    return get_storage().store_song_for_stream(streamid, songid)
@@ -0,0 +1,279 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+# A cache of fingerprints, keyed by the content they were made from.
+#
+# The key combines the object's ETag (or a SHA-256 of a local file) with an ID for the
+# fingerprinting configuration, so changing any setting that affects fingerprints never returns
+# stale results. Fingerprints are looked for in three tiers, fastest first:
+#   - memory, bounded by CACHE_MEMORY_BYTES
+#   - files in CACHE_DIR (/tmp persists while a Lambda container is warm), bounded by CACHE_DISK_BYTES
+#   - objects under FINGERPRINT_CACHE_PREFIX in the FingerprintCacheBucket bucket, if it is set.
+#     The template sets it to the source bucket, where a lifecycle rule expires old entries
+# Each tier evicts its least recently used entries when it is full, and a hit in a slower tier
+# is copied into the faster ones.
+
+import os
+import json
+import struct
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+import fingerprinting_config
+from fingerprinting_config import FINGERPRINT_FORMAT
+from fingerprinting import get_fingerprint_arrays_for_s3_object, get_fingerprint_arrays
+from metrics import count
+from s3_utils import get_s3_client
+
+CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+CACHE_DIR = '/tmp/fingerprint_cache'
+CACHE_DISK_BYTES = 256 * 1024 * 1024
+FINGERPRINT_CACHE_BUCKET = os.environ.get('FingerprintCacheBucket')
+FINGERPRINT_CACHE_PREFIX = 'fingerprint_cache/'
+
+# fingerprint blobs: magic, blob version, fingerprint format, number of fingerprints, then the
+# hashes and the offsets as packed arrays
+BLOB_MAGIC = b'SFPC'
+BLOB_VERSION = 1
+BLOB_HEADER_FORMAT = '<4sHHQ'
+BLOB_HEADER_SIZE = struct.calcsize(BLOB_HEADER_FORMAT)
+
+# the settings that change the fingerprints made from the same audio
+CONFIG_SETTINGS = [
+    'FINGERPRINT_FORMAT', 'SAMPLE_RATE', 'PEAK_BOX_SIZE', 'POINT_EFFICIENCY', 'TARGET_START',
+    'TARGET_T', 'TARGET_F', 'FFT_WINDOW_SIZE', 'TARGET_FAN_OUT', 'STREAM_FROM_S3',
+    'STREAM_BLOCK_COLUMNS', 'HASH_FREQ_STEP', 'MAX_FREQUENCY', 'DECODE_FORMAT',
+]
+CONFIG_ID = hashlib.sha256(json.dumps(
+    [getattr(fingerprinting_config, name) for name in CONFIG_SETTINGS]
+).encode('utf-8')).hexdigest()[:16]
+
+
+def get_content_key_for_s3_object(bucket, key):
+    # the ETag changes whenever the object's content does
+    return get_content_key_for_etag(get_s3_client().head_object(Bucket=bucket, Key=key)['ETag'])
+
+
+def get_content_key_for_etag(etag):
+    return f'{etag.strip(chr(34))}-{CONFIG_ID}'
+
+
+def get_content_key_for_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return f'{digest.hexdigest()}-{CONFIG_ID}'
+
+
+def _blob_dtypes(fingerprint_format):
+    # format 1 hashes need 64 bits and its offsets are seconds; later formats pack hashes
+    # into 32 bits, with offsets in whole frames
+    if fingerprint_format == 1:
+        return np.dtype('<i8'), np.dtype('<f8')
+    return np.dtype('<u4'), np.dtype('<i4')
+
+
+def encode_fingerprints(hashes, offsets):
+    """Packs fingerprint arrays into a compact binary blob."""
+    hash_dtype, offset_dtype = _blob_dtypes(FINGERPRINT_FORMAT)
+    header = struct.pack(BLOB_HEADER_FORMAT, BLOB_MAGIC, BLOB_VERSION, FINGERPRINT_FORMAT, len(hashes))
+    return header + hashes.astype(hash_dtype).tobytes() + offsets.astype(offset_dtype).tobytes()
+
+
+def decode_fingerprints(blob):
+    """Unpacks a blob from :func:`encode_fingerprints` into the arrays that
+    :func:`fingerprinting.get_fingerprint_arrays` returns, or None if it isn't a blob in the
+    current fingerprint format.
+    """
+    if len(blob) < BLOB_HEADER_SIZE:
+        return None
+    magic, version, fingerprint_format, n = struct.unpack_from(BLOB_HEADER_FORMAT, blob)
+    if magic != BLOB_MAGIC or version != BLOB_VERSION or fingerprint_format != FINGERPRINT_FORMAT:
+        return None
+    hash_dtype, offset_dtype = _blob_dtypes(fingerprint_format)
+    if len(blob) != BLOB_HEADER_SIZE + n * (hash_dtype.itemsize + offset_dtype.itemsize):
+        return None
+    hashes = np.frombuffer(blob, dtype=hash_dtype, count=n, offset=BLOB_HEADER_SIZE)
+    offsets = np.frombuffer(blob, dtype=offset_dtype, count=n, offset=BLOB_HEADER_SIZE + n * hash_dtype.itemsize)
+    return hashes.astype(np.int64), offsets.astype(np.float64 if fingerprint_format == 1 else np.int64)
+
+
+class FingerprintCache:
+    """The memory, disk and S3 tiers of the cache. Safe to use from several threads."""
+
+    def __init__(self, memory_bytes=CACHE_MEMORY_BYTES, cache_dir=CACHE_DIR, disk_bytes=CACHE_DISK_BYTES,
+                 bucket=FINGERPRINT_CACHE_BUCKET, prefix=FINGERPRINT_CACHE_PREFIX):
+        self.memory_bytes = memory_bytes
+        self.cache_dir = cache_dir
+        self.disk_bytes = disk_bytes
+        self.bucket = bucket
+        self.prefix = prefix
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+
+    def get(self, content_key):
+        # returns the blob for content_key, or None
+        with self._lock:
+            blob = self._memory.get(content_key)
+            if blob is not None:
+                self._memory.move_to_end(content_key)
+                count('FingerprintCacheMemoryHits')
+                return blob
+
+        blob = self._read_disk(content_key)
+        if blob is not None:
+            count('FingerprintCacheDiskHits')
+            self._put_memory(content_key, blob)
+            return blob
+
+        blob = self._read_s3(content_key)
+        if blob is not None:
+            count('FingerprintCacheS3Hits')
+            self._put_memory(content_key, blob)
+            self._write_disk(content_key, blob)
+            return blob
+
+        count('FingerprintCacheMisses')
+        return None
+
+    def put(self, content_key, blob):
+        self._put_memory(content_key, blob)
+        self._write_disk(content_key, blob)
+        self._write_s3(content_key, blob)
+
+    def _put_memory(self, content_key, blob):
+        if len(blob) > self.memory_bytes:
+            return
+        with self._lock:
+            if content_key in self._memory:
+                self._memory_used -= len(self._memory.pop(content_key))
+            self._memory[content_key] = blob
+            self._memory_used += len(blob)
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+
+    def _disk_path(self, content_key):
+        return os.path.join(self.cache_dir, f'{content_key}.fpc')
+
+    def _read_disk(self, content_key):
+        path = self._disk_path(content_key)
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return None
+        # the modification time records when the entry was last used, for eviction
+        os.utime(path)
+        return blob
+
+    def _write_disk(self, content_key, blob):
+        if len(blob) > self.disk_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._disk_path(content_key)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+        self._evict_disk()
+
+    def _evict_disk(self):
+        # removes the least recently used files until the cache fits in disk_bytes
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.fpc'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if used <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+
+    def _read_s3(self, content_key):
+        if self.bucket is None:
+            return None
+        try:
+            response = get_s3_client().get_object(Bucket=self.bucket, Key=f'{self.prefix}{content_key}.fpc')
+        except get_s3_client().exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def _write_s3(self, content_key, blob):
+        if self.bucket is not None:
+            get_s3_client().put_object(Bucket=self.bucket, Key=f'{self.prefix}{content_key}.fpc', Body=blob)
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = FingerprintCache()
+    return _cache
+
+
+def get_cached_fingerprint_arrays(content_key, make_fingerprints):
+    # returns the fingerprints for content_key from the cache, or makes them with
+    # make_fingerprints() and caches them
+    cache = get_cache()
+    blob = cache.get(content_key)
+    if blob is not None:
+        fingerprints = decode_fingerprints(blob)
+        if fingerprints is not None:
+            return fingerprints
+    hashes, offsets = make_fingerprints()
+    cache.put(content_key, encode_fingerprints(hashes, offsets))
+    return hashes, offsets
+
+
+def get_fingerprint_arrays_for_s3_object_cached(bucket, key, content_key=None):
+    """Fingerprints an object in S3, or returns its fingerprints from the cache.
+
+    :param content_key: The object's key from :func:`get_content_key_for_s3_object`, if
+        the caller already has it.
+    """
+    if content_key is None:
+        content_key = get_content_key_for_s3_object(bucket, key)
+    return get_cached_fingerprint_arrays(
+        content_key, lambda: get_fingerprint_arrays_for_s3_object(bucket, key)
+    )
+
+
+def get_fingerprints_for_s3_object_cached(bucket, key, content_key=None):
+    # as fingerprinting.get_fingerprints_for_s3_object, but through the cache
+    hashes, offsets = get_fingerprint_arrays_for_s3_object_cached(bucket, key, content_key)
+    return list(zip(hashes.tolist(), offsets.tolist()))
+
+
+def get_fingerprint_arrays_cached(path, content_key=None):
+    # as fingerprinting.get_fingerprint_arrays, but through the cache
+    if content_key is None:
+        content_key = get_content_key_for_file(path)
+    return get_cached_fingerprint_arrays(content_key, lambda: get_fingerprint_arrays(path))
@@ -0,0 +1,304 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import json
+import struct
+import numpy as np
+from db_utils import run_command, sql_array, has_legacy_rows, plan_lookup, get_db_matches_for_fingerprints, \
+    get_db_matches_for_fingerprint_sets
+from fingerprinting_config import FINGERPRINT_FORMAT
+from matching import Matches, match_postings
+from metrics import stage, count
+
+# A local fingerprint index is a single file, laid out as:
+#   header | hashes (int64, sorted, unique) | posting offsets (int64, one more than hashes)
+#   | postings (song index uint32, timestep int32)
+#   | songs (JSON: names, and the songs table revision each song's rows were exported at)
+# The postings for hashes[i] are postings[offsets[i]:offsets[i+1]].
+INDEX_MAGIC = b'SIDX'
+INDEX_VERSION = 4
+HEADER_FORMAT = '<4sIIIQQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+POSTING_DTYPE = np.dtype([('song', '<u4'), ('timestep', '<i4')])
+
+# rows fetched per SELECT when exporting, to stay under the Data API's 1MB result limit
+EXPORT_BATCH_ROWS = 5000
+# songs whose rows are fetched together when exporting
+EXPORT_BATCH_SONGS = 200
+
+LOCAL_INDEX_PATH = os.getenv('LocalIndexPath')
+
+
+class FingerprintIndex:
+    """A read-only fingerprint index, memory-mapped from a file written by :func:`write_index`."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+        magic, version, self.fingerprint_format, _, n_hashes, n_postings, names_offset, names_length = header
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f'{path} is not a version {INDEX_VERSION} fingerprint index')
+
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        offset = HEADER_SIZE
+        self.hashes = _map(path, np.int64, offset, n_hashes)
+        offset += self.hashes.nbytes
+        self.offsets = _map(path, np.int64, offset, n_hashes + 1)
+        offset += self.offsets.nbytes
+        self.postings = _map(path, POSTING_DTYPE, offset, n_postings)
+
+        with open(path, 'rb') as f:
+            f.seek(names_offset)
+            songs = json.loads(f.read(names_length).decode('utf-8'))
+        self.song_ids = songs['names']
+        self.song_revisions = songs['revisions']
+
+    def get_matches(self, fingerprints):
+        """Looks up fingerprints in the index. Stop hashes are left out, as they are from
+        database lookups, so both give the same matches.
+
+        :param fingerprints: List of (hash, time offset) pairs for the query.
+        :returns: :class:`matching.Matches`, as from :func:`db_utils.get_db_matches_for_fingerprints`.
+        """
+        query_hashes, query_times = plan_lookup(fingerprints)
+
+        pair_rows, pair_query_times, unique_hashes, total = match_postings(
+            query_hashes, query_times, self.hashes, self.offsets
+        )
+        postings = self.postings[pair_rows]
+
+        count('UniqueHashes', unique_hashes)
+        count('RowsReturned', total)
+        return Matches(self.song_ids, postings['song'], postings['timestep'], pair_query_times)
+
+
+def _map(path, dtype, offset, count):
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+def write_index(path, song_ids, song_revisions, song_idxs, hashes, timesteps,
+                fingerprint_format=FINGERPRINT_FORMAT):
+    """Writes a fingerprint index file from flat arrays of rows.
+
+    The file is written next to `path` and renamed into place, so readers never see a
+    partial index.
+
+    :param path: Where to write the index.
+    :param song_ids: List of song names; `song_idxs` index into it.
+    :param song_revisions: Songs table revision of each song's rows, used for incremental
+        updates. 0 for songs no longer in the database.
+    :param song_idxs: Song index of each row.
+    :param hashes: Hash of each row.
+    :param timesteps: Timestep of each row.
+    :param fingerprint_format: Format of the fingerprints in the index.
+    """
+    hashes = np.asarray(hashes, dtype=np.int64)
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    postings = np.empty(len(hashes), dtype=POSTING_DTYPE)
+    postings['song'] = np.asarray(song_idxs)[order]
+    postings['timestep'] = np.asarray(timesteps)[order]
+
+    unique_hashes, first = np.unique(hashes, return_index=True)
+    offsets = np.append(first, len(hashes)).astype(np.int64)
+    names = json.dumps({'names': list(song_ids), 'revisions': [int(r) for r in song_revisions]}).encode('utf-8')
+    names_offset = HEADER_SIZE + unique_hashes.nbytes + offsets.nbytes + postings.nbytes
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, fingerprint_format, 0,
+                            len(unique_hashes), len(postings), names_offset, len(names)))
+        f.write(unique_hashes.tobytes())
+        f.write(offsets.tobytes())
+        f.write(postings.tobytes())
+        f.write(names)
+    os.replace(tmp_path, path)
+    print(f'Wrote index {path}: {len(song_ids)} songs, {len(unique_hashes)} hashes, {len(postings)} rows')
+
+
+def export_index(path):
+    """Snapshots the fingerprints of every song into a local index file."""
+    return update_index(path, rebuild=True)
+
+
+def update_index(path, rebuild=False):
+    """Brings a local index file up to date with the database.
+
+    The index records the songs table revision of each song's rows. Only songs whose revision
+    in the database differs - songs re-indexed, added or removed since - are read from the
+    database. Their old rows are dropped from the existing index, their current rows added, and
+    the file is rewritten. Revisions are taken from a sequence when a song's rows are written
+    but only show once they commit, so they can appear out of order; comparing each song's
+    revision, rather than reading those above the highest seen, still picks those songs up.
+    Builds the index from scratch if it doesn't exist yet, or if `rebuild` is set.
+
+    Songs in the old fingerprints table aren't exported, so this refuses to run until
+    migrate_fingerprints.py has moved them all - an index missing them would stop them matching.
+    """
+    if has_legacy_rows():
+        raise RuntimeError('The fingerprints table still has rows to migrate. '
+                           'Run migrate_fingerprints.py before exporting a local index')
+    song_ids, song_idxs, hashes, timesteps = [], [], [], []
+    revisions = {}
+    if not rebuild and os.path.exists(path):
+        try:
+            index = FingerprintIndex(path)
+        except ValueError as e:
+            print(f'Rebuilding index: {e}')
+            return update_index(path, rebuild=True)
+        if index.fingerprint_format != FINGERPRINT_FORMAT:
+            del index
+            return update_index(path, rebuild=True)
+        song_ids = list(index.song_ids)
+        revisions = dict(zip(song_ids, index.song_revisions))
+        counts = np.diff(index.offsets)
+        hashes.append(np.repeat(index.hashes, counts))
+        song_idxs.append(np.asarray(index.postings['song']))
+        timesteps.append(np.asarray(index.postings['timestep']))
+        del index
+
+    # songs table id -> name of every song whose revision differs from the index's
+    changed = {}
+    current = set()
+    last_id = 0
+    while True:
+        sql = f"SELECT id, songid, revision FROM songs " \
+              f"WHERE version = {int(FINGERPRINT_FORMAT)} AND id > {int(last_id)} " \
+              f"ORDER BY id LIMIT {EXPORT_BATCH_ROWS};"
+        records = run_command(sql)
+        for song, songid, revision in records:
+            current.add(songid)
+            if revisions.get(songid) != revision:
+                changed[song] = songid
+                revisions[songid] = revision
+        if len(records) > 0:
+            last_id = records[-1][0]
+        if len(records) < EXPORT_BATCH_ROWS:
+            break
+    removed = [songid for songid, revision in revisions.items() if revision != 0 and songid not in current]
+    for songid in removed:
+        revisions[songid] = 0
+
+    print(f'{len(changed)} changed songs read from DB')
+    if len(changed) == 0 and len(removed) == 0 and not rebuild and os.path.exists(path):
+        return
+
+    song_lookup = {songid: i for i, songid in enumerate(song_ids)}
+    if len(hashes) > 0:
+        replaced = [song_lookup[songid] for songid in (*changed.values(), *removed) if songid in song_lookup]
+        if len(replaced) > 0:
+            keep = ~np.isin(song_idxs[0], replaced)
+            song_idxs[0], hashes[0], timesteps[0] = song_idxs[0][keep], hashes[0][keep], timesteps[0][keep]
+            print(f'Replaced the fingerprints of {len(replaced)} re-indexed or removed songs')
+    for songid in changed.values():
+        song_lookup.setdefault(songid, len(song_lookup))
+
+    changed_ids = list(changed)
+    new_rows = 0
+    for i in range(0, len(changed_ids), EXPORT_BATCH_SONGS):
+        # identical rows come back grouped, which makes (song, hash, timestep) unique, so it
+        # serves as the key to carry on from
+        sql = "SELECT song, hash, timestep, COUNT(*) FROM song_fingerprints " \
+              "WHERE song = ANY(CAST(:songs AS int[])) " \
+              "AND (song, hash, timestep) > (:lastsong, :lasthash, :laststep) " \
+              f"GROUP BY song, hash, timestep ORDER BY song, hash, timestep LIMIT {EXPORT_BATCH_ROWS};"
+        parameters = {
+            'songs': sql_array(changed_ids[i:i + EXPORT_BATCH_SONGS]),
+            'lastsong': 0,
+            'lasthash': np.iinfo(np.int64).min,
+            'laststep': np.iinfo(np.int32).min,
+        }
+        while True:
+            records = run_command(sql, parameters)
+            if len(records) == 0:
+                break
+            batch_songs = np.empty(len(records), dtype=np.uint32)
+            batch_hashes = np.empty(len(records), dtype=np.int64)
+            batch_timesteps = np.empty(len(records), dtype=np.int32)
+            batch_counts = np.empty(len(records), dtype=np.int64)
+            for j, row in enumerate(records):
+                batch_songs[j] = song_lookup[changed[row[0]]]
+                batch_hashes[j], batch_timesteps[j], batch_counts[j] = row[1:]
+            song_idxs.append(np.repeat(batch_songs, batch_counts))
+            hashes.append(np.repeat(batch_hashes, batch_counts))
+            timesteps.append(np.repeat(batch_timesteps, batch_counts))
+            new_rows += int(batch_counts.sum())
+            if len(records) < EXPORT_BATCH_ROWS:
+                break
+            parameters['lastsong'] = records[-1][0]
+            parameters['lasthash'] = int(batch_hashes[-1])
+            parameters['laststep'] = int(batch_timesteps[-1])
+
+    print(f'{new_rows} new fingerprint rows read from DB')
+    song_ids = sorted(song_lookup, key=song_lookup.get)
+    write_index(path, song_ids, [revisions[songid] for songid in song_ids],
+                np.concatenate(song_idxs) if song_idxs else np.empty(0, dtype=np.uint32),
+                np.concatenate(hashes) if hashes else np.empty(0, dtype=np.int64),
+                np.concatenate(timesteps) if timesteps else np.empty(0, dtype=np.int32))
+
+
+_index = None
+
+
+def get_local_index():
+    """Returns the index at LocalIndexPath, loaded once per container and reloaded if the
+    file changes. Returns None if no local index is configured or present.
+    """
+    global _index
+    if LOCAL_INDEX_PATH is None or not os.path.exists(LOCAL_INDEX_PATH):
+        return None
+    if _index is None or _index.mtime != os.path.getmtime(LOCAL_INDEX_PATH):
+        try:
+            _index = FingerprintIndex(LOCAL_INDEX_PATH)
+        except ValueError as e:
+            print(f'Ignoring local index: {e}')
+            return None
+    if _index.fingerprint_format != FINGERPRINT_FORMAT:
+        print(f'Ignoring local index in fingerprint format {_index.fingerprint_format}')
+        return None
+    return _index
+
+
+def get_matches_for_fingerprints(fingerprints):
+    # use the local index if there is one, otherwise go to the database
+    index = get_local_index()
+    if index is None:
+        return get_db_matches_for_fingerprints(fingerprints)
+    with stage('Lookup'):
+        return index.get_matches(fingerprints)
+
+
+def get_matches_for_fingerprint_sets(fingerprint_sets):
+    # the same for several queries at once. The local index is cheap enough to search once per
+    # query, while the database lookups are shared between the queries
+    index = get_local_index()
+    if index is None:
+        return get_db_matches_for_fingerprint_sets(fingerprint_sets)
+    with stage('Lookup'):
+        return [index.get_matches(fingerprints) for fingerprints in fingerprint_sets]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Export or update a local fingerprint index')
+    parser.add_argument('path', help='index file to write')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild from scratch')
+    args = parser.parse_args()
+    update_index(args.path, rebuild=args.rebuild)
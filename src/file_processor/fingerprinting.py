@@ -20,16 +20,77 @@ from av import AudioResampler
 from scipy.signal import spectrogram
 from scipy.ndimage import maximum_filter
 from fingerprinting_config import SAMPLE_RATE, PEAK_BOX_SIZE, POINT_EFFICIENCY, \
-    TARGET_START, TARGET_T, TARGET_F, FFT_WINDOW_SIZE
+    TARGET_START, TARGET_T, TARGET_F, TARGET_FAN_OUT, \
+    PEAK_TILE_SIZE, STREAM_BLOCK_COLUMNS, STREAM_FROM_S3, FINGERPRINT_FORMAT, HASH_FREQ_STEP, \
+    FFT_NPERSEG, FRAME_HOP, MAX_FREQUENCY, DECODE_FORMAT
+from s3_utils import downloaded_from_s3, open_s3_object
+from metrics import stage, count
 
 
 def get_fingerprints(filename):
-    f, t, Sxx = file_to_spectrogram(filename)
-    peaks = find_peaks(Sxx)
-    peaks = idxs_to_tf_pairs(peaks, t, f)
-    hashes = hash_points(peaks)
-    hashes = sorted(hashes, key=lambda x: x[1])
-    return hashes
+    hashes, offsets = get_fingerprint_arrays(filename)
+    return list(zip(hashes.tolist(), offsets.tolist()))
+
+
+def get_fingerprints_for_s3_object(bucket, key):
+    """Fingerprints an object in S3, either streaming it or downloading it to /tmp first,
+    depending on :data:`STREAM_FROM_S3`.
+    """
+    hashes, offsets = get_fingerprint_arrays_for_s3_object(bucket, key)
+    return list(zip(hashes.tolist(), offsets.tolist()))
+
+
+def get_fingerprint_arrays_for_s3_object(bucket, key):
+    """As :func:`get_fingerprints_for_s3_object`, returning arrays like :func:`get_fingerprint_arrays`."""
+    if STREAM_FROM_S3:
+        with open_s3_object(bucket, key) as source:
+            return get_fingerprint_arrays_streaming(source)
+    with downloaded_from_s3(bucket, key) as local_fname:
+        return get_fingerprint_arrays(local_fname)
+
+
+def get_fingerprint_arrays(filename):
+    """Fingerprints a file, returning packed arrays rather than a list of tuples.
+
+    :param filename: Path to the file to fingerprint.
+    :returns: * hashes - int64 array of fingerprint hashes
+              * offsets - time offset of each hash, sorted ascending, in the units of
+                :data:`FINGERPRINT_FORMAT`
+    """
+    return samples_to_fingerprint_arrays(get_samples_from_file(filename))
+
+
+def get_samples_for_s3_object(bucket, key):
+    """Decodes an object in S3 into samples, streaming it or downloading it to /tmp first,
+    depending on :data:`STREAM_FROM_S3`.
+    """
+    if STREAM_FROM_S3:
+        with open_s3_object(bucket, key) as source:
+            return np.concatenate(list(iter_sample_blocks(source)))
+    with downloaded_from_s3(bucket, key) as local_fname:
+        return get_samples_from_file(local_fname)
+
+
+def samples_to_fingerprint_arrays(samples, min_target_time=None):
+    """Fingerprints decoded audio.
+
+    :param samples: Mono samples at :data:`SAMPLE_RATE`, as from :func:`get_samples_from_file`.
+    :param min_target_time: If given, only pairs whose target peak is at or after this time
+        (in seconds from the start of `samples`) are hashed.
+    :returns: * hashes - int64 array of fingerprint hashes
+              * offsets - time offset of each hash, sorted ascending, in the units of
+                :data:`FINGERPRINT_FORMAT`
+    """
+    with stage('Spectrogram'):
+        f, t, Sxx = samples_to_spectrogram(samples)
+    with stage('Peaks'):
+        peaks = find_peaks(Sxx)
+        peaks = idxs_to_tf_pairs(peaks, t, f)
+    with stage('Hashing'):
+        hashes, offsets = hash_points(peaks, min_target_time=min_target_time)
+        order = np.argsort(offsets, kind='stable')
+    count('Fingerprints', len(hashes))
+    return hashes[order], offsets[order]
 
 
 def file_to_spectrogram(filename):
@@ -43,12 +104,29 @@ def file_to_spectrogram(filename):
               * t - list of times
               * Sxx - Power value for each time/frequency pair
     """
-    audio = get_samples_from_file(filename)
-    nperseg = int(SAMPLE_RATE * FFT_WINDOW_SIZE)
-    return spectrogram(audio, SAMPLE_RATE, nperseg=nperseg)
+    return samples_to_spectrogram(get_samples_from_file(filename))
+
+
+def samples_to_spectrogram(samples):
+    """Calculates the spectrogram of mono samples at :data:`SAMPLE_RATE`.
+
+    The spectrogram has the precision of the samples (float32 for float32 samples), and
+    stops at :data:`MAX_FREQUENCY` if one is set.
+    """
+    f, t, Sxx = spectrogram(samples, SAMPLE_RATE, nperseg=FFT_NPERSEG)
+    f, Sxx = band_limit(f, Sxx)
+    return f, t, Sxx
 
 
-def find_peaks(Sxx):
+def band_limit(f, Sxx):
+    """Drops the spectrogram rows above :data:`MAX_FREQUENCY`, if it is set."""
+    if MAX_FREQUENCY is None:
+        return f, Sxx
+    rows = np.searchsorted(f, MAX_FREQUENCY, side='right')
+    return f[:rows], Sxx[:rows]
+
+
+def find_peaks(Sxx, tile_size=PEAK_TILE_SIZE):
     """Finds peaks in a spectrogram.
 
     Uses :data:`~abracadabra.PEAK_BOX_SIZE` as the size of the region around each
@@ -60,26 +138,76 @@ def find_peaks(Sxx):
     <https://photutils.readthedocs.io/en/stable/_modules/photutils/detection/core.html#find_peaks>`_.
 
     :param Sxx: The spectrogram.
-    :returns: A list of peaks in the spectrogram.
+    :param tile_size: If the spectrogram has more time columns than this, the maximum filter
+        is run over blocks of `tile_size` columns (with enough overlap that the result is
+        unchanged), so the filter output never has to be held for the whole spectrogram.
+        None disables tiling.
+    :returns: Two arrays - the frequency and time indices of the peaks, strongest first.
     """
-    data_max = maximum_filter(Sxx, size=PEAK_BOX_SIZE, mode='constant', cval=0.0)
-    peak_goodmask = (Sxx == data_max)  # good pixels are True
-    y_peaks, x_peaks = peak_goodmask.nonzero()
-    peak_values = Sxx[y_peaks, x_peaks]
-    i = peak_values.argsort()[::-1]
-    # get co-ordinates into arr
-    j = [(y_peaks[idx], x_peaks[idx]) for idx in i]
     total = Sxx.shape[0] * Sxx.shape[1]
     # in a square with a perfectly spaced grid, we could fit area / PEAK_BOX_SIZE^2 points
     # use point efficiency to reduce this, since it won't be perfectly spaced
     # accuracy vs speed tradeoff
     peak_target = int((total / (PEAK_BOX_SIZE**2)) * POINT_EFFICIENCY)
-    return j[:peak_target]
+    n_cols = Sxx.shape[1]
+
+    if tile_size is None or n_cols <= tile_size:
+        y_peaks, x_peaks = _local_maxima(Sxx)
+        peak_values = Sxx[y_peaks, x_peaks]
+        _, y_peaks, x_peaks = _top_peaks(peak_values, y_peaks, x_peaks, n_cols, peak_target)
+        return y_peaks, x_peaks
+
+    # each column's filter window reaches PEAK_BOX_SIZE // 2 columns either side,
+    # so a halo of PEAK_BOX_SIZE columns makes every tile exact
+    halo = PEAK_BOX_SIZE
+    best_values = np.empty(0, dtype=Sxx.dtype)
+    best_y = np.empty(0, dtype=np.intp)
+    best_x = np.empty(0, dtype=np.intp)
+    for start in range(0, n_cols, tile_size):
+        stop = min(start + tile_size, n_cols)
+        lo = max(start - halo, 0)
+        hi = min(stop + halo, n_cols)
+        y_peaks, x_peaks = _local_maxima(Sxx[:, lo:hi], start - lo, stop - lo)
+        x_peaks += start
+        best_values, best_y, best_x = _top_peaks(
+            np.concatenate((best_values, Sxx[y_peaks, x_peaks])),
+            np.concatenate((best_y, y_peaks)),
+            np.concatenate((best_x, x_peaks)),
+            n_cols, peak_target
+        )
+    return best_y, best_x
+
+
+def _local_maxima(Sxx, start=0, stop=None):
+    """Frequency/time indices of the points in columns [start, stop) of `Sxx` that are
+    the maximum of the PEAK_BOX_SIZE box around them. Time indices are relative to `start`.
+    """
+    data_max = maximum_filter(Sxx, size=PEAK_BOX_SIZE, mode='constant', cval=0.0)
+    peak_goodmask = (Sxx[:, start:stop] == data_max[:, start:stop])  # good pixels are True
+    return peak_goodmask.nonzero()
+
+
+def _top_peaks(values, y_peaks, x_peaks, n_cols, peak_target):
+    """Selects the `peak_target` strongest peaks, strongest first.
+
+    Uses a partial selection rather than sorting every candidate. Equal values are ordered
+    by descending position in the spectrogram, as a reversed stable argsort would give.
+    """
+    if peak_target <= 0:
+        return values[:0], y_peaks[:0], x_peaks[:0]
+    if len(values) > peak_target:
+        kth = values[np.argpartition(values, -peak_target)[-peak_target]]
+        keep = values >= kth
+        values, y_peaks, x_peaks = values[keep], y_peaks[keep], x_peaks[keep]
+    position = y_peaks.astype(np.int64) * n_cols + x_peaks
+    i = np.lexsort((position, values))[::-1][:peak_target]
+    return values[i], y_peaks[i], x_peaks[i]
 
 
 def idxs_to_tf_pairs(idxs, t, f):
     """Helper function to convert time/frequency indices into values."""
-    return np.array([(f[i[0]], t[i[1]]) for i in idxs])
+    y_peaks, x_peaks = idxs
+    return np.column_stack((f[y_peaks], t[x_peaks]))
 
 
 def hash_point_pair(p1, p2):
@@ -87,58 +215,180 @@ def hash_point_pair(p1, p2):
     return hash((p1[0], p2[0], p2[1]-p2[1]))
 
 
-def target_zone(anchor, points, width, height, t):
-    """Generates a target zone as described in `the Shazam paper
+# constants used by CPython's tuple hash (xxHash based, 64-bit builds)
+_XXPRIME_1 = np.uint64(11400714785074694791)
+_XXPRIME_2 = np.uint64(14029467366897019727)
+_XXPRIME_5 = np.uint64(2870177450012600261)
+
+
+def _lane_hashes(values):
+    """Python ``hash()`` of each float in `values`, as unsigned 64-bit lanes.
+
+    Peak frequencies come from a small set of spectrogram bins, so we only call
+    ``hash()`` once per distinct value.
+    """
+    uniq, inverse = np.unique(values, return_inverse=True)
+    lanes = np.array([hash(float(v)) for v in uniq], dtype=np.int64)
+    return lanes.view(np.uint64)[inverse.reshape(-1)]
+
+
+def hash_point_pairs(f1, f2):
+    """Vectorized :func:`hash_point_pair` for arrays of anchor and target frequencies.
+
+    Reproduces CPython's tuple hash of ``(f1, f2, 0.0)`` with wrapping 64-bit
+    arithmetic, so the values are identical to the scalar helper.
+
+    :param f1: Array of anchor frequencies.
+    :param f2: Array of target frequencies.
+    :returns: An int64 array of hashes.
+    """
+    acc = np.full(len(f1), _XXPRIME_5, dtype=np.uint64)
+    # hash(0.0) == 0, which is the lane for the (always zero) time term
+    for lane in (_lane_hashes(f1), _lane_hashes(f2), np.zeros(len(f1), dtype=np.uint64)):
+        acc += lane * _XXPRIME_2
+        acc = (acc << np.uint64(31)) | (acc >> np.uint64(33))
+        acc *= _XXPRIME_1
+    acc += np.uint64(3) ^ (_XXPRIME_5 ^ np.uint64(3527539))
+    hashes = acc.view(np.int64)
+    hashes[hashes == -1] = 1546275796
+    return hashes
+
+
+# bit layout of format 2 hashes: anchor frequency | target frequency | time delta
+HASH_FREQ_BITS = 12
+HASH_DELTA_BITS = 8
+
+
+def pack_hash_pairs(f1, f2, frame_deltas):
+    """Packs anchor/target pairs into format 2 hashes.
+
+    Both frequencies are quantized to :data:`HASH_FREQ_STEP` Hz steps, and packed together with
+    the anchor-to-target delta in spectrogram frames into a 32-bit value. The result only
+    depends on the inputs, so it is the same on every platform and Python version.
+
+    :param f1: Array of anchor frequencies, in Hz.
+    :param f2: Array of target frequencies, in Hz.
+    :param frame_deltas: Array of target frame minus anchor frame.
+    :returns: An int64 array of hashes, each in the range [0, 2**32).
+    """
+    freq_max = (1 << HASH_FREQ_BITS) - 1
+    q1 = np.minimum(np.floor(np.asarray(f1) / HASH_FREQ_STEP), freq_max).astype(np.int64)
+    q2 = np.minimum(np.floor(np.asarray(f2) / HASH_FREQ_STEP), freq_max).astype(np.int64)
+    dt = np.clip(frame_deltas, 0, (1 << HASH_DELTA_BITS) - 1).astype(np.int64)
+    return (q1 << (HASH_FREQ_BITS + HASH_DELTA_BITS)) | (q2 << HASH_DELTA_BITS) | dt
+
+
+def times_to_frames(times):
+    """Converts spectrogram column times (in seconds) back to column indices."""
+    return np.rint((np.asarray(times) * SAMPLE_RATE - FFT_NPERSEG / 2) / FRAME_HOP).astype(np.int64)
+
+
+def hash_pairs(points, anchors, targets, fingerprint_format=FINGERPRINT_FORMAT):
+    """Hashes anchor/target pairs of peaks in the given fingerprint format.
+
+    :param points: Array of (frequency, time) peaks.
+    :param anchors: Indices into `points` of the anchor of each pair.
+    :param targets: Indices into `points` of the target of each pair.
+    :param fingerprint_format: See :data:`FINGERPRINT_FORMAT`.
+    :returns: Two arrays - the hashes, and the time offset of each anchor (in seconds for
+        format 1, spectrogram frames for format 2).
+    """
+    if fingerprint_format == 1:
+        return hash_point_pairs(points[anchors, 0], points[targets, 0]), points[anchors, 1]
+    anchor_frames = times_to_frames(points[anchors, 1])
+    target_frames = times_to_frames(points[targets, 1])
+    hashes = pack_hash_pairs(points[anchors, 0], points[targets, 0], target_frames - anchor_frames)
+    return hashes, anchor_frames
+
+
+def target_zone_pairs(points, width, height, t, fan_out=None):
+    """Finds every anchor/target pair as described in `the Shazam paper
     <https://www.ee.columbia.edu/~dpwe/papers/Wang03-shazam.pdf>`_.
 
-    Given an anchor point, yields all points within a box that starts `t` seconds after the point,
-    and has width `width` and height `height`.
+    For each anchor point, the target zone is a box that starts `t` seconds after the point,
+    and has width `width` and height `height`. Peaks are sorted by time so each anchor only
+    looks at the index range of peaks falling inside its time window.
 
-    :param anchor: The anchor point
-    :param points: The list of points to search
+    :param points: Array of (frequency, time) peaks.
     :param width: The width of the target zone
     :param height: The height of the target zone
     :param t: How many seconds after the anchor point the target zone should start
-    :returns: Yields all points within the target zone.
+    :param fan_out: Optional cap on the number of targets per anchor. The targets closest
+        in time to the anchor are kept.
+    :returns: Two arrays of indices into `points` - anchors and their targets. Pairs are
+        ordered by anchor, then by target, in the same order as `points`.
     """
-    x_min = anchor[1] + t
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    freqs = points[:, 0]
+    times = points[:, 1]
+
+    order = np.argsort(times, kind='stable')
+    sorted_times = times[order]
+
+    # same arithmetic as the original per-anchor box, so edges compare identically
+    x_min = times + t
     x_max = x_min + width
-    y_min = anchor[0] - (height*0.5)
+    lo = np.searchsorted(sorted_times, x_min, side='left')
+    hi = np.searchsorted(sorted_times, x_max, side='right')
+    counts = np.maximum(hi - lo, 0)
+
+    # expand each anchor into its window of candidate targets
+    anchors = np.repeat(np.arange(len(points)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    ranks = np.arange(len(anchors)) - starts
+    targets = order[np.repeat(lo, counts) + ranks]
+
+    y_min = freqs[anchors] - (height*0.5)
     y_max = y_min + height
-    for point in points:
-        if point[0] < y_min or point[0] > y_max:
-            continue
-        if point[1] < x_min or point[1] > x_max:
-            continue
-        yield point
+    in_zone = (freqs[targets] >= y_min) & (freqs[targets] <= y_max)
+    anchors = anchors[in_zone]
+    targets = targets[in_zone]
+
+    if fan_out is not None:
+        # candidates are still grouped by anchor and sorted by time within each group
+        group_sizes = np.bincount(anchors, minlength=len(points))
+        starts = np.repeat(np.cumsum(group_sizes) - group_sizes, group_sizes)
+        keep = (np.arange(len(anchors)) - starts) < fan_out
+        anchors = anchors[keep]
+        targets = targets[keep]
 
+    pair_order = np.lexsort((targets, anchors))
+    return anchors[pair_order], targets[pair_order]
 
-def hash_points(points):
+
+def hash_points(points, fan_out=TARGET_FAN_OUT, min_target_time=None):
     """Generates all hashes for a list of peaks.
 
-    Iterates through the peaks, generating a hash for each peak within that peak's target zone.
-
-    :param points: The list of peaks.
-    :param filename: The filename of the song, used for generating song_id.
-    :returns: A list of tuples of the form (hash, time offset, song_id).
-    """
-    hashes = []
-    for anchor in points:
-        for target in target_zone(
-            anchor, points, TARGET_T, TARGET_F, TARGET_START
-        ):
-            hashes.append((
-                # hash
-                hash_point_pair(anchor, target),
-                # time offset
-                anchor[1]
-            ))
-    return hashes
+    Pairs each peak with every peak within that peak's target zone, and hashes each pair.
+
+    :param points: Array of (frequency, time) peaks.
+    :param fan_out: Optional cap on the number of targets paired with each anchor.
+    :param min_target_time: If given, pairs whose target is earlier than this are skipped.
+    :returns: Two arrays - the hashes, and the time offset (of the anchor) for each hash.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    anchors, targets = target_zone_pairs(
+        points, TARGET_T, TARGET_F, TARGET_START, fan_out=fan_out
+    )
+    if min_target_time is not None:
+        keep = points[targets, 1] >= min_target_time
+        anchors, targets = anchors[keep], targets[keep]
+    return hash_pairs(points, anchors, targets)
 
 
 def get_samples_from_file(fname):
+    with stage('Decode'):
+        return np.concatenate(list(iter_sample_blocks(fname)))
+
+
+def iter_sample_blocks(source):
+    """Decodes audio into blocks of mono samples at :data:`SAMPLE_RATE`, one per frame.
 
-    container = av.open(fname)
+    :param source: Path to the file, or a readable (and ideally seekable) file object.
+    :returns: Yields arrays of samples - 32-bit floats if :data:`DECODE_FORMAT` is 'flt',
+        otherwise as the decoder produces them, with floats converted to 16-bit integers.
+    """
+    container = av.open(source)
     audio_stream = next(s for s in container.streams if s.type == 'audio')
 
     # reset to the start of the file
@@ -150,8 +400,7 @@ def get_samples_from_file(fname):
     if frame is None:
         raise Exception('Cannot get audio frames')
 
-    samples = []
-    resampler = AudioResampler(layout="mono", rate=SAMPLE_RATE)
+    resampler = AudioResampler(format=DECODE_FORMAT, layout="mono", rate=SAMPLE_RATE)
 
     try:
         while frame:
@@ -160,7 +409,14 @@ def get_samples_from_file(fname):
 
             # then extract samples
             data = frame.to_ndarray()
-            samples.append(data[0])
+            samples = data[0]
+            # convert the samples from 32-bit floats (from -1 to 1)
+            # to 16-bit signed integers (from -32768 to 32767), unless
+            # the profile decodes to floats on purpose
+            if samples.dtype == np.float32 and DECODE_FORMAT is None:
+                samples *= 32767
+                samples = samples.astype(np.int16)
+            yield samples
 
             frame = next(data_stream)
     except ValueError:
@@ -171,14 +427,178 @@ def get_samples_from_file(fname):
     except Exception as e:
         err_type = str(type(e))
         print(f'Exception during extracting audio: {err_type}')
+    finally:
+        data_stream.close()
+        container.close()
+
+
+def get_fingerprints_streaming(source):
+    hashes, offsets = get_fingerprint_arrays_streaming(source)
+    return list(zip(hashes.tolist(), offsets.tolist()))
+
 
-    data_stream.close()
+def get_fingerprint_arrays_streaming(source):
+    """Fingerprints audio incrementally, holding only a few seconds of it in memory at a time.
 
-    samples = np.concatenate(samples)
-    # convert the samples from 32-bit floats (from -1 to 1)
-    # to 16-bit signed integers (from -32768 to 32767)
-    if samples.dtype == np.float32:
-        samples *= 32767
-        samples = samples.astype(np.int16)
+    Unlike :func:`get_fingerprint_arrays`, peaks are chosen per block of
+    :data:`STREAM_BLOCK_COLUMNS` spectrogram columns rather than across the whole song.
 
-    return samples
+    :param source: Path to the file, or a readable file object such as an S3 object reader.
+    :returns: * hashes - int64 array of fingerprint hashes
+              * offsets - time offset of each hash, sorted ascending, in the units of
+                :data:`FINGERPRINT_FORMAT`
+    """
+    hashes = [np.empty(0, dtype=np.int64)]
+    offsets = [np.empty(0, dtype=np.float64 if FINGERPRINT_FORMAT == 1 else np.int64)]
+    # decoding, spectrogram, peaks and hashing are interleaved, so they are timed as one stage
+    with stage('StreamingFingerprinting'):
+        for block_hashes, block_offsets in stream_fingerprints(source):
+            hashes.append(block_hashes)
+            offsets.append(block_offsets)
+        hashes, offsets = np.concatenate(hashes), np.concatenate(offsets)
+    count('Fingerprints', len(hashes))
+    return hashes, offsets
+
+
+def stream_fingerprints(source):
+    """Yields (hashes, offsets) arrays as audio is decoded from `source`, in time order."""
+    columns = stream_spectrogram(iter_sample_blocks(source))
+    return stream_hashes(stream_peaks(columns))
+
+
+def stream_spectrogram(sample_blocks, block_columns=STREAM_BLOCK_COLUMNS):
+    """Computes the spectrogram of a stream of sample blocks, `block_columns` columns at a time.
+
+    Samples are copied into a preallocated buffer. Once it holds enough samples for
+    `block_columns` columns they are transformed, and the overlap needed by the next column
+    is moved to the front of the buffer. The columns are the same as
+    :func:`file_to_spectrogram` would give for the whole input.
+
+    :param sample_blocks: Iterable of sample arrays, as from :func:`iter_sample_blocks`.
+    :param block_columns: How many spectrogram columns to compute at once.
+    :returns: Yields (f, t, Sxx) for each block of columns.
+    """
+    nperseg = FFT_NPERSEG
+    step = FRAME_HOP
+    span = nperseg + (block_columns - 1) * step
+    keep = nperseg - step
+
+    buffer = None
+    filled = 0
+    first_column = 0
+    for block in sample_blocks:
+        if buffer is None:
+            buffer = np.empty(span, dtype=block.dtype)
+        while len(block):
+            n = min(len(block), span - filled)
+            buffer[filled:filled + n] = block[:n]
+            filled += n
+            block = block[n:]
+            if filled == span:
+                yield _spectrogram_columns(buffer, first_column, nperseg, step)
+                buffer[:keep] = buffer[span - keep:]
+                filled = keep
+                first_column += block_columns
+
+    if buffer is not None and filled >= nperseg:
+        yield _spectrogram_columns(buffer[:filled], first_column, nperseg, step)
+
+
+def _spectrogram_columns(samples, first_column, nperseg, step):
+    f, _, Sxx = spectrogram(samples, SAMPLE_RATE, nperseg=nperseg)
+    f, Sxx = band_limit(f, Sxx)
+    # column times as scipy computes them for the whole input
+    columns = first_column + np.arange(Sxx.shape[1])
+    t = (nperseg / 2 + columns * step) / float(SAMPLE_RATE)
+    return f, t, Sxx
+
+
+def stream_peaks(columns, tile_size=STREAM_BLOCK_COLUMNS):
+    """Finds peaks in a stream of spectrogram columns, one tile of `tile_size` columns at a time.
+
+    Each tile keeps the strongest of its local maxima, with a budget based on the tile's
+    area and :data:`POINT_EFFICIENCY`. A tile is only processed once the PEAK_BOX_SIZE
+    columns after it have arrived, so the maxima are the same as for the whole spectrogram.
+
+    :param columns: Iterable of (f, t, Sxx) blocks, as from :func:`stream_spectrogram`.
+    :param tile_size: How many columns to select peaks from at once.
+    :returns: Yields (points, frontier), where points is an array of (frequency, time) peaks
+        and every peak earlier than time `frontier` has already been yielded.
+    """
+    halo = PEAK_BOX_SIZE
+    f = None
+    Sxx = None
+    t = None
+    # global column index of Sxx[:, 0], and of the first column not yet searched for peaks
+    first = 0
+    next_tile = 0
+    for f, block_t, block in columns:
+        if Sxx is None:
+            Sxx, t = block, block_t
+        else:
+            Sxx = np.concatenate((Sxx, block), axis=1)
+            t = np.concatenate((t, block_t))
+        while first + Sxx.shape[1] >= next_tile + tile_size + halo:
+            yield _tile_peaks(f, t, Sxx, first, next_tile, next_tile + tile_size)
+            next_tile += tile_size
+            # only the halo before the next tile is needed from here on
+            drop = max(next_tile - halo - first, 0)
+            Sxx, t = Sxx[:, drop:], t[drop:]
+            first += drop
+
+    if Sxx is None:
+        return
+    end = first + Sxx.shape[1]
+    while next_tile < end:
+        yield _tile_peaks(f, t, Sxx, first, next_tile, min(next_tile + tile_size, end))
+        next_tile += tile_size
+
+
+def _tile_peaks(f, t, Sxx, first, start, stop):
+    lo = max(start - PEAK_BOX_SIZE, first)
+    hi = min(stop + PEAK_BOX_SIZE, first + Sxx.shape[1])
+    block = Sxx[:, lo - first:hi - first]
+    y_peaks, x_peaks = _local_maxima(block, start - lo, stop - lo)
+    peak_values = block[y_peaks, x_peaks + (start - lo)]
+    peak_target = int((Sxx.shape[0] * (stop - start) / (PEAK_BOX_SIZE**2)) * POINT_EFFICIENCY)
+    _, y_peaks, x_peaks = _top_peaks(peak_values, y_peaks, x_peaks, stop - start, peak_target)
+    points = np.column_stack((f[y_peaks], t[x_peaks + (start - first)]))
+    frontier = t[stop - first] if stop - first < len(t) else np.inf
+    return points, frontier
+
+
+def stream_hashes(peak_blocks, fan_out=TARGET_FAN_OUT):
+    """Hashes a stream of peaks, as :func:`hash_points` would for all of them together.
+
+    An anchor is hashed once every peak that could be in its target zone has arrived. Peaks
+    are dropped once they can no longer be an anchor or a target.
+
+    :param peak_blocks: Iterable of (points, frontier), as from :func:`stream_peaks`.
+    :param fan_out: Optional cap on the number of targets paired with each anchor.
+    :returns: Yields (hashes, offsets) arrays, sorted by offset.
+    """
+    window = np.empty((0, 2), dtype=np.float64)
+    hashed = np.empty(0, dtype=bool)
+    for points, frontier in peak_blocks:
+        window = np.concatenate((window, points))
+        hashed = np.concatenate((hashed, np.zeros(len(points), dtype=bool)))
+
+        # same arithmetic as the end of the target zone in target_zone_pairs
+        ready = ~hashed & ((window[:, 1] + TARGET_START) + TARGET_T < frontier)
+        anchors, targets = target_zone_pairs(
+            window, TARGET_T, TARGET_F, TARGET_START, fan_out=fan_out
+        )
+        keep = ready[anchors]
+        anchors, targets = anchors[keep], targets[keep]
+        hashes, offsets = hash_pairs(window, anchors, targets)
+        order = np.argsort(offsets, kind='stable')
+        yield hashes[order], offsets[order]
+
+        hashed |= ready
+        if hashed.all():
+            # later peaks are later in time, so these can't be targets any more
+            window, hashed = window[:0], hashed[:0]
+        else:
+            cutoff = window[~hashed, 1].min() + TARGET_START
+            keep = ~hashed | (window[:, 1] >= cutoff)
+            window, hashed = window[keep], hashed[keep]
@@ -14,6 +14,8 @@ COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
+import os
+
 # FINGERPRINTS CONFIG:
 
 SAMPLE_RATE = 44100
@@ -53,3 +55,68 @@ FFT_WINDOW_SIZE = 0.2
 """ The number of seconds of audio to use in each spectrogram segment. Larger windows mean higher
 frequency resolution but lower time resolution in the spectrogram.
 """
+
+TARGET_FAN_OUT = None
+""" Optional cap on the number of targets paired with each anchor point (the ones closest in
+time are kept). None pairs every point in the target zone. Lower values mean fewer fingerprints
+and faster lookups, at some cost in accuracy.
+"""
+
+PEAK_TILE_SIZE = 4096
+""" The number of spectrogram time columns processed at once when searching for peaks.
+Long inputs are filtered in blocks of this many columns, which bounds memory use without
+changing the peaks found. None processes the whole spectrogram in one go.
+"""
+
+STREAM_FROM_S3 = False
+""" When True, objects are read from S3 with ranged requests and fingerprinted as they are
+decoded, instead of being downloaded to /tmp first. Memory use then stays flat regardless of
+the length of the audio. Peaks are chosen per block of STREAM_BLOCK_COLUMNS rather than across
+the whole file, so fingerprints differ slightly from the default mode.
+"""
+
+STREAM_BLOCK_COLUMNS = 256
+""" The number of spectrogram columns (roughly 45 seconds of audio) decoded and searched for
+peaks at a time when streaming.
+"""
+
+FINGERPRINT_FORMAT = int(os.environ.get('FingerprintFormat', 1))
+""" The format of fingerprint hashes and time offsets, set by the FingerprintFormat environment
+variable. Every stored fingerprint records the format it was made with, and lookups only match
+fingerprints of the current format, so an index can be rebuilt in a new format while the old one
+is still in use: re-index the songs with FingerprintFormat set to the new format (for example
+with bulk_indexing.py), then switch the functions over once every song has been re-indexed.
+1 - Python's hash() of the anchor and target frequencies; offsets in seconds.
+2 - anchor frequency, target frequency and time delta quantized and packed into 32 bits;
+    offsets in spectrogram frames.
+3 - as format 2, but with the reduced-rate profile: audio is decoded at REDUCED_SAMPLE_RATE
+    (instead of SAMPLE_RATE) as 32-bit floats, and spectrograms stop at REDUCED_MAX_FREQUENCY.
+    Decoding, the FFT and the spectrogram take roughly a quarter of the time and memory.
+Because the format is stored with the fingerprints (and in local index files), queries are only
+ever matched against songs indexed with the same profile.
+"""
+
+REDUCED_SAMPLE_RATE = 11025
+""" The decode sample rate in Hz for format 3. Must be at least twice REDUCED_MAX_FREQUENCY.
+16000 keeps a little more of the upper band, at some extra cost.
+"""
+
+REDUCED_MAX_FREQUENCY = 5000
+""" The highest frequency in Hz kept in format 3 spectrograms. Landmarks above this are ignored.
+"""
+
+HASH_FREQ_STEP = 10
+""" The width in Hz of each quantized frequency step in format 2 hashes. Frequencies are packed
+into 12 bits, so this must be at least (0.5 * SAMPLE_RATE) / 4096.
+"""
+
+# derived values - don't edit these
+REDUCED_PROFILE = FINGERPRINT_FORMAT == 3
+if REDUCED_PROFILE:
+    SAMPLE_RATE = REDUCED_SAMPLE_RATE
+MAX_FREQUENCY = REDUCED_MAX_FREQUENCY if REDUCED_PROFILE else None
+# sample format the decoder converts to - None keeps the decoder's own, which is then made 16-bit
+DECODE_FORMAT = 'flt' if REDUCED_PROFILE else None
+FFT_NPERSEG = int(SAMPLE_RATE * FFT_WINDOW_SIZE)
+FRAME_HOP = FFT_NPERSEG - FFT_NPERSEG // 8  # scipy's default spectrogram overlap
+TIMESTEPS_PER_SECOND = 1 if FINGERPRINT_FORMAT == 1 else SAMPLE_RATE / FRAME_HOP
@@ -14,36 +14,112 @@ COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
+from time import perf_counter
+_import_start = perf_counter()
+
+import os
+import sys
 import json
-from song_indexing import get_fingerprints_and_store
-from check_for_song_in_file import identify_song_in_file
-from check_for_song_in_stream import identify_song_in_stream
+from metrics import start_invocation, emit_metrics, get_metrics, stage, count
+from validation_utils import is_music_file
 
 INDEX_FOLDER = "songs_to_index"
 CHECK_FOLDER = "songs_to_check"
 STREAM_CHECK_FOLDER = "songs_to_check/streams/"
+TIMELINE_CHECK_FOLDER = "songs_to_check/timelines/"
+
+# The handler modules pull in NumPy, SciPy, PyAV and boto3, so they are only imported once an
+# event has been routed to them. Events for the wrong folder, or for files that aren't music,
+# are answered without loading any of them. The AWS clients are likewise created on first use
+HANDLER_MODULES = {
+    'CheckStream': ['check_for_song_in_stream', 'notifications'],
+    'CheckFile': ['check_for_song_in_file'],
+    'CheckTimeline': ['timeline_matching'],
+    'IndexSong': ['song_indexing'],
+}
+
+# time taken to import this module, charged to the first invocation in the container
+MAIN_IMPORT_SECONDS = perf_counter() - _import_start
+_cold_start = True
 
 
 def lambda_handler(event, context):
+    global _cold_start
 
     # print("Received event: " + json.dumps(event, indent=2))
     bucket = event['detail']['bucket']['name']
     key = event['detail']['object']['key']
 
+    # one metrics record is written for each invocation, however it ends
+    start_invocation(get_operation(key))
+    if _cold_start:
+        count('ColdStart')
+        get_metrics().add_stage('Import', MAIN_IMPORT_SECONDS)
+        _cold_start = False
+    try:
+        return handle_object(bucket, key)
+    finally:
+        emit_metrics()
+
+
+def get_operation(key):
+    # name of the operation for a key, used as the metrics dimension
+    fname = key.lower()
+    if fname.startswith(STREAM_CHECK_FOLDER):
+        return 'CheckStream'
+    elif fname.startswith(TIMELINE_CHECK_FOLDER):
+        return 'CheckTimeline'
+    elif fname.startswith(CHECK_FOLDER):
+        return 'CheckFile'
+    elif fname.startswith(INDEX_FOLDER):
+        return 'IndexSong'
+    return 'Unknown'
+
+
+def handle_object(bucket, key):
+
     fname = key.lower()
     if fname.startswith(STREAM_CHECK_FOLDER):
 
-        # get the stream name from the key
-        stream_name = key.replace(STREAM_CHECK_FOLDER, '')
-        identify_song_in_stream(stream_name, bucket, key)
+        if not is_music_file(key):
+            print(f'Skipping {key} in stream processor as it is not a music file')
+        else:
+            with stage('Import'):
+                from check_for_song_in_stream import identify_song_in_stream
+                from notifications import flush_notifications
+
+            # get the stream name from the key
+            stream_name = key.replace(STREAM_CHECK_FOLDER, '')
+            try:
+                identify_song_in_stream(stream_name, bucket, key)
+            finally:
+                flush_notifications()
         return {
             'statusCode': 200,
             'body': json.dumps(f'Successfully checked stream in {key} in bucket {bucket}')
         }
 
+    elif fname.startswith(TIMELINE_CHECK_FOLDER):
+
+        if not is_music_file(key):
+            print(f'Skipping {key} as it is not a music file')
+        else:
+            with stage('Import'):
+                from timeline_matching import identify_timeline_in_file
+            identify_timeline_in_file(bucket, key)
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f'Successfully checked recording {key} in bucket {bucket}')
+        }
+
     elif fname.startswith(CHECK_FOLDER):
 
-        identify_song_in_file(bucket, key)
+        if not is_music_file(key):
+            print(f'Skipping {key} as it is not a music file')
+        else:
+            with stage('Import'):
+                from check_for_song_in_file import identify_song_in_file
+            identify_song_in_file(bucket, key)
         return {
             'statusCode': 200,
             'body': json.dumps(f'Successfully checked file {key} in bucket {bucket}')
@@ -51,7 +127,11 @@ def lambda_handler(event, context):
 
     elif fname.startswith(INDEX_FOLDER):
 
-        get_fingerprints_and_store(bucket, key)
+        # silently ignore any files we can't process
+        if is_music_file(key):
+            with stage('Import'):
+                from song_indexing import get_fingerprints_and_store
+            get_fingerprints_and_store(bucket, key)
         return {
             'statusCode': 200,
             'body': json.dumps(f'Successful fingerprinting of {key} in bucket {bucket}')
@@ -62,3 +142,25 @@ def lambda_handler(event, context):
             'statusCode': 400,  # bad request
             'body': json.dumps(f'Files must be in either the {CHECK_FOLDER} or {INDEX_FOLDER} folders')
         }
+
+
+def import_report():
+    """Measures cold-start import time: this module on its own, then each operation's handler
+    modules, each in a fresh interpreter so shared dependencies are counted for every operation.
+
+    :returns: Dictionary of seconds taken to import, keyed by "main" and operation name.
+    """
+    import subprocess
+    script = 'from time import perf_counter; t = perf_counter(); import {}; print(perf_counter() - t)'
+    report = {}
+    for name, modules in [('main', ['main'])] + list(HANDLER_MODULES.items()):
+        output = subprocess.run([sys.executable, '-c', script.format(', '.join(modules))],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        report[name] = float(output.strip().splitlines()[-1])
+    return report
+
+
+if __name__ == '__main__':
+    # prints the import-time report as JSON, e.g. to record cold-start cost for each release
+    print(json.dumps(import_report(), indent=2))
@@ -15,35 +15,227 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 import numpy as np
+from fingerprinting_config import FINGERPRINT_FORMAT, TIMESTEPS_PER_SECOND
+from metrics import stage, count
 
 MINIMUM_SCORE_FOR_MATCH = 5
 
+# width of the offset histogram bins used for scoring, in timesteps. Format 1 database
+# timesteps are rounded to whole seconds, so that needs half-second bins. Format 2
+# timesteps are spectrogram frames (0.175 seconds) on both sides, so the bins can be tighter
+BIN_WIDTH = 0.5 if FINGERPRINT_FORMAT == 1 else 2
+
+# how many songs (by raw hit count) are fully scored before checking whether any other song
+# could still beat them
+PREFILTER_SONGS = 50
+
+
+class Matches:
+    """The matches for one query, as parallel arrays with one entry per pair of a database row
+    and a query fingerprint with the same hash.
+
+    :param song_ids: Song names, which `song_idxs` index into. May include songs with no pairs.
+    :param song_idxs: Song index of each pair.
+    :param db_times: Time offset in the song of each pair.
+    :param query_times: Time offset in the query of each pair.
+    """
+
+    def __init__(self, song_ids, song_idxs, db_times, query_times):
+        self.song_ids = song_ids
+        self.song_idxs = np.asarray(song_idxs, dtype=np.int64)
+        self.db_times = np.asarray(db_times, dtype=np.float64)
+        self.query_times = np.asarray(query_times, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.song_idxs)
+
+    @classmethod
+    def from_dict(cls, matches):
+        """Builds matches from a dictionary of song_id to list of offset pairs (db_offset, sample_offset)."""
+        song_ids = list(matches.keys())
+        counts = [len(offsets) for offsets in matches.values()]
+        pairs = np.array([pair for offsets in matches.values() for pair in offsets], dtype=np.float64)
+        pairs = pairs.reshape(-1, 2)
+        return cls(song_ids, np.repeat(np.arange(len(song_ids)), counts), pairs[:, 0], pairs[:, 1])
+
+    def to_dict(self):
+        """The matches as a dictionary of song_id to list of offset pairs (db_offset, sample_offset)."""
+        results = {}
+        order = np.argsort(self.song_idxs, kind='stable')
+        songs, split_at = np.unique(self.song_idxs[order], return_index=True)
+        for song, song_rows in zip(songs, np.split(order, split_at[1:])):
+            results[self.song_ids[song]] = list(zip(
+                self.db_times[song_rows].tolist(), self.query_times[song_rows].tolist()
+            ))
+        return results
+
+
+def match_postings(query_hashes, query_times, hashes, offsets):
+    """Pairs each query fingerprint with every stored row that has the same hash.
+
+    The stored rows are grouped by hash, with the rows for `hashes[i]` at positions
+    `offsets[i]:offsets[i+1]`. A hash can occur more than once in the query, and every
+    occurrence is paired with every row.
+
+    :param query_hashes: Hash of each query fingerprint.
+    :param query_times: Time offset in the query of each fingerprint.
+    :param hashes: Sorted, unique hashes of the stored rows.
+    :param offsets: Start of each hash's rows, with one more entry than `hashes`.
+    :returns: Row position and query time of each pair, and the number of unique query hashes
+        and of rows matched.
+    """
+    query_hashes = np.asarray(query_hashes, dtype=np.int64)
+    query_times = np.asarray(query_times, dtype=np.float64)
+
+    # group the query by hash
+    query_order = np.argsort(query_hashes, kind='stable')
+    unique_hashes, first, occurrences = np.unique(
+        query_hashes[query_order], return_index=True, return_counts=True
+    )
+
+    positions = np.searchsorted(hashes, unique_hashes)
+    positions[positions == len(hashes)] = 0
+    if len(hashes) > 0:
+        found = hashes[positions] == unique_hashes
+    else:
+        found = np.zeros(len(unique_hashes), dtype=bool)
+    starts = offsets[positions[found]]
+    counts = offsets[positions[found] + 1] - starts
+    first, occurrences = first[found], occurrences[found]
+
+    # expand each matched hash into the range of its rows
+    total = int(counts.sum())
+    matched = np.repeat(np.arange(len(counts)), counts)
+    rows = starts[matched] + (np.arange(total) - (np.cumsum(counts) - counts)[matched])
+
+    # and pair each row with every occurrence of its hash in the query
+    repeats = occurrences[matched]
+    pair_rows = np.repeat(rows, repeats)
+    pair_hashes = np.repeat(matched, repeats)
+    within = np.arange(len(pair_rows)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    return pair_rows, query_times[query_order[first[pair_hashes] + within]], len(unique_hashes), total
+
 
 def get_best_match(matches):
     """For a dictionary of song_id: offsets, returns the best song_id.
 
     Scores each song in the matches dictionary and then returns the song_id with the best score.
 
-    :param matches: Dictionary of song_id to list of offset pairs (db_offset, sample_offset)
-       as returned by :func:`~abracadabra.Storage.storage.get_matches`.
+    :param matches: :class:`Matches`, or a dictionary of song_id to list of offset pairs
+       (db_offset, sample_offset).
     :returns: song_id with the best score.
     :rtype: str
     """
-    matched_song = None
-    best_score = 0
-    for song_id, offsets in matches.items():
-        if len(offsets) < best_score:
-            # can't be best score, avoid expensive histogram
-            continue
-        score = score_match(offsets)
-        if score > best_score:
-            best_score = score
-            matched_song = song_id
+    ranked = rank_matches(matches, top_n=1)
+    if len(ranked) == 0:
+        return None, 0
+    matched_song, best_score, _ = ranked[0]
     if best_score < MINIMUM_SCORE_FOR_MATCH:
         return None, int(best_score)
     return matched_song, int(best_score)
 
 
+def rank_matches(matches, top_n=5):
+    """Ranks the songs in a dictionary of song_id: offsets.
+
+    :param matches: :class:`Matches`, or a dictionary of song_id to list of offset pairs
+       (db_offset, sample_offset).
+    :param top_n: How many songs to return.
+    :returns: List of (song_id, score, offset) for the best `top_n` songs, best first. The offset
+        is roughly where the query starts within the song, in seconds.
+    :rtype: list
+    """
+    if not isinstance(matches, Matches):
+        matches = Matches.from_dict(matches)
+    with stage('Scoring'):
+        songs, scores, offsets = score_songs(matches.song_idxs, matches.db_times, matches.query_times,
+                                             top_n=top_n)
+    return [(matches.song_ids[song], int(score), float(offset) / TIMESTEPS_PER_SECOND)
+            for song, score, offset in zip(songs, scores, offsets)]
+
+
+def score_songs(song_idxs, db_times, query_times, top_n=5, prefilter=PREFILTER_SONGS):
+    """Scores every candidate song at once.
+
+    Works like :func:`score_match` for all songs together: each song's score is the largest
+    bin of its histogram of time deltas, found with one sort over (song, delta bin) pairs.
+    Only the `prefilter` songs with the most hits are scored at first - a song's score can't
+    exceed its hit count, so any other song is only scored if its hit count could still get
+    it into the top `top_n`.
+
+    :param song_idxs: Integer song index of each matching hash.
+    :param db_times: Time offset in the song of each matching hash.
+    :param query_times: Time offset in the query of each matching hash.
+    :param top_n: How many songs to return.
+    :param prefilter: How many songs to score before checking whether the rest could matter.
+    :returns: Three arrays - song indices, scores and best offsets, best score first. Equal
+        scores keep the order of the song indices.
+    """
+    song_idxs = np.asarray(song_idxs, dtype=np.int64)
+    hits = np.bincount(song_idxs)
+    candidates = np.flatnonzero(hits)
+    # most hits first, lowest song index first among equals
+    candidates = candidates[np.argsort(-hits[candidates], kind='stable')]
+
+    scored = candidates[:prefilter]
+    songs, scores, offsets = _score(song_idxs, db_times, query_times, scored)
+    rest = candidates[prefilter:]
+    if len(rest) > 0:
+        bar = np.sort(scores)[::-1][top_n - 1] if len(scores) >= top_n else 0
+        rest = rest[hits[rest] >= bar]
+        if len(rest) > 0:
+            more = _score(song_idxs, db_times, query_times, rest)
+            songs, scores, offsets = (np.concatenate(pair) for pair in zip((songs, scores, offsets), more))
+    count('CandidateSongs', len(candidates))
+    count('SongsScored', len(songs))
+
+    order = np.lexsort((songs, -scores))[:top_n]
+    return songs[order], scores[order], offsets[order]
+
+
+def _score(song_idxs, db_times, query_times, songs):
+    """Best histogram bin (count and offset) for each of `songs`."""
+    songs = np.sort(songs)
+    selected = np.isin(song_idxs, songs)
+    song_idxs = song_idxs[selected]
+    deltas = np.asarray(db_times, dtype=np.float64)[selected] - np.asarray(query_times, dtype=np.float64)[selected]
+    if len(deltas) == 0:
+        return songs[:0], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    # like np.histogram in score_match, bins start at int() of each song's smallest delta
+    # (which drops deltas below that if it is negative)
+    order = np.argsort(song_idxs, kind='stable')
+    song_idxs, deltas = song_idxs[order], deltas[order]
+    starts = np.flatnonzero(np.r_[True, song_idxs[1:] != song_idxs[:-1]])
+    origins = np.trunc(np.minimum.reduceat(deltas, starts))
+    origin_per_delta = np.repeat(origins, np.diff(np.r_[starts, len(deltas)]))
+    keep = deltas >= origin_per_delta
+    bins = np.floor((deltas[keep] - origin_per_delta[keep]) / BIN_WIDTH).astype(np.int64)
+
+    # a song whose deltas were all dropped scores zero, as an empty histogram would
+    present = song_idxs[starts]
+    scores = np.zeros(len(present), dtype=np.int64)
+    offsets = origins.copy()
+    if not keep.any():
+        return present, scores, offsets
+
+    # count each (song, bin) pair, then take the biggest bin for each song
+    keys, bin_counts = np.unique((song_idxs[keep] << 32) | bins, return_counts=True)
+    key_songs = keys >> 32
+    key_starts = np.flatnonzero(np.r_[True, key_songs[1:] != key_songs[:-1]])
+    best_counts = np.maximum.reduceat(bin_counts, key_starts)
+
+    # the first (lowest) bin with the best count gives the offset
+    is_best = bin_counts == np.repeat(best_counts, np.diff(np.r_[key_starts, len(keys)]))
+    best_keys = keys[is_best]
+    best_keys = best_keys[np.r_[True, best_keys[1:] >> 32 != best_keys[:-1] >> 32]]
+
+    i = np.searchsorted(present, key_songs[key_starts])
+    scores[i] = best_counts
+    offsets[i] += (best_keys & 0xFFFFFFFF) * BIN_WIDTH
+    return present, scores, offsets
+
+
 def score_match(offsets):
     """Score a matched song.
 
@@ -55,8 +247,7 @@ def score_match(offsets):
     :returns: The highest peak in a histogram of time deltas
     :rtype: int
     """
-    # Use bins spaced 0.5 seconds apart
-    binwidth = 0.5
+    binwidth = BIN_WIDTH
     tks = list(map(lambda x: x[0] - x[1], offsets))
     hist, _ = np.histogram(tks,
                            bins=np.arange(int(min(tks)),
@@ -0,0 +1,169 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+# Per-invocation metrics.
+#
+# Stages are timed with `with stage('name'):` and counters bumped with count('Name', n). At the
+# end of each Lambda invocation emit_metrics() prints everything as a single CloudWatch Embedded
+# Metric Format (EMF) record, which CloudWatch Logs turns into metrics without any API calls.
+#
+# Setting the ProfileLatencyBudgetMs environment variable turns on a sampling profiler: while a
+# stage runs, a background thread samples the Python stacks, and if the stage takes longer than
+# the budget the most common stacks are printed.
+
+import os
+import sys
+import json
+import threading
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter, time
+
+METRICS_NAMESPACE = os.environ.get('MetricsNamespace', 'SongIdentification')
+PROFILE_LATENCY_BUDGET_MS = os.environ.get('ProfileLatencyBudgetMs')
+PROFILE_LATENCY_BUDGET_MS = float(PROFILE_LATENCY_BUDGET_MS) if PROFILE_LATENCY_BUDGET_MS else None
+# how often the profiler samples, how many frames of each stack it keeps, and how many
+# of the most common stacks it prints
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_STACK_DEPTH = 12
+PROFILE_TOP_STACKS = 5
+
+# units of the counters - anything not listed is a plain count
+COUNTER_UNITS = {
+    'BytesDownloaded': 'Bytes',
+}
+
+
+class Metrics:
+    """Stage durations and counters for one invocation. Safe to update from several threads,
+    so work done on thread pools adds to the same invocation.
+    """
+
+    def __init__(self, operation=None):
+        self.operation = operation
+        self.start_time = perf_counter()
+        self.stages = Counter()
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self.lock:
+            self.stages[name] += seconds
+
+    def add_count(self, name, n):
+        with self.lock:
+            self.counters[name] += n
+
+    def to_emf(self):
+        """Returns the metrics as a CloudWatch Embedded Metric Format record."""
+        with self.lock:
+            values = {f'{name}Time': round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+            values['InvocationTime'] = round((perf_counter() - self.start_time) * 1000, 3)
+            units = {name: 'Milliseconds' for name in values}
+            for name, n in self.counters.items():
+                values[name] = int(n)
+                units[name] = COUNTER_UNITS.get(name, 'Count')
+
+        dimensions = {'Operation': self.operation or 'unknown'}
+        return {
+            '_aws': {
+                'Timestamp': int(time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()],
+                }],
+            },
+            **dimensions,
+            **values,
+        }
+
+
+_metrics = Metrics()
+
+
+def start_invocation(operation):
+    # starts a fresh set of metrics, dropping anything recorded since the last one
+    global _metrics
+    _metrics = Metrics(operation)
+    return _metrics
+
+
+def get_metrics():
+    return _metrics
+
+
+def count(name, n=1):
+    _metrics.add_count(name, n)
+
+
+@contextmanager
+def stage(name):
+    # times the block, adding its duration to the stage. Durations of a stage that runs more
+    # than once (or on several threads at once) are summed
+    metrics = _metrics
+    profiler = StackSampler() if PROFILE_LATENCY_BUDGET_MS is not None else None
+    if profiler is not None:
+        profiler.start()
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start_time
+        metrics.add_stage(name, elapsed)
+        if profiler is not None:
+            profiler.stop()
+            if elapsed * 1000 > PROFILE_LATENCY_BUDGET_MS:
+                profiler.report(name, elapsed)
+
+
+def emit_metrics():
+    # prints the invocation's metrics as one EMF record
+    print(json.dumps(_metrics.to_emf()))
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of every other thread until stopped, counting identical stacks."""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = Counter()
+        self.total = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = traceback.extract_stack(frame)[-PROFILE_STACK_DEPTH:]
+                self.samples[tuple(f'{f.filename}:{f.lineno} {f.name}' for f in stack)] += 1
+            self.total += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def report(self, stage_name, elapsed):
+        print(f'Stage {stage_name} took {elapsed * 1000:.0f} ms, over its budget of '
+              f'{PROFILE_LATENCY_BUDGET_MS:.0f} ms. Hottest stacks from {self.total} samples:')
+        for stack, n in self.samples.most_common(PROFILE_TOP_STACKS):
+            print(f'  {n} samples:')
+            for line in stack:
+                print(f'    {line}')
@@ -0,0 +1,158 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import time
+from time import perf_counter
+from db_utils import run_command, ensure_schema
+
+# rows moved per statement. Each batch is its own transaction, so the tables stay available
+# for lookups and indexing throughout, and an interrupted migration carries on where it stopped
+MIGRATE_BATCH_ROWS = 10000
+# pause between batches, to leave the database some headroom while it's serving traffic
+MIGRATE_PAUSE_SECONDS = 0.0
+# print progress after this many batches
+REPORT_EVERY = 20
+# wait before trying again when every row left is locked by songs being re-indexed
+MIGRATE_RETRY_SECONDS = 1.0
+
+# moves the oldest batch of rows from the old fingerprints table into song_fingerprints, adding
+# their songs to the catalogue. Bumping the revision of each song touched means incremental
+# local index exports pick up its migrated rows. Rows locked by a song being re-indexed at the
+# same time are skipped, and deleted by that re-index
+MOVE_BATCH_SQL = \
+    "WITH batch AS (DELETE FROM fingerprints WHERE id IN (SELECT id FROM fingerprints " \
+    "WHERE songid IS NOT NULL ORDER BY id LIMIT {rows} FOR UPDATE SKIP LOCKED) " \
+    "RETURNING songid, version, hash, timestep), " \
+    "catalogued AS (INSERT INTO songs (songid, version) SELECT DISTINCT songid, version FROM batch " \
+    "ON CONFLICT (songid, version) DO UPDATE SET revision = nextval('song_revisions') " \
+    "RETURNING id, songid, version), " \
+    "moved AS (INSERT INTO song_fingerprints (hash, song, timestep) " \
+    "SELECT b.hash, c.id, b.timestep FROM batch b JOIN catalogued c USING (songid, version) RETURNING 1) " \
+    "SELECT COUNT(*) FROM moved;"
+ROWS_LEFT_SQL = "SELECT EXISTS (SELECT 1 FROM fingerprints WHERE songid IS NOT NULL);"
+
+# re-indexing a song deletes its rows from the old fingerprints table, which needs an index on
+# songid to avoid scanning the whole table. Building it takes far too long to do in a request,
+# so it is built here before the rows are moved, concurrently so the table stays writable
+SONG_INDEX_SQL = "CREATE INDEX CONCURRENTLY IF NOT EXISTS song_index ON fingerprints (songid, version);"
+SONG_INDEX_VALID_SQL = "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('song_index');"
+SONG_INDEX_BUILDING_SQL = "SELECT EXISTS (SELECT 1 FROM pg_stat_progress_create_index " \
+                          "WHERE index_relid = to_regclass('song_index'));"
+# how often to check whether the index has been built
+SONG_INDEX_POLL_SECONDS = 10.0
+
+
+def migrate_fingerprints(batch_rows=MIGRATE_BATCH_ROWS, pause=MIGRATE_PAUSE_SECONDS):
+    # moves every row out of the old fingerprints table, a batch at a time. Safe to run while
+    # songs are being indexed and identified, and to stop and run again at any point
+    ensure_schema()
+    build_song_index()
+    sql = MOVE_BATCH_SQL.format(rows=int(batch_rows))
+    start_time = perf_counter()
+    moved = batches = 0
+    while True:
+        rows = run_command(sql)[0][0]
+        if rows == 0:
+            # a batch skips locked rows, so it can move nothing while rows are still left
+            if not run_command(ROWS_LEFT_SQL)[0][0]:
+                break
+            print(f'Remaining rows are locked by songs being re-indexed, trying again in {MIGRATE_RETRY_SECONDS}s')
+            time.sleep(MIGRATE_RETRY_SECONDS)
+            continue
+        moved += rows
+        batches += 1
+        if batches % REPORT_EVERY == 0:
+            _report(moved, start_time)
+        if pause:
+            time.sleep(pause)
+
+    _report(moved, start_time)
+    # fresh statistics, so lookups plan the songs filter as a hash join
+    run_command("ANALYZE songs;")
+    run_command("ANALYZE song_fingerprints;")
+    remaining = run_command("SELECT COUNT(*) FROM fingerprints;")[0][0]
+    if remaining:
+        print(f'{remaining} rows without a songid were left in the fingerprints table')
+    else:
+        print('Migration complete. Run VACUUM song_fingerprints so lookups can use index-only scans '
+              'straight away, and drop the fingerprints table once no older code is running')
+    return moved
+
+
+def build_song_index():
+    # builds the old fingerprints table's index on songid, if it isn't there already. The Data
+    # API stops waiting after 45 seconds while the build carries on, so this waits for it to
+    # finish. An interrupted build leaves an invalid index, which is dropped and built again
+    exists, valid = _song_index_state()
+    if valid:
+        return
+    start_time = perf_counter()
+    if not _song_index_building():
+        if exists:
+            print('Dropping song_index left invalid by an interrupted build')
+            run_command("DROP INDEX CONCURRENTLY IF EXISTS song_index;")
+        print('Building song_index on the fingerprints table')
+        try:
+            run_command(SONG_INDEX_SQL, continue_after_timeout=True)
+        except Exception:
+            if not _song_index_building():
+                raise
+    while not _song_index_state()[1]:
+        if not _song_index_building():
+            raise RuntimeError('Building song_index failed - run again to retry')
+        time.sleep(SONG_INDEX_POLL_SECONDS)
+    print(f'Built song_index in {perf_counter() - start_time:.0f} seconds')
+
+
+def _song_index_state():
+    # whether song_index exists, and whether it is ready to use
+    rows = run_command(SONG_INDEX_VALID_SQL)
+    return len(rows) > 0, len(rows) > 0 and rows[0][0]
+
+
+def _song_index_building():
+    return run_command(SONG_INDEX_BUILDING_SQL)[0][0]
+
+
+def get_table_sizes():
+    # rows and on-disk sizes (table and indexes, in bytes) of the old and new fingerprint tables
+    sizes = {}
+    for table in ('fingerprints', 'song_fingerprints', 'songs'):
+        if not run_command(f"SELECT to_regclass('{table}') IS NOT NULL;")[0][0]:
+            continue
+        sql = f"SELECT COUNT(*), pg_table_size('{table}'), pg_indexes_size('{table}') FROM {table};"
+        rows, table_bytes, index_bytes = run_command(sql)[0]
+        sizes[table] = {'rows': rows, 'table_bytes': table_bytes, 'index_bytes': index_bytes}
+    return sizes
+
+
+def _report(moved, start_time):
+    elapsed = perf_counter() - start_time
+    rate = moved / elapsed if elapsed > 0 else 0.0
+    print(f'{moved} rows moved in {elapsed:.0f} seconds ({rate:.0f} rows/second)')
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Move fingerprints into the compact song_fingerprints table')
+    parser.add_argument('--batch-rows', type=int, default=MIGRATE_BATCH_ROWS, help='rows moved per statement')
+    parser.add_argument('--pause', type=float, default=MIGRATE_PAUSE_SECONDS, help='seconds to wait between batches')
+    parser.add_argument('--sizes', action='store_true', help='only print the sizes of the tables')
+    args = parser.parse_args()
+    if not args.sizes:
+        migrate_fingerprints(batch_rows=args.batch_rows, pause=args.pause)
+    print(json.dumps(get_table_sizes(), indent=2))
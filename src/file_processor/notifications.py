@@ -0,0 +1,136 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import json
+import threading
+import queue
+from time import sleep
+
+SNS_TOPIC = os.getenv('SNSNotificationTopic')
+# created on first use (see get_sns_client), so importing this module stays cheap
+sns_client = None
+_sns_client_lock = threading.Lock()
+
+# SNS accepts at most 10 messages per PublishBatch call
+PUBLISH_BATCH_SIZE = 10
+# attempts per message before giving up, and the delay before the first retry (doubled each time)
+PUBLISH_MAX_ATTEMPTS = 4
+PUBLISH_RETRY_DELAY = 0.1
+
+
+class NotificationDispatcher:
+    """Sends stream song change notifications to SNS on a background thread.
+
+    Notifications queued while a batch is being sent are sent together with PublishBatch.
+    Failed messages are retried with exponential backoff. Duplicates are not filtered here:
+    callers only notify when the database reports that a stream's song really changed (see
+    stream_state.py). Call :meth:`flush` before the Lambda invocation returns, so nothing is
+    left unsent when the container is frozen.
+    """
+
+    def __init__(self, topic_arn=SNS_TOPIC, client=None):
+        self.topic_arn = topic_arn
+        self.client = client if client is not None else get_sns_client()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self, info):
+        """Queues a notification, and returns without waiting for it to be sent.
+
+        :param info: Dictionary with at least a "stream" key, sent as the JSON message.
+        """
+        message = json.dumps(info)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._queue.put(message)
+
+    def flush(self):
+        # wait until everything queued so far has been sent (or has run out of retries)
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            messages = [self._queue.get()]
+            while len(messages) < PUBLISH_BATCH_SIZE:
+                try:
+                    messages.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._publish(messages)
+            except Exception as e:
+                print(f'Failed to send {len(messages)} notifications: {e}')
+            finally:
+                for _ in messages:
+                    self._queue.task_done()
+
+    def _publish(self, messages):
+        pending = {str(i): message for i, message in enumerate(messages)}
+        delay = PUBLISH_RETRY_DELAY
+        for attempt in range(PUBLISH_MAX_ATTEMPTS):
+            if attempt > 0:
+                sleep(delay)
+                delay *= 2
+            entries = [{'Id': i, 'Message': message} for i, message in pending.items()]
+            try:
+                response = self.client.publish_batch(TopicArn=self.topic_arn, PublishBatchRequestEntries=entries)
+            except Exception as e:
+                print(f'PublishBatch attempt {attempt + 1} failed: {e}')
+                continue
+            failed = response.get('Failed', [])
+            # only retry the failures SNS says are worth retrying
+            pending = {f['Id']: pending[f['Id']] for f in failed if not f.get('SenderFault')}
+            print(f'Sent {len(entries) - len(failed)} of {len(entries)} notifications')
+            for f in failed:
+                if f.get('SenderFault'):
+                    print(f'Notification rejected: {f.get("Code")} {f.get("Message")}')
+            if not pending:
+                return
+        print(f'Giving up on {len(pending)} notifications after {PUBLISH_MAX_ATTEMPTS} attempts')
+
+
+_dispatcher = None
+
+
+def get_sns_client():
+    global sns_client
+    if sns_client is None:
+        # created once, from its own session, as boto3's default session isn't thread-safe
+        with _sns_client_lock:
+            if sns_client is None:
+                from boto3.session import Session
+                sns_client = Session().client(service_name='sns')
+    return sns_client
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = NotificationDispatcher()
+    return _dispatcher
+
+
+def send_notification(info):
+    get_dispatcher().notify(info)
+
+
+def flush_notifications():
+    if _dispatcher is not None:
+        _dispatcher.flush()
@@ -0,0 +1,190 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+# PostgreSQL fingerprint storage through a pool of direct database connections.
+#
+# Uses the same schema and SQL as the RDS Data API backend (db_utils.DataApiStorage), but sends
+# statements over connections held open by the container, so each statement costs a round trip
+# on the VPC rather than an HTTPS request. Needs the psycopg2 driver, and network access to the
+# database from the functions. Set StorageBackend=postgres to use it.
+#
+# Connection settings come from DatabaseUrl (a libpq connection string or postgresql:// URL),
+# or otherwise from the database secret (SecretArn), with DBName and, if the secret has no
+# host, DBHost.
+
+from contextlib import contextmanager
+from functools import lru_cache
+from time import monotonic
+import os
+import re
+import json
+import uuid
+import threading
+import numpy as np
+from db_utils import PostgresStorage
+
+DatabaseUrl = os.environ.get('DatabaseUrl')
+DBHost = os.environ.get('DBHost')
+DBName = os.environ.get('DBName')
+SecretArn = os.environ.get('SecretArn')
+
+# connections the pool holds open at most. Callers wait for a free one rather than failing,
+# so this also caps the load one container puts on the database
+POOL_MAX_CONNECTIONS = 8
+# connections idle for longer than this are checked before use, and replaced if the
+# database has closed them
+POOL_PING_IDLE_SECONDS = 60
+# seconds to wait when opening a connection
+CONNECT_TIMEOUT_SECONDS = 10
+
+# :name parameters, but not :: casts
+NAMED_PARAMETER = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+
+class PooledPostgresStorage(PostgresStorage):
+    """PostgreSQL through a pool of direct connections, shared by the threads of a container.
+
+    :param dsn: Connection string. By default it is built from the environment (see above).
+    :param max_connections: Most connections to hold open at once.
+    """
+
+    def __init__(self, dsn=None, max_connections=POOL_MAX_CONNECTIONS):
+        super().__init__()
+        self._dsn = dsn or get_dsn()
+        # connections are opened as they are needed, up to max_connections. Callers wait for a
+        # free one rather than failing
+        self._slots = threading.BoundedSemaphore(max_connections)
+        # idle connections, with when each was last used. The most recently used is reused first
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._transactions = {}
+
+    def execute(self, sql, parameters=None, transaction_id=None, compact=False, continue_after_timeout=False):
+        # rows come back as tuples of Python values already, so compact makes no difference, and
+        # statements are never cut short, so neither does continue_after_timeout
+        if transaction_id is not None:
+            return _run(self._transactions[transaction_id], sql, parameters)
+        with self._connection() as connection:
+            return _run(connection, sql, parameters)
+
+    def begin_transaction(self):
+        connection = self._checkout()
+        try:
+            _run(connection, 'BEGIN;')
+        except Exception:
+            self._checkin(connection)
+            raise
+        transaction_id = uuid.uuid4().hex
+        self._transactions[transaction_id] = connection
+        return transaction_id
+
+    def commit_transaction(self, transaction_id):
+        connection = self._transactions.pop(transaction_id)
+        try:
+            _run(connection, 'COMMIT;')
+        finally:
+            self._checkin(connection)
+
+    def rollback_transaction(self, transaction_id):
+        connection = self._transactions.pop(transaction_id)
+        try:
+            _run(connection, 'ROLLBACK;')
+        finally:
+            self._checkin(connection)
+
+    def close(self):
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            connection.close()
+
+    @contextmanager
+    def _connection(self):
+        connection = self._checkout()
+        try:
+            yield connection
+        finally:
+            self._checkin(connection)
+
+    def _checkout(self):
+        # an idle connection, or a new one. Connections run in autocommit mode; transactions
+        # are begun explicitly
+        self._slots.acquire()
+        try:
+            while True:
+                with self._idle_lock:
+                    connection, last_used = self._idle.pop() if self._idle else (None, None)
+                if connection is None:
+                    import psycopg2
+                    connection = psycopg2.connect(self._dsn, connect_timeout=CONNECT_TIMEOUT_SECONDS)
+                    connection.autocommit = True
+                    return connection
+                if monotonic() - last_used <= POOL_PING_IDLE_SECONDS or _is_alive(connection):
+                    return connection
+                print('Replacing a closed database connection')
+                connection.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, connection):
+        # broken connections are closed rather than going back into the pool
+        if connection.closed == 0:
+            with self._idle_lock:
+                self._idle.append((connection, monotonic()))
+        self._slots.release()
+
+
+def _is_alive(connection):
+    import psycopg2
+    try:
+        _run(connection, 'SELECT 1;')
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+
+def _run(connection, sql, parameters=None):
+    with connection.cursor() as cursor:
+        if parameters:
+            cursor.execute(_pyformat(sql), {name: _python_value(value) for name, value in parameters.items()})
+        else:
+            cursor.execute(sql)
+        return cursor.fetchall() if cursor.description else []
+
+
+@lru_cache(maxsize=256)
+def _pyformat(sql):
+    # the statement with :name parameters in psycopg2's %(name)s style
+    return NAMED_PARAMETER.sub(r'%(\1)s', sql.replace('%', '%%'))
+
+
+def _python_value(value):
+    # psycopg2 doesn't know how to send NumPy scalars
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def get_dsn():
+    if DatabaseUrl:
+        return DatabaseUrl
+    if SecretArn is None:
+        raise KeyError('DatabaseUrl or SecretArn environment variable must be set')
+    from boto3.session import Session
+    secret = json.loads(Session().client(service_name='secretsmanager')
+                        .get_secret_value(SecretId=SecretArn)['SecretString'])
+    from psycopg2.extensions import make_dsn
+    return make_dsn(host=secret.get('host', DBHost), port=secret.get('port', 5432),
+                    dbname=DBName or secret.get('dbname'), user=secret['username'], password=secret['password'])
@@ -0,0 +1,100 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import numpy as np
+from contextlib import closing
+from fingerprinting import iter_sample_blocks
+from fingerprinting_config import SAMPLE_RATE, STREAM_FROM_S3
+from matching import MINIMUM_SCORE_FOR_MATCH
+from metrics import count
+from s3_utils import downloaded_from_s3, open_s3_object
+from stream_session import StreamSession
+
+# seconds of audio fingerprinted, looked up and scored in each step
+PROGRESSIVE_WINDOW_SECONDS = 5
+# identification stops once the best song scores at least MINIMUM_SCORE_FOR_MATCH, and at least
+# this much more than the runner-up
+PROGRESSIVE_MARGIN = 10
+
+
+def identify_progressively(source, window_seconds=PROGRESSIVE_WINDOW_SECONDS, margin=PROGRESSIVE_MARGIN):
+    """Identifies the song in a file a window at a time, stopping as soon as the result is clear.
+
+    Each window is fingerprinted together with the end of the one before (see
+    :class:`StreamSession`), its new hashes are looked up, and everything so far is scored.
+    Decoding stops once the best song is a clear winner, so a long file is usually identified
+    from its first few windows. Since peaks are picked per window, scores can differ slightly
+    from fingerprinting the whole file at once.
+
+    :param source: Path to the file, or a readable file object such as an S3 object reader.
+    :param window_seconds: Seconds of audio added in each step.
+    :param margin: How far the best score must be ahead of the runner-up to stop early.
+    :returns: (song_id, score, seconds, complete) - song_id is None if nothing scores at least
+        MINIMUM_SCORE_FOR_MATCH, seconds is how much audio was used, and complete is True if
+        the whole file was used.
+    """
+    session = StreamSession(str(source), window_segments=None)
+    consumed = 0
+    complete = True
+    with closing(_iter_windows(source, int(window_seconds * SAMPLE_RATE))) as windows:
+        for samples in windows:
+            session.add_samples(samples)
+            consumed += len(samples)
+            ranked = session.top_matches(top_n=2)
+            if _is_clear_winner(ranked, margin):
+                complete = False
+                break
+
+    count('ProgressiveWindows', len(session.window))
+    song_id, score = session.best_match()
+    return song_id, score, consumed / SAMPLE_RATE, complete
+
+
+def identify_s3_object_progressively(bucket, key):
+    """Progressively identifies an object in S3, streaming it or downloading it to /tmp first,
+    depending on :data:`STREAM_FROM_S3`. When streaming, only the ranges needed are fetched.
+    """
+    if STREAM_FROM_S3:
+        with open_s3_object(bucket, key) as source:
+            return identify_progressively(source)
+    with downloaded_from_s3(bucket, key) as local_fname:
+        return identify_progressively(local_fname)
+
+
+def _is_clear_winner(ranked, margin):
+    if len(ranked) == 0 or ranked[0][1] < MINIMUM_SCORE_FOR_MATCH:
+        return False
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    return ranked[0][1] - runner_up >= margin
+
+
+def _iter_windows(source, window_samples):
+    # regroups the decoded sample blocks into windows of window_samples (the last may be short)
+    pending = []
+    pending_samples = 0
+    with closing(iter_sample_blocks(source)) as blocks:
+        for block in blocks:
+            pending.append(block)
+            pending_samples += len(block)
+            if pending_samples >= window_samples:
+                samples = np.concatenate(pending)
+                for start in range(0, len(samples) - window_samples + 1, window_samples):
+                    yield samples[start:start + window_samples]
+                rest = samples[len(samples) - len(samples) % window_samples:]
+                pending = [rest]
+                pending_samples = len(rest)
+    if pending_samples > 0:
+        yield np.concatenate(pending)
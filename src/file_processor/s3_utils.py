@@ -14,21 +14,138 @@ COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
-from cmtimer import CMtimer
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import io
+import os
 import pathlib
-import boto3
+import tempfile
+import threading
+from metrics import stage, count
 
-s3 = boto3.client('s3')
+# created on first use (see get_s3_client), so importing this module stays cheap
+s3 = None
+_s3_lock = threading.Lock()
+
+# size of each ranged GET when streaming an object
+RANGE_READ_SIZE = 1024 * 1024
+
+
+def get_s3_client():
+    global s3
+    if s3 is None:
+        # worker threads can ask for the client at the same time, and boto3's shared default
+        # session isn't safe to create clients from concurrently
+        with _s3_lock:
+            if s3 is None:
+                from boto3.session import Session
+                s3 = Session().client(service_name='s3')
+    return s3
 
 
 def download_from_s3_to_local(bucket, key):
+    # each download gets a file of its own, as keys in different folders can share a name
+    # and several can be downloaded at once. The caller removes it (see downloaded_from_s3)
     pathinfo = pathlib.PurePath(key)
-    local_fname = '/tmp/' + pathinfo.name
-    with CMtimer(f"Downloading {key} from bucket {bucket}"):
-        s3.download_file(bucket, key, local_fname)
+    fd, local_fname = tempfile.mkstemp(suffix=pathinfo.suffix, dir='/tmp')
+    os.close(fd)
+    with stage('Download'):
+        get_s3_client().download_file(bucket, key, local_fname)
+    count('BytesDownloaded', os.path.getsize(local_fname))
     return local_fname
 
 
+@contextmanager
+def downloaded_from_s3(bucket, key):
+    # downloads an object to a temporary file, which is removed afterwards
+    local_fname = download_from_s3_to_local(bucket, key)
+    try:
+        yield local_fname
+    finally:
+        os.remove(local_fname)
+
+
 def send_text_to_s3(bucket, key, text):
-    with CMtimer(f"Sending {key} to bucket {bucket}"):
-        s3.put_object(Bucket=bucket, Key=key, Body=text)
+    with stage('Upload'):
+        get_s3_client().put_object(Bucket=bucket, Key=key, Body=text)
+
+
+class S3ObjectReader(io.RawIOBase):
+    """A read-only, seekable file object over an S3 object.
+
+    The object is fetched in RANGE_READ_SIZE pieces with ranged GETs. While the caller
+    works on one piece, the next one is fetched in the background, so downloading
+    overlaps with whatever is reading (e.g. decoding audio).
+    """
+
+    def __init__(self, bucket, key, range_size=RANGE_READ_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.range_size = range_size
+        self.size = get_s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.position = 0
+        self._range_start = 0
+        self._range = b''
+        self._prefetch = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence value {whence}')
+        self.position = max(self.position, 0)
+        return self.position
+
+    def readinto(self, b):
+        if self.position >= self.size:
+            return 0
+        if not self._range_start <= self.position < self._range_start + len(self._range):
+            self._load_range(self.position)
+        offset = self.position - self._range_start
+        n = min(len(b), len(self._range) - offset)
+        b[:n] = self._range[offset:offset + n]
+        self.position += n
+        return n
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+    def _fetch(self, start):
+        end = min(start + self.range_size, self.size) - 1
+        response = get_s3_client().get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{end}')
+        data = response['Body'].read()
+        count('BytesDownloaded', len(data))
+        return data
+
+    def _load_range(self, start):
+        if self._prefetch is not None and self._prefetch[0] == start:
+            data = self._prefetch[1].result()
+        else:
+            data = self._fetch(start)
+        self._range_start = start
+        self._range = data
+
+        next_start = start + len(data)
+        if next_start < self.size:
+            self._prefetch = (next_start, self._executor.submit(self._fetch, next_start))
+        else:
+            self._prefetch = None
+
+
+def open_s3_object(bucket, key):
+    return S3ObjectReader(bucket, key)
@@ -15,9 +15,9 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 import pathlib
-from db_utils import store_fingerprints_to_db
-from s3_utils import download_from_s3_to_local
-from fingerprinting import get_fingerprints
+from db_utils import store_fingerprints_to_db, get_indexed_content_key
+from fingerprint_cache import get_content_key_for_s3_object, get_fingerprints_for_s3_object_cached
+from metrics import count
 from validation_utils import is_music_file
 
 
@@ -27,14 +27,20 @@ def get_fingerprints_and_store(bucket, key):
     if not is_music_file(key):
         return
 
-    local_fname = download_from_s3_to_local(bucket, key)
-
     # get the name of the file (sans extention) as the ID, and
     # create fingerprints for song and store to DB
     pathinfo = pathlib.PurePath(key)
     songid = pathinfo.stem
-    file_fingerprints = get_fingerprints(local_fname)
+
+    # indexing is idempotent - content that is already indexed is skipped, and changed
+    # content replaces the song's fingerprints
+    content_key = get_content_key_for_s3_object(bucket, key)
+    if get_indexed_content_key(songid) == content_key:
+        print(f'{songid} is already indexed from this content, skipping')
+        count('SongsUnchanged')
+        return
+    file_fingerprints = get_fingerprints_for_s3_object_cached(bucket, key, content_key)
 
     print(f'{songid} has {len(file_fingerprints)} fingerprints')
 
-    store_fingerprints_to_db(songid, file_fingerprints)
+    store_fingerprints_to_db(songid, file_fingerprints, content_key=content_key)
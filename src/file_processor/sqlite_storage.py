@@ -0,0 +1,201 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+# SQLite fingerprint storage, in a single local file.
+#
+# A reference implementation of the storage interface (storage.py) with no server to run, for
+# local development, tests and trying out changes to the matching. It keeps the same tables as
+# the PostgreSQL schema, and gives the same results for every operation. Set
+# StorageBackend=sqlite, and SQLitePath to choose the file.
+
+from contextlib import contextmanager
+from time import monotonic
+import os
+import json
+import sqlite3
+import threading
+import numpy as np
+from fingerprinting_config import FINGERPRINT_FORMAT
+from db_utils import STOP_HASH_MAX_FRACTION, STOP_HASH_MIN_SONGS, STOP_HASH_REFRESH_SECONDS
+from storage import FingerprintStorage
+
+SQLitePath = os.environ.get('SQLitePath', 'fingerprints.sqlite3')
+
+# each entry upgrades the schema by one version, recorded in the file's user_version
+SCHEMA_MIGRATIONS = [
+    [
+        "CREATE TABLE songs (id INTEGER PRIMARY KEY AUTOINCREMENT, songid TEXT NOT NULL, "
+        "version INT NOT NULL, content_key TEXT, indexed_at TEXT DEFAULT CURRENT_TIMESTAMP, "
+        "UNIQUE (songid, version));",
+        "CREATE TABLE song_fingerprints (hash INTEGER NOT NULL, song INTEGER NOT NULL, timestep INTEGER NOT NULL);",
+        "CREATE INDEX song_fingerprints_lookup ON song_fingerprints (hash, song, timestep);",
+        "CREATE INDEX song_fingerprints_song ON song_fingerprints (song);",
+        "CREATE TABLE hash_stats (version INT NOT NULL, hash INTEGER NOT NULL, songs INT NOT NULL, "
+        "rowcount INT NOT NULL, PRIMARY KEY (version, hash)) WITHOUT ROWID;",
+        "CREATE TABLE catalogue_stats (version INT PRIMARY KEY, songs INT NOT NULL);",
+        "CREATE TABLE streams (streamid TEXT PRIMARY KEY, songid TEXT);",
+    ],
+]
+
+STOP_HASHES_SQL = "SELECT hash, rowcount FROM hash_stats WHERE version = :version AND songs >= :minsongs " \
+                  "AND songs > :maxfraction * (SELECT songs FROM catalogue_stats WHERE version = :version);"
+
+
+class SQLiteStorage(FingerprintStorage):
+    """Fingerprints in an SQLite file. One connection is shared by every thread, taking turns.
+
+    :param path: Database file, or ':memory:' for a database that lasts as long as the object.
+    """
+
+    def __init__(self, path=SQLitePath):
+        # statements are run in autocommit mode, with transactions begun explicitly
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        self._schema_ready = False
+        self._stop_hashes = {}
+        self._stop_hashes_expiry = 0
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode = WAL;')
+
+    def ensure_schema(self):
+        if self._schema_ready:
+            return
+        with self._lock:
+            version = self._db.execute('PRAGMA user_version;').fetchone()[0]
+            for cmds in SCHEMA_MIGRATIONS[version:]:
+                version += 1
+                with self._transaction():
+                    for cmd in cmds:
+                        self._db.execute(cmd)
+                    self._db.execute(f'PRAGMA user_version = {version};')
+                print(f'Migrated schema to version {version}')
+            self._schema_ready = True
+
+    def store_fingerprints(self, songid, hashes, timesteps, content_key=None):
+        # the old and new rows give the change to the hash statistics, worked out here rather
+        # than in SQL. Timesteps are rounded as PostgreSQL rounds them into an INT column
+        self.ensure_schema()
+        timesteps = np.floor(np.asarray(timesteps, dtype=np.float64) + 0.5).astype(np.int64)
+        with self._lock, self._transaction():
+            song = self._db.execute(
+                "INSERT INTO songs (songid, version, content_key) VALUES (?, ?, ?) "
+                "ON CONFLICT (songid, version) DO UPDATE SET content_key = excluded.content_key, "
+                "indexed_at = CURRENT_TIMESTAMP RETURNING id;",
+                (songid, FINGERPRINT_FORMAT, content_key)).fetchone()[0]
+            old_hashes = np.array([row[0] for row in self._db.execute(
+                "SELECT hash FROM song_fingerprints WHERE song = ?;", (song,))], dtype=np.int64)
+            self._db.execute("DELETE FROM song_fingerprints WHERE song = ?;", (song,))
+            self._db.executemany("INSERT INTO song_fingerprints (hash, song, timestep) VALUES (?, ?, ?);",
+                                 zip(hashes.tolist(), [song] * len(hashes), timesteps.tolist()))
+
+            new_unique, new_counts = np.unique(hashes, return_counts=True)
+            old_unique, old_counts = np.unique(old_hashes, return_counts=True)
+            changed = np.union1d(new_unique, old_unique)
+            songs = np.isin(changed, new_unique).astype(np.int64) - np.isin(changed, old_unique)
+            rowcount = np.zeros(len(changed), dtype=np.int64)
+            rowcount[np.searchsorted(changed, new_unique)] += new_counts
+            rowcount[np.searchsorted(changed, old_unique)] -= old_counts
+            self._db.executemany(
+                "INSERT INTO hash_stats (version, hash, songs, rowcount) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (version, hash) DO UPDATE SET songs = songs + excluded.songs, "
+                "rowcount = rowcount + excluded.rowcount;",
+                zip([FINGERPRINT_FORMAT] * len(changed), changed.tolist(), songs.tolist(), rowcount.tolist()))
+            self._db.execute(
+                "INSERT INTO catalogue_stats (version, songs) VALUES (?, ?) "
+                "ON CONFLICT (version) DO UPDATE SET songs = songs + excluded.songs;",
+                (FINGERPRINT_FORMAT, 0 if len(old_hashes) > 0 else 1))
+        return int(len(hashes) > 0)
+
+    def get_indexed_content_key(self, songid):
+        self.ensure_schema()
+        return self._fetch_value("SELECT content_key FROM songs WHERE songid = ? AND version = ?;",
+                                 (songid, FINGERPRINT_FORMAT))
+
+    def select_fingerprints_for_hashes(self, hashes):
+        # identical rows are grouped and counted, as the PostgreSQL backend does
+        sql = "SELECT f.hash, s.songid, f.timestep, COUNT(*) FROM song_fingerprints f " \
+              "JOIN songs s ON s.id = f.song " \
+              "WHERE f.hash IN (SELECT value FROM json_each(?)) AND s.version = ? " \
+              "GROUP BY f.hash, f.song, f.timestep ORDER BY f.hash, f.song, f.timestep;"
+        with self._lock:
+            rows = self._db.execute(sql, (json.dumps(hashes.tolist()), FINGERPRINT_FORMAT)).fetchall()
+        found, songs, timesteps, counts = zip(*rows) if rows else ((),) * 4
+        song_ids, song_idxs = np.unique(np.array(songs, dtype=str), return_inverse=True)
+        return (song_ids.tolist(), np.array(found, dtype=np.int64), song_idxs.astype(np.int64),
+                np.array(timesteps, dtype=np.int64), np.array(counts, dtype=np.int64))
+
+    def get_stop_hashes(self):
+        # cached like the PostgreSQL backend's, but refreshed whenever this object stores a song
+        if monotonic() < self._stop_hashes_expiry:
+            return self._stop_hashes
+        parameters = {
+            'version': FINGERPRINT_FORMAT,
+            'minsongs': STOP_HASH_MIN_SONGS,
+            'maxfraction': STOP_HASH_MAX_FRACTION,
+        }
+        with self._lock:
+            self._stop_hashes = dict(self._db.execute(STOP_HASHES_SQL, parameters).fetchall())
+        self._stop_hashes_expiry = monotonic() + STOP_HASH_REFRESH_SECONDS
+        print(f'Loaded {len(self._stop_hashes)} stop hashes')
+        return self._stop_hashes
+
+    def rebuild_hash_stats(self):
+        self.ensure_schema()
+        rows = "SELECT s.version, f.hash, s.songid FROM song_fingerprints f JOIN songs s ON s.id = f.song"
+        with self._lock, self._transaction():
+            self._db.execute("DELETE FROM hash_stats;")
+            self._db.execute("DELETE FROM catalogue_stats;")
+            self._db.execute("INSERT INTO hash_stats (version, hash, songs, rowcount) "
+                             f"SELECT version, hash, COUNT(DISTINCT songid), COUNT(*) FROM ({rows}) "
+                             "GROUP BY version, hash;")
+            self._db.execute("INSERT INTO catalogue_stats (version, songs) "
+                             f"SELECT version, COUNT(DISTINCT songid) FROM ({rows}) GROUP BY version;")
+
+    def get_last_song_for_stream(self, streamid):
+        self.ensure_schema()
+        return self._fetch_value("SELECT songid FROM streams WHERE streamid = ?;", (streamid,))
+
+    def store_song_for_stream(self, streamid, songid):
+        # returns a row only if it wrote one, as in the PostgreSQL backend
+        self.ensure_schema()
+        sql = "INSERT INTO streams (streamid, songid) VALUES (?, ?) " \
+              "ON CONFLICT (streamid) DO UPDATE SET songid = excluded.songid " \
+              "WHERE streams.songid IS NOT excluded.songid RETURNING songid;"
+        with self._lock:
+            return len(self._db.execute(sql, (streamid, songid)).fetchall()) > 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _fetch_value(self, sql, parameters):
+        with self._lock:
+            row = self._db.execute(sql, parameters).fetchone()
+        return row[0] if row is not None else None
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE ... COMMIT, rolled back on error. Also expires the stop hash cache, as
+        # the transaction may have changed the hash statistics
+        self._db.execute('BEGIN IMMEDIATE;')
+        try:
+            yield
+            self._db.execute('COMMIT;')
+        except BaseException:
+            self._db.execute('ROLLBACK;')
+            raise
+        finally:
+            self._stop_hashes_expiry = 0
@@ -0,0 +1,128 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import importlib
+import threading
+
+# which backend stores fingerprints and stream state:
+#   dataapi  - Aurora PostgreSQL through the RDS Data API (db_utils.DataApiStorage)
+#   postgres - PostgreSQL through a pool of direct connections (postgres_storage.py)
+#   sqlite   - an embedded SQLite file, for local runs and tests (sqlite_storage.py)
+STORAGE_BACKEND = os.environ.get('StorageBackend', 'dataapi')
+
+# module and class of each backend. Modules are imported only when their backend is used,
+# so a backend's driver is only needed where it is configured
+BACKENDS = {
+    'dataapi': ('db_utils', 'DataApiStorage'),
+    'postgres': ('postgres_storage', 'PooledPostgresStorage'),
+    'sqlite': ('sqlite_storage', 'SQLiteStorage'),
+}
+
+
+class FingerprintStorage:
+    """Where fingerprints and stream state are kept. A backend implements every method here;
+    :mod:`db_utils` builds lookups, scoring input and statistics on top of them.
+
+    Backends are created once per container (see :func:`get_storage`), so connections and
+    caches are reused across invocations, and must be safe to use from several threads.
+    """
+
+    def ensure_schema(self):
+        """Creates or upgrades the schema if needed. Cheap to call again once it has run."""
+        raise NotImplementedError
+
+    def store_fingerprints(self, songid, hashes, timesteps, content_key=None):
+        """Replaces all of a song's fingerprints in the current format, as one atomic change,
+        and updates the hash statistics to match.
+
+        :param songid: Name of the song.
+        :param hashes: Array of the hash of each fingerprint.
+        :param timesteps: Array of the time offset of each fingerprint.
+        :param content_key: Key of the content the fingerprints were made from, or None.
+        :returns: Number of batches the rows were written in.
+        """
+        raise NotImplementedError
+
+    def get_indexed_content_key(self, songid):
+        """The content key the song was last indexed from in the current format, or None."""
+        raise NotImplementedError
+
+    def select_fingerprints_for_hashes(self, hashes):
+        """Fetches every fingerprint row in the current format for a batch of hashes.
+
+        :param hashes: Array of unique hashes.
+        :returns: (song_ids, hashes, song_idxs, timesteps, counts) - a list of song names, then
+            arrays of the hash, song (indexing into the names), timestep and number of
+            identical rows, in hash order.
+        """
+        raise NotImplementedError
+
+    def get_stop_hashes(self):
+        """The stop hashes for the current format, as {hash: rows} - hashes found in more than
+        STOP_HASH_MAX_FRACTION of the catalogue's songs, and in at least STOP_HASH_MIN_SONGS.
+        """
+        raise NotImplementedError
+
+    def rebuild_hash_stats(self):
+        """Recalculates the hash statistics from every stored fingerprint. A heavy operation,
+        run by hand (e.g. after upgrading an existing database).
+        """
+        raise NotImplementedError
+
+    def get_last_song_for_stream(self, streamid):
+        """The song last recorded for a stream, or None."""
+        raise NotImplementedError
+
+    def store_song_for_stream(self, streamid, songid):
+        """Records the song playing on a stream. Returns True only if this changed it, so that
+        of several callers storing the same change at once, exactly one sees it as a change.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases any connections held by the backend."""
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_storage(backend=STORAGE_BACKEND, **settings):
+    # a new instance of a backend, by its name in BACKENDS
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown storage backend {backend!r}, expected one of {", ".join(BACKENDS)}')
+    module_name, class_name = BACKENDS[backend]
+    return getattr(importlib.import_module(module_name), class_name)(**settings)
+
+
+def get_storage():
+    # the configured backend, created on first use and kept for the life of the container
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+def set_storage(storage):
+    # replaces the backend in use (e.g. to run against a particular one in benchmarks and
+    # tests), returning the one it replaced
+    global _storage
+    with _storage_lock:
+        previous, _storage = _storage, storage
+    return previous
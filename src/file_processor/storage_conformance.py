@@ -0,0 +1,262 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+# Conformance checks for the fingerprint storage backends (see storage.py).
+#
+# Runs the same checks against each backend: schema setup, storing and looking up fingerprints
+# against a brute force search, replacing a song, hash statistics and stop hashes, content
+# keys, stream state, and an empty lookup. Then reports insert and lookup throughput. The
+# checks write songs and streams of their own, so point the database backends at a scratch
+# database:
+#
+#   python storage_conformance.py --backends sqlite
+#   DatabaseUrl=postgresql://... python storage_conformance.py --backends postgres
+#
+# The process exits with status 1 if any check fails.
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import os
+import sys
+import uuid
+import tempfile
+import traceback
+import numpy as np
+import db_utils
+from storage import create_storage, set_storage
+
+# songs stored for the lookup checks, and fingerprints per song
+SONGS = 3
+SONG_FINGERPRINTS = 3000
+# songs sharing one hash, enough to make it a stop hash
+STOP_HASH_SONGS = 25
+# songs, fingerprints per song and hashes per lookup for the throughput figures
+THROUGHPUT_SONGS = 5
+THROUGHPUT_FINGERPRINTS = 20000
+THROUGHPUT_LOOKUP_HASHES = 2000
+
+
+class Fixture:
+    """Song names and hashes unique to one run, so runs don't see each other's data."""
+
+    def __init__(self, seed=0):
+        self.run = uuid.uuid4().hex[:8]
+        self.rng = np.random.default_rng(seed)
+        # hashes are drawn from a small range of their own, so songs share plenty of them
+        self.hash_base = int(np.random.default_rng().integers(1, 2 ** 40)) << 20
+        self.songs = {}
+
+    def name(self, song):
+        return f'conformance-{self.run}-{song}'
+
+    def fingerprints(self, rows, hash_range=500, steps=200):
+        hashes = self.hash_base + self.rng.integers(0, hash_range, rows)
+        return hashes.astype(np.int64), self.rng.integers(0, steps, rows).astype(np.float64)
+
+    def store(self, storage, song, hashes, timesteps, content_key=None):
+        storage.store_fingerprints(self.name(song), hashes, timesteps, content_key=content_key)
+        self.songs[self.name(song)] = (hashes, timesteps)
+
+    def expected_rows(self, hashes):
+        # every stored (hash, song, timestep), found by brute force
+        rows = []
+        for songid, (song_hashes, timesteps) in self.songs.items():
+            found = np.isin(song_hashes, hashes)
+            rows += zip(song_hashes[found].tolist(), [songid] * int(found.sum()), timesteps[found].astype(int).tolist())
+        return sorted(rows)
+
+
+def selected_rows(storage, hashes):
+    # the rows a backend returns for some hashes, expanded and sorted
+    song_ids, found, song_idxs, timesteps, counts = storage.select_fingerprints_for_hashes(hashes)
+    assert np.all(np.diff(found) >= 0), 'rows are not in hash order'
+    rows = zip(found.tolist(), [song_ids[i] for i in song_idxs.tolist()], timesteps.tolist())
+    return sorted(row for row, n in zip(rows, counts.tolist()) for _ in range(n))
+
+
+def check_schema(make_storage, fixture):
+    storage = make_storage()
+    storage.ensure_schema()
+    storage.ensure_schema()
+    make_storage().ensure_schema()
+
+
+def check_store_and_lookup(make_storage, fixture):
+    storage = make_storage()
+    for song in range(SONGS):
+        fixture.store(storage, song, *fixture.fingerprints(SONG_FINGERPRINTS))
+    hashes = np.unique(fixture.fingerprints(300)[0])
+    assert selected_rows(storage, hashes) == fixture.expected_rows(hashes), 'lookup differs from brute force'
+
+    # the same through the lookup used for identification
+    previous = set_storage(storage)
+    try:
+        query = list(zip(*(column.tolist() for column in fixture.fingerprints(200))))
+        matches = db_utils.get_db_matches_for_fingerprints(query).to_dict()
+    finally:
+        set_storage(previous)
+    expected = {}
+    query_times = {}
+    for h, t in query:
+        query_times.setdefault(h, []).append(t)
+    for h, songid, timestep in fixture.expected_rows(np.array(list(query_times), dtype=np.int64)):
+        expected.setdefault(songid, []).extend((float(timestep), t) for t in query_times[h])
+    assert {songid: sorted(pairs) for songid, pairs in matches.items()} == \
+        {songid: sorted(pairs) for songid, pairs in expected.items()}, 'matches differ from brute force'
+
+
+def check_replace(make_storage, fixture):
+    storage = make_storage()
+    fixture.store(storage, 1, *fixture.fingerprints(SONG_FINGERPRINTS // 2))
+    hashes = np.unique(fixture.fingerprints(300)[0])
+    assert selected_rows(storage, hashes) == fixture.expected_rows(hashes), 'old rows left after replacing a song'
+
+    # fractional timesteps are rounded half up
+    fixture.store(storage, 'rounding', np.array([fixture.hash_base - 1] * 3), np.array([0.5, 1.4, 2.6]))
+    assert selected_rows(storage, np.array([fixture.hash_base - 1])) == \
+        [(fixture.hash_base - 1, fixture.name('rounding'), t) for t in (1, 1, 3)], 'timesteps rounded differently'
+
+
+def check_stop_hashes(make_storage, fixture):
+    # the statistics kept as songs are stored agree with ones rebuilt from scratch
+    storage = make_storage()
+    stop_hash = fixture.hash_base - 2
+    for song in range(STOP_HASH_SONGS):
+        fixture.store(storage, f'stop{song}', np.array([stop_hash, stop_hash]), np.array([song, song + 1.0]))
+    stop_hashes = make_storage().get_stop_hashes()
+    assert stop_hashes.get(stop_hash) == 2 * STOP_HASH_SONGS, 'shared hash is not a stop hash'
+    assert not any(fixture.hash_base <= h < fixture.hash_base + 500 for h in stop_hashes), 'unexpected stop hash'
+    storage.rebuild_hash_stats()
+    assert make_storage().get_stop_hashes() == stop_hashes, 'stop hashes differ after rebuilding the statistics'
+
+
+def check_content_key(make_storage, fixture):
+    storage = make_storage()
+    assert storage.get_indexed_content_key(fixture.name('never stored')) is None
+    fixture.store(storage, 'keyed', *fixture.fingerprints(10), content_key='key1')
+    assert storage.get_indexed_content_key(fixture.name('keyed')) == 'key1'
+    fixture.store(storage, 'keyed', *fixture.fingerprints(10), content_key='key2')
+    assert storage.get_indexed_content_key(fixture.name('keyed')) == 'key2'
+
+
+def check_streams(make_storage, fixture):
+    storage = make_storage()
+    stream = fixture.name('stream')
+    assert storage.get_last_song_for_stream(stream) is None
+    assert storage.store_song_for_stream(stream, 'a') is True
+    assert storage.store_song_for_stream(stream, 'a') is False, 'storing the same song counted as a change'
+    assert storage.get_last_song_for_stream(stream) == 'a'
+    assert storage.store_song_for_stream(stream, None) is True
+    assert storage.get_last_song_for_stream(stream) is None
+
+    # of several callers storing the same change at once, exactly one sees it
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        changed = list(executor.map(lambda _: storage.store_song_for_stream(stream, 'b'), range(8)))
+    assert changed.count(True) == 1, f'{changed.count(True)} concurrent callers saw the change'
+
+
+def check_empty_lookup(make_storage, fixture):
+    song_ids, *columns = make_storage().select_fingerprints_for_hashes(np.empty(0, dtype=np.int64))
+    assert len(song_ids) == 0 and all(len(column) == 0 for column in columns)
+    missing = np.array([fixture.hash_base - 3])
+    assert selected_rows(make_storage(), missing) == []
+
+
+CHECKS = [check_schema, check_store_and_lookup, check_replace, check_stop_hashes, check_content_key,
+          check_streams, check_empty_lookup]
+
+
+def measure_throughput(make_storage, fixture):
+    # rows stored and rows returned per second
+    storage = make_storage()
+    songs = [fixture.fingerprints(THROUGHPUT_FINGERPRINTS, hash_range=200000, steps=20000)
+             for _ in range(THROUGHPUT_SONGS)]
+    start = perf_counter()
+    for song, (hashes, timesteps) in enumerate(songs):
+        storage.store_fingerprints(fixture.name(f'throughput{song}'), hashes, timesteps)
+    insert_seconds = perf_counter() - start
+
+    hashes = np.unique(songs[0][0][:THROUGHPUT_LOOKUP_HASHES])
+    start = perf_counter()
+    rows = int(storage.select_fingerprints_for_hashes(hashes)[4].sum())
+    lookup_seconds = perf_counter() - start
+    return {
+        'insert_rows_per_sec': THROUGHPUT_SONGS * THROUGHPUT_FINGERPRINTS / insert_seconds,
+        'lookup_rows_per_sec': rows / lookup_seconds,
+        'lookup_seconds': lookup_seconds,
+    }
+
+
+def run_conformance(backend, make_storage, throughput=True):
+    """Runs every check against a backend, printing the outcome of each.
+
+    :param make_storage: Function returning a backend instance. Each call should give a new
+        instance on the same database, so caches are tested too.
+    :returns: Number of failed checks.
+    """
+    print(f'== {backend}')
+    fixture = Fixture()
+    failures = 0
+    for check in CHECKS:
+        try:
+            check(make_storage, fixture)
+            print(f'PASS {check.__name__}')
+        except Exception:
+            print(f'FAIL {check.__name__}')
+            traceback.print_exc()
+            failures += 1
+    if throughput and failures == 0:
+        results = measure_throughput(make_storage, fixture)
+        print(f'insert: {results["insert_rows_per_sec"]:.0f} rows/second, '
+              f'lookup: {results["lookup_rows_per_sec"]:.0f} rows/second ({results["lookup_seconds"] * 1000:.1f}ms)')
+    return failures
+
+
+def configured_backends():
+    # sqlite always; the database backends when they have settings
+    backends = ['sqlite']
+    if os.environ.get('DatabaseUrl'):
+        backends.append('postgres')
+    if os.environ.get('DBClusterArn'):
+        backends.append('dataapi')
+    return backends
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Check the fingerprint storage backends behave the same')
+    parser.add_argument('--backends', nargs='+', choices=['sqlite', 'postgres', 'dataapi'],
+                        help='backends to check (default: every configured backend)')
+    parser.add_argument('--no-throughput', action='store_true', help='skip the throughput figures')
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in args.backends or configured_backends():
+            instances = []
+            settings = {'path': os.path.join(tmp_dir, 'conformance.sqlite3')} if backend == 'sqlite' else {}
+
+            def make_storage():
+                instances.append(create_storage(backend, **settings))
+                return instances[-1]
+
+            failures += run_conformance(backend, make_storage, throughput=not args.no_throughput)
+            for storage in instances:
+                storage.close()
+
+    if failures:
+        print(f'{failures} checks failed')
+        sys.exit(1)
@@ -0,0 +1,166 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import re
+import numpy as np
+from collections import deque, OrderedDict
+from time import monotonic
+from fingerprint_index import get_matches_for_fingerprints
+from fingerprinting import get_samples_for_s3_object, samples_to_fingerprint_arrays
+from fingerprinting_config import SAMPLE_RATE, TARGET_START, TARGET_T, FFT_WINDOW_SIZE, \
+    TIMESTEPS_PER_SECOND
+from matching import MINIMUM_SCORE_FOR_MATCH, score_songs
+
+# how many consecutive segments of a stream are scored together
+STREAM_WINDOW_SEGMENTS = 3
+
+# seconds of audio carried over from the end of one segment to the start of the next. This
+# covers the longest anchor/target pair, plus a spectrogram window either side
+STREAM_OVERLAP_SECONDS = TARGET_START + TARGET_T + 2 * FFT_WINDOW_SIZE
+
+# a session not used for this long is dropped - its stream has stopped, or moved to another
+# container, so the next segment would start a new session anyway
+STREAM_SESSION_IDLE_SECONDS = 300
+# most sessions kept at once; the least recently used are dropped first
+STREAM_SESSION_MAX_ENTRIES = 100
+
+# stream name -> (session, time last used), least recently used first
+_sessions = OrderedDict()
+
+
+class StreamSession:
+    """Rolling state for one stream, carried between its consecutive segments.
+
+    Each segment is fingerprinted together with the last few seconds of the one before it, so
+    landmark pairs that cross the boundary are found. Only pairs with a target in the new
+    audio are looked up, so nothing is counted twice. Matches are kept on a timeline for the
+    whole stream, and the last STREAM_WINDOW_SEGMENTS segments are scored together - a song
+    that keeps playing lines up at the same offset in every segment, so its votes add up.
+
+    Sessions live in the memory of a warm container. If a segment arrives out of order (or is
+    handled by another container) the session starts over from that segment.
+
+    :param stream_name: Name of the stream, for log messages.
+    :param window_segments: How many segments are scored together. None keeps them all.
+    """
+
+    def __init__(self, stream_name, window_segments=STREAM_WINDOW_SEGMENTS):
+        self.stream_name = stream_name
+        self.window_segments = window_segments
+        self.song_ids = []
+        self._song_lookup = {}
+        self.reset()
+
+    def reset(self):
+        self.last_segment = None
+        self.tail = None
+        # stream time, in samples, of the start of the tail
+        self.position = 0
+        # (song index, db timestep, stream timestep) arrays for each recent segment
+        self.window = deque(maxlen=self.window_segments)
+
+    def add_segment(self, segment_number, samples):
+        """Adds the audio for the next segment, and returns the best match over the window.
+
+        :param segment_number: Sequence number of the segment, used to spot gaps.
+        :param samples: Decoded samples for the segment.
+        :returns: (song_id, score), where song_id is None if nothing scores at least
+            MINIMUM_SCORE_FOR_MATCH.
+        """
+        if segment_number is None or self.last_segment is None or segment_number != self.last_segment + 1:
+            if self.last_segment is not None:
+                print(f'Stream {self.stream_name} jumped from segment {self.last_segment} '
+                      f'to {segment_number}, starting a new session')
+            self.reset()
+        self.last_segment = segment_number
+        self.add_samples(samples)
+        return self.best_match()
+
+    def add_samples(self, samples):
+        """Fingerprints the audio that follows on from the last samples added, and adds its
+        matches to the window.
+        """
+        if self.tail is None:
+            audio = samples
+            min_target_time = None
+        else:
+            audio = np.concatenate((self.tail, samples))
+            min_target_time = len(self.tail) / SAMPLE_RATE
+
+        hashes, offsets = samples_to_fingerprint_arrays(audio, min_target_time=min_target_time)
+        matches = get_matches_for_fingerprints(list(zip(hashes.tolist(), offsets.tolist())))
+        self.window.append(self._to_timeline(matches, self.position / SAMPLE_RATE * TIMESTEPS_PER_SECOND))
+
+        keep = min(int(STREAM_OVERLAP_SECONDS * SAMPLE_RATE), len(audio))
+        self.tail = audio[len(audio) - keep:].copy()
+        self.position += len(audio) - keep
+
+    def best_match(self):
+        ranked = self.top_matches(top_n=1)
+        if len(ranked) == 0:
+            return None, 0
+        song_id, score = ranked[0]
+        if score < MINIMUM_SCORE_FOR_MATCH:
+            return None, score
+        return song_id, score
+
+    def top_matches(self, top_n):
+        # the best top_n (song_id, score) pairs over the window, best first
+        if len(self.window) == 0:
+            return []
+        song_idxs, db_times, stream_times = (np.concatenate(column) for column in zip(*self.window))
+        songs, scores, _ = score_songs(song_idxs, db_times, stream_times, top_n=top_n)
+        return [(self.song_ids[song], int(score)) for song, score in zip(songs, scores)]
+
+    def _to_timeline(self, matches, start):
+        # matches as arrays indexing into this session's song table, with query times moved
+        # onto the stream's timeline. Only the songs that matched are looked up, as the
+        # matches' song table can be the whole catalogue
+        matched, song_idxs = np.unique(matches.song_idxs, return_inverse=True)
+        to_session = np.empty(len(matched), dtype=np.int64)
+        for i, song in enumerate(matched.tolist()):
+            songid = matches.song_ids[song]
+            if songid not in self._song_lookup:
+                self._song_lookup[songid] = len(self.song_ids)
+                self.song_ids.append(songid)
+            to_session[i] = self._song_lookup[songid]
+        return to_session[song_idxs], matches.db_times, matches.query_times + start
+
+
+def get_session(stream_name):
+    now = monotonic()
+    session, last_used = _sessions.pop(stream_name, (None, None))
+    if session is None or now - last_used >= STREAM_SESSION_IDLE_SECONDS:
+        session = StreamSession(stream_name)
+
+    # drop sessions that have gone idle, and the least recently used beyond the limit
+    while len(_sessions) > 0 and (len(_sessions) >= STREAM_SESSION_MAX_ENTRIES or
+                                  now - next(iter(_sessions.values()))[1] >= STREAM_SESSION_IDLE_SECONDS):
+        _sessions.popitem(last=False)
+    _sessions[stream_name] = (session, now)
+    return session
+
+
+def get_segment_number(key):
+    # MediaLive archive files are named {nameprefix}_{namemodifier}.{number}.ts
+    match = re.search(r'\.(\d+)\.[^.]+$', key)
+    return int(match.group(1)) if match else None
+
+
+def match_stream_segment(stream_name, bucket, key):
+    """Identifies the song playing in a stream, using this segment and the ones before it."""
+    samples = get_samples_for_s3_object(bucket, key)
+    return get_session(stream_name).add_segment(get_segment_number(key), samples)
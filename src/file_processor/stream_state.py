@@ -0,0 +1,65 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+from collections import OrderedDict
+from time import monotonic
+from db_utils import store_song_for_stream_in_db
+
+# how long a cached song for a stream is trusted before the database is checked again
+STREAM_STATE_TTL_SECONDS = 120
+# most streams cached at once; the least recently used are evicted first
+STREAM_STATE_MAX_ENTRIES = 1000
+
+# streamid -> (songid, expiry time)
+_cache = OrderedDict()
+
+
+def update_stream_song(streamid, songid):
+    """Records the song currently playing on a stream.
+
+    The last song for each stream is cached in memory. If it matches, nothing is sent to the
+    database at all. Otherwise the song is written through with a conditional upsert, which
+    reports whether the stored value actually changed - so if two invocations see the same
+    change at once, only one of them reports it.
+
+    :param streamid: Name of the stream.
+    :param songid: The song now playing.
+    :returns: True if this changed the song recorded for the stream.
+    """
+    if get_cached_song(streamid) == songid:
+        return False
+    changed = store_song_for_stream_in_db(streamid, songid)
+    cache_song(streamid, songid)
+    return changed
+
+
+def get_cached_song(streamid):
+    entry = _cache.get(streamid)
+    if entry is None:
+        return None
+    songid, expires = entry
+    if monotonic() >= expires:
+        del _cache[streamid]
+        return None
+    _cache.move_to_end(streamid)
+    return songid
+
+
+def cache_song(streamid, songid):
+    _cache[streamid] = (songid, monotonic() + STREAM_STATE_TTL_SECONDS)
+    _cache.move_to_end(streamid)
+    while len(_cache) > STREAM_STATE_MAX_ENTRIES:
+        _cache.popitem(last=False)
@@ -14,18 +14,8 @@ COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
-from time import perf_counter
-from contextlib import ContextDecorator
+import os
+import sys
 
-
-class CMtimer(ContextDecorator):
-    def __init__(self, msg):
-        self.msg = msg
-
-    def __enter__(self):
-        self.time = perf_counter()
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.time = perf_counter() - self.time
-        print(f'{self.msg} took {self.time:.3f} seconds')
+# the modules under test are run from src/file_processor, as they are in the function
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
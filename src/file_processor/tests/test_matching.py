@@ -0,0 +1,39 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import pytest
+from matching import get_best_match, rank_matches, score_match
+
+# cases that are easy to get wrong, including ones where every delta falls below the first
+# histogram bin
+CASES = {
+    'all deltas dropped': {'a': [(10.0, 12.4), (10.0, 12.6)]},
+    'single negative delta': {'a': [(1.0, 3.3)]},
+    'one song dropped, one scored': {'a': [(1.0, 3.3)], 'b': [(5.0, 1.0), (6.0, 2.0), (9.0, 1.0)]},
+    'mixed signs': {'a': [(0.0, 1.7), (3.0, 1.0), (3.2, 1.1), (8.0, 0.5)]},
+}
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_rank_matches_scores_like_score_match(name):
+    matches = CASES[name]
+    expected = {songid: int(score_match(offsets)) for songid, offsets in matches.items()}
+    got = {songid: score for songid, score, _ in rank_matches(matches, top_n=len(matches))}
+    assert got == expected
+
+
+def test_no_best_match_when_every_delta_is_dropped():
+    assert get_best_match(CASES['single negative delta']) == (None, 0)
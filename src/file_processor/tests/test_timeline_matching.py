@@ -0,0 +1,78 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import numpy as np
+from fingerprinting_config import TIMESTEPS_PER_SECOND
+from matching import Matches
+from timeline_matching import find_song_runs, TIMELINE_MAX_GAP_SECONDS
+
+RECORDING_SECONDS = 600
+SONG_SECONDS = 240
+# random matches per song, spread over the whole recording and song
+BACKGROUND_MATCHES = 3000
+
+
+def _timesteps(seconds):
+    return np.asarray(seconds, dtype=np.float64) * TIMESTEPS_PER_SECOND
+
+
+def _background(rng, song, count=BACKGROUND_MATCHES):
+    # (song, song time, recording time) of matches that line up by chance
+    return (np.full(count, song), _timesteps(rng.uniform(0, SONG_SECONDS, count)),
+            _timesteps(rng.uniform(0, RECORDING_SECONDS, count)))
+
+
+def _play(song, start, end, song_offset, per_second=5):
+    # matches from the song playing in the recording from start to end, starting at song_offset
+    query_seconds = np.linspace(start, end, (end - start) * per_second)
+    query_times = _timesteps(query_seconds)
+    return np.full(len(query_times), song), query_times + _timesteps(song_offset - start), query_times
+
+
+def _matches(*parts):
+    songs, db_times, query_times = (np.concatenate(column) for column in zip(*parts))
+    return Matches(['a', 'b'], songs, db_times, query_times)
+
+
+def test_finds_a_song_among_background_matches():
+    rng = np.random.default_rng(0)
+    runs = find_song_runs(_matches(_play(0, 100, 160, 20), _background(rng, 0), _background(rng, 1)))
+
+    assert [run['song'] for run in runs] == ['a']
+    run = runs[0]
+    assert abs(run['start'] - 100) <= TIMELINE_MAX_GAP_SECONDS
+    assert abs(run['end'] - 160) <= TIMELINE_MAX_GAP_SECONDS
+    assert abs(run['song_offset'] - 20) <= 1
+    assert run['score'] >= 5 * 60
+
+
+def test_finds_a_song_played_twice():
+    rng = np.random.default_rng(1)
+    runs = find_song_runs(_matches(_play(0, 30, 90, 0), _play(1, 200, 260, 50),
+                                   _play(0, 400, 460, 0), _background(rng, 0), _background(rng, 1)))
+
+    assert [(run['song'], round(run['song_offset'])) for run in runs] == [('a', 0), ('b', 50), ('a', 0)]
+    for run, start in zip(runs, (30, 200, 400)):
+        assert abs(run['start'] - start) <= TIMELINE_MAX_GAP_SECONDS
+
+
+def test_finds_nothing_in_background_matches():
+    rng = np.random.default_rng(2)
+    assert find_song_runs(_matches(_background(rng, 0), _background(rng, 1))) == []
+
+
+def test_empty_matches():
+    assert find_song_runs(Matches(['a'], [], [], [])) == []
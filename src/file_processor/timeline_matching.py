@@ -0,0 +1,217 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import json
+import pathlib
+import numpy as np
+from fingerprint_cache import get_fingerprints_for_s3_object_cached
+from fingerprint_index import get_matches_for_fingerprints
+from fingerprinting_config import TIMESTEPS_PER_SECOND
+from matching import BIN_WIDTH
+from metrics import stage, count
+from s3_utils import send_text_to_s3
+
+# matching hashes whose time deltas (song time minus recording time) are within this many
+# timesteps of a peak in the song's histogram of deltas are taken to be that alignment of the
+# song with the recording. It is also the width of the histogram's bins
+TIMELINE_DELTA_TOLERANCE = BIN_WIDTH
+# an alignment is split into separate runs where no hash matches for this many seconds
+TIMELINE_MAX_GAP_SECONDS = 10
+# runs with fewer matching hashes than this are left out of the timeline
+TIMELINE_MIN_SCORE = 20
+# a run is left out if more than this fraction of it overlaps runs that scored higher
+TIMELINE_MAX_OVERLAP = 0.5
+
+
+def find_song_runs(matches, min_score=TIMELINE_MIN_SCORE, max_gap_seconds=TIMELINE_MAX_GAP_SECONDS):
+    """Finds where each song plays in a long recording.
+
+    Hashes from one play of a song all share (nearly) the same time delta, so each song's
+    deltas are counted in a histogram, and the matches within :data:`TIMELINE_DELTA_TOLERANCE`
+    of each peak in it make up one alignment. Matches away from every peak are background and
+    are ignored. Each alignment is split wherever the recording goes
+    :data:`TIMELINE_MAX_GAP_SECONDS` without a match, so a song played twice gives two runs.
+    Runs are then taken best first, leaving out any that mostly overlap a better one.
+
+    :param matches: :class:`matching.Matches` for the whole recording.
+    :param min_score: Fewest matching hashes for a run to be reported.
+    :param max_gap_seconds: Longest gap between matching hashes within a run.
+    :returns: List of dictionaries with the song, the start and end of the run in the
+        recording and where the run starts within the song (all in seconds), and the score
+        (number of matching hashes), in order of start time.
+    :rtype: list
+    """
+    with stage('Scoring'):
+        songs = matches.song_idxs
+        query_times = matches.query_times
+        deltas = matches.db_times - query_times
+
+        alignments = _find_alignments(songs, deltas, min_score)
+        keep = alignments >= 0
+        songs, deltas, query_times, alignments = (
+            column[keep] for column in (songs, deltas, query_times, alignments)
+        )
+
+        # within each alignment, sort by recording time and start a new run at each long gap
+        order = np.lexsort((query_times, alignments))
+        songs, deltas, query_times, alignments = (
+            column[order] for column in (songs, deltas, query_times, alignments)
+        )
+        new_run = np.r_[True, (alignments[1:] != alignments[:-1]) |
+                        (np.diff(query_times) > max_gap_seconds * TIMESTEPS_PER_SECOND)]
+        starts = np.flatnonzero(new_run)
+        ends = np.r_[starts[1:], len(songs)]
+        scores = ends - starts
+        keep = scores >= min_score
+        starts, ends, scores = starts[keep], ends[keep], scores[keep]
+
+        runs = []
+        for start, end, score in zip(starts.tolist(), ends.tolist(), scores.tolist()):
+            offset = float(np.median(deltas[start:end]))
+            runs.append({
+                'song': matches.song_ids[songs[start]],
+                'start': float(query_times[start]) / TIMESTEPS_PER_SECOND,
+                'end': float(query_times[end - 1]) / TIMESTEPS_PER_SECOND,
+                'song_offset': (float(query_times[start]) + offset) / TIMESTEPS_PER_SECOND,
+                'score': score,
+            })
+        count('TimelineRuns', len(runs))
+        runs = _drop_overlapping(runs)
+    return sorted(runs, key=lambda run: run['start'])
+
+
+def _find_alignments(songs, deltas, min_score):
+    # counts each song's deltas in bins TIMELINE_DELTA_TOLERANCE wide, and takes the bins whose
+    # counts (together with their neighbours', so a peak split across two bins isn't missed) are
+    # local maxima of at least min_score as the song's alignments. Returns the alignment of each
+    # match, or -1 for matches that aren't within the tolerance of any peak
+    alignments = np.full(len(deltas), -1, dtype=np.int64)
+    if len(deltas) == 0:
+        return alignments
+    width = TIMELINE_DELTA_TOLERANCE
+    bins = np.floor(deltas / width).astype(np.int64)
+    # one key per (song, bin), with room either side so neighbouring bins never cross songs
+    lowest = bins.min() - 3
+    keys = songs * (bins.max() - lowest + 4) + (bins - lowest)
+    keys_sorted = np.sort(keys)
+    first = np.flatnonzero(np.r_[True, keys_sorted[1:] != keys_sorted[:-1]])
+    occupied, counts = keys_sorted[first], np.diff(np.r_[first, len(keys)])
+
+    def window(table, values, at):
+        # total of values over each bin in at and its two neighbours
+        total = np.zeros(len(at), dtype=np.int64)
+        for step in (-1, 0, 1):
+            i = _lookup(table, at + step)
+            total += np.where(i >= 0, values[i], 0)
+        return total
+
+    candidates = np.sort(np.r_[occupied - 1, occupied, occupied + 1])
+    candidates = candidates[np.r_[True, candidates[1:] != candidates[:-1]]]
+    heights = window(occupied, counts, candidates)
+
+    def height_at(at):
+        i = _lookup(candidates, at)
+        return np.where(i >= 0, heights[i], 0)
+
+    # on a plateau, only the last bin counts as the peak
+    is_peak = ((heights >= min_score) & (heights >= height_at(candidates - 1)) &
+               (heights > height_at(candidates + 1)))
+    peaks = candidates[is_peak]
+    if len(peaks) == 0:
+        return alignments
+
+    # each peak is centred on the mean delta of the matches in its three bins
+    sums = np.zeros(len(peaks))
+    for step in (-1, 0, 1):
+        i = _lookup(peaks, keys + step)
+        sums += np.bincount(i[i >= 0], weights=deltas[i >= 0], minlength=len(peaks))
+    centres = sums / heights[is_peak]
+
+    # a match goes to the nearest peak centre within the tolerance, which is at most two bins away
+    nearest = np.full(len(deltas), np.inf)
+    for step in range(-2, 3):
+        i = _lookup(peaks, keys + step)
+        distance = np.where(i >= 0, np.abs(deltas - centres[i]), np.inf)
+        closer = (distance <= width) & (distance < nearest)
+        alignments[closer] = i[closer]
+        nearest[closer] = distance[closer]
+    return alignments
+
+
+def _lookup(table, keys):
+    # position of each key in the sorted table, or -1 where it isn't there
+    i = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+    return np.where(table[i] == keys, i, -1)
+
+
+def _drop_overlapping(runs):
+    # a recording of one song can also match a few hashes of other songs alongside it, so
+    # only the best run is kept wherever runs mostly overlap
+    chosen = []
+    for run in sorted(runs, key=lambda run: -run['score']):
+        length = max(run['end'] - run['start'], 1 / TIMESTEPS_PER_SECOND)
+        overlap = sum(max(0.0, min(run['end'], other['end']) - max(run['start'], other['start']))
+                      for other in chosen)
+        if overlap <= TIMELINE_MAX_OVERLAP * length:
+            chosen.append(run)
+    return chosen
+
+
+def identify_timeline(fingerprints):
+    """Finds every song in a recording from its fingerprints, with a single lookup.
+
+    :param fingerprints: List of (hash, time offset) pairs for the whole recording.
+    :returns: The runs found, as from :func:`find_song_runs`.
+    """
+    return find_song_runs(get_matches_for_fingerprints(fingerprints))
+
+
+def identify_timeline_in_file(bucket, key):
+    # used for long recordings (e.g. DJ mixes or broadcasts) dropped into the timelines folder.
+    # The file is fingerprinted once and every hash looked up once, and the report lists
+    # each song found with when it plays
+    fingerprints = get_fingerprints_for_s3_object_cached(bucket, key)
+    runs = identify_timeline(fingerprints)
+    print(f'Found {len(runs)} songs in {key}')
+    write_timeline_report(bucket, key, runs)
+    return runs
+
+
+def write_timeline_report(bucket, key, runs):
+    report_data = json.dumps({
+        "songs": [
+            {**run, **{name: round(run[name], 3) for name in ('start', 'end', 'song_offset')}}
+            for run in runs
+        ]
+    })
+
+    # written next to the recording, like the reports for single files
+    pathinfo = pathlib.PurePath(key)
+    report_name = f'{pathinfo.parent.as_posix()}/{pathinfo.stem}.json'
+    print(f'Writing report {report_name} to {bucket}')
+    send_text_to_s3(bucket, report_name, report_data)
+
+
+if __name__ == '__main__':
+    import argparse
+    from fingerprinting import get_fingerprints
+    parser = argparse.ArgumentParser(description='List the known songs in a long local recording')
+    parser.add_argument('path')
+    parser.add_argument('--min-score', type=int, default=TIMELINE_MIN_SCORE,
+                        help='fewest matching hashes for a song to be listed')
+    args = parser.parse_args()
+    matches = get_matches_for_fingerprints(get_fingerprints(args.path))
+    print(json.dumps(find_song_runs(matches, min_score=args.min_score), indent=2))